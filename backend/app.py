@@ -1,32 +1,69 @@
-from flask import Flask, jsonify, request
+from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from functools import wraps
+from flask_migrate import Migrate
 import os
 from db import db
+from config import Config
+from jobs import job_worker
+from outbox import s3_deletion_worker
+from rate_limit import rate_limiter
+from profiling import request_profiler
+from s3_client import s3_client
 from routes.audiofiles import audiofiles_routes  # Import the routes for authentication
 from routes.users import users_routes
+from routes.uploads import uploads_routes
 from routes.utils import utils_routes
-from routes.utils import create_admin
-
-# Initialize Flask app and enable CORS
-app = Flask(__name__)
-CORS(app, supports_credentials=True)
-
-app.register_blueprint(audiofiles_routes)  
-app.register_blueprint(users_routes)      
-app.register_blueprint(utils_routes)
-
-# Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://user:password@db:5432/audiovault'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'default-secret-key')
-
-# Create tables if they don't exist and add an admin user 'audiovault' by default
-with app.app_context():
-    db.init_app(app)  # Initialize the db with the app
-    db.create_all()
-    create_admin()
+from routes.jobs import jobs_routes
+
+migrate = Migrate()
+
+def dispose_engines(app):
+    """Drops the pooled database connections inherited by a forked process, without closing the parent's."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def create_app(config=Config):
+    """
+    Builds the Flask app. Nothing is connected or hashed here: database connections, the S3 client and the
+    disk cache's index are created by each process on first use, so servers that fork workers from a
+    preloaded app (e.g. gunicorn --preload) start them in milliseconds. The schema and the master user are
+    set up once per deployment with `flask bootstrap`.
+
+    Args:
+        config: The configuration object, defaults to Config read from the environment.
+
+    Returns:
+        Flask: The app.
+    """
+    # Initialize Flask app and enable CORS
+    app = Flask(__name__)
+    CORS(app, supports_credentials=True)
+
+    app.register_blueprint(audiofiles_routes)
+    app.register_blueprint(uploads_routes)
+    app.register_blueprint(users_routes)
+    app.register_blueprint(utils_routes)
+    app.register_blueprint(jobs_routes)
+
+    # Configuration
+    app.config.from_object(config)
+
+    # Registered first so the timings include the other before_request hooks
+    request_profiler.init_app(app, s3_client)
+
+    # The schema is managed by migrations in migrations/, apply them with `flask bootstrap` or `flask db upgrade`
+    db.init_app(app)
+    migrate.init_app(app, db)
+    job_worker.init_app(app)
+    s3_deletion_worker.init_app(app)
+    rate_limiter.init_app(app)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: dispose_engines(app))
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,72 @@
+import asyncio
+from quart import Quart, request, jsonify
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+from config import Config
+from async_db import async_engine
+from async_s3_client import open_async_s3_client, close_async_s3_client
+from rate_limit import rate_limiter, request_user_id, client_ip, retry_after_seconds
+from routes.async_audiofiles import async_audiofiles_routes
+from app import app as wsgi_app
+
+# Async serving path: the audio endpoints are handled natively on the event loop, so a slow S3 read
+# or upload does not hold a worker thread, while every other route falls through to the Flask app.
+# Run with an ASGI server, e.g. `uvicorn asgi:app --host 0.0.0.0 --port 5000`
+async_app = Quart(__name__)
+async_app.config.from_object(Config)
+async_app.config['SECRET_KEY'] = wsgi_app.config['SECRET_KEY']
+async_app.register_blueprint(async_audiofiles_routes)
+
+fallback_app = WsgiToAsgi(wsgi_app)
+
+@async_app.before_serving
+async def startup():
+    await open_async_s3_client()
+
+@async_app.after_serving
+async def shutdown():
+    await close_async_s3_client()
+    await async_engine.dispose()
+
+@async_app.before_request
+async def limit_request():
+    # Counted in the same buckets as the Flask endpoints they mirror, e.g. audiofiles.create_audiofile
+    if request.method == 'OPTIONS' or not request.endpoint:
+        return None
+    endpoint = request.endpoint.replace('async_audiofiles.', 'audiofiles.', 1)
+    user_id = request_user_id(request, async_app.config['SECRET_KEY'])
+    # The Redis backend blocks on its socket, so it is called off the event loop
+    retry_after = await asyncio.to_thread(rate_limiter.check, endpoint, user_id, client_ip(request))
+    if retry_after:
+        seconds = retry_after_seconds(retry_after)
+        return jsonify({"error": f"Too many requests, retry after {seconds} seconds"}), 429, {"Retry-After": str(seconds)}
+    return None
+
+@async_app.after_request
+async def add_cors_headers(response):
+    # Mirrors CORS(app, supports_credentials=True) in app.py, preflight requests are answered by the Flask app
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.vary.add('Origin')
+    return response
+
+def is_async_route(scope):
+    """Returns whether an HTTP request matches one of the routes served by the async app."""
+    if scope['method'] == 'OPTIONS':
+        return False
+    try:
+        async_app.url_map.bind('').match(scope['path'], method=scope['method'])
+        return True
+    except HTTPException:
+        return False
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point dispatching each request to the async app or the Flask app.
+    """
+    if scope['type'] == 'lifespan' or (scope['type'] == 'http' and is_async_route(scope)):
+        await async_app(scope, receive, send)
+    else:
+        await fallback_app(scope, receive, send)
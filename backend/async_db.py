@@ -0,0 +1,16 @@
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from config import Config
+
+# Async engine and sessions for the async serving path, they work with the same models as db
+if Config.ASYNC_SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+    async_engine = create_async_engine(
+        Config.ASYNC_SQLALCHEMY_DATABASE_URI,
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_pre_ping=Config.DB_POOL_PRE_PING,
+        pool_recycle=Config.DB_POOL_RECYCLE_SECONDS,
+        connect_args={'server_settings': {'statement_timeout': str(Config.DB_STATEMENT_TIMEOUT_MS)}},
+    )
+else:
+    async_engine = create_async_engine(Config.ASYNC_SQLALCHEMY_DATABASE_URI)
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
@@ -0,0 +1,32 @@
+from contextlib import AsyncExitStack
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from config import Config
+
+_exit_stack = None
+_s3_client = None
+
+async def open_async_s3_client():
+    """
+    Creates the async S3 client shared by the async serving path, must be called once the event loop is running.
+    """
+    global _exit_stack, _s3_client
+    _exit_stack = AsyncExitStack()
+    _s3_client = await _exit_stack.enter_async_context(get_session().create_client(
+        's3',
+        region_name=Config.S3_REGION,
+        endpoint_url=Config.S3_ENDPOINT_URL,
+        config=AioConfig(max_pool_connections=Config.S3_MAX_POOL_CONNECTIONS),
+    ))
+
+async def close_async_s3_client():
+    """Closes the async S3 client and its connection pool."""
+    global _exit_stack, _s3_client
+    if _exit_stack is not None:
+        await _exit_stack.aclose()
+    _exit_stack = None
+    _s3_client = None
+
+def get_async_s3_client():
+    """Returns the async S3 client opened by open_async_s3_client."""
+    return _s3_client
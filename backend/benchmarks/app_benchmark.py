@@ -0,0 +1,674 @@
+"""
+End-to-end benchmark of the backend, booted from app.py against a throwaway database and an in-process
+S3 stand-in.
+
+The database is a SQLite file, an ephemeral Postgres cluster started with the initdb and pg_ctl binaries
+found on the PATH (or in --pg-bin), or an existing empty database given with --database-url. The schema
+is created by the migrations. The S3 stand-in is a small S3-compatible HTTP server with a fixed latency
+per request and a bandwidth limit per transfer, so the app's real boto3 client and connection pool are used.
+
+Synthetic users and libraries are seeded directly in the database and the stand-in, with file sizes drawn
+from a log-normal (or fixed) distribution. The app is then served by a threaded WSGI server and each
+workload is driven over keep-alive HTTP connections at the given concurrency. The report gives latency
+percentiles, throughput and errors per workload, and the peak RSS of the process, as JSON so runs can be
+compared across commits, e.g.
+
+    python benchmarks/app_benchmark.py --users 20 --files-per-user 200 --requests 500 --concurrency 16
+    python benchmarks/app_benchmark.py --db postgres --workloads list,favourites,like --latency 0.02
+
+The load generator, the server and the stand-in share one process, so absolute numbers are lower than on
+a real deployment; the report is meant for comparing commits on the same machine. Environment variables
+for Config (e.g. BCRYPT_ROUNDS, DISK_CACHE_DIR) are passed through, except that rate limiting and
+transcoding are off unless enabled in the environment.
+"""
+import argparse
+import datetime
+import hashlib
+import http.client
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs, quote
+from xml.etree import ElementTree
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+BUCKET = 'audiovault-bench'
+WORKLOADS = ['login', 'upload', 'list', 'favourites', 'like', 'stream', 'delete']
+PASSWORD = 'benchmark-password'
+
+# Content of seeded objects, which is generated on the fly from this block rather than held in memory
+PATTERN = hashlib.sha256(b'audiovault').digest() * 2048
+# Size of each write or read throttled by the stand-in's bandwidth limit
+TRANSFER_CHUNK_SIZE = 64 * 1024
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class StoredObject:
+    """An object in the stand-in, holding its content or, for seeded objects, only its size."""
+    def __init__(self, size, etag, content_type, data=None):
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+        self.data = data
+        self.last_modified = time.time()
+
+    def chunks(self, start, end):
+        """Yields the content from start up to and excluding end, TRANSFER_CHUNK_SIZE bytes at a time."""
+        offset = start
+        while offset < end:
+            length = min(TRANSFER_CHUNK_SIZE, end - offset)
+            if self.data is not None:
+                yield self.data[offset:offset + length]
+            else:
+                pattern_offset = offset % len(PATTERN)
+                length = min(length, len(PATTERN) - pattern_offset)
+                yield PATTERN[pattern_offset:pattern_offset + length]
+            offset += length
+
+class StandInS3Handler(BaseHTTPRequestHandler):
+    """
+    Serves the S3 operations the app uses with path-style addressing: objects, ranged and conditional
+    reads, multipart uploads, batch deletes and listing. Signatures are not checked.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        return bucket, unquote(key), parse_qs(parts.query, keep_blank_values=True)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = bytearray()
+        while len(body) < length:
+            chunk = self.rfile.read(min(TRANSFER_CHUNK_SIZE, length - len(body)))
+            if not chunk:
+                break
+            body += chunk
+            self.server.throttle(len(chunk))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            return decode_aws_chunked(bytes(body))
+        return bytes(body)
+
+    def send(self, status, body=b'', headers=None, chunks=None, length=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length if length is not None else len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for chunk in chunks if chunks is not None else [body]:
+            self.wfile.write(chunk)
+            self.server.throttle(len(chunk))
+
+    def send_xml(self, status, root):
+        body = b'<?xml version="1.0" encoding="UTF-8"?>' + ElementTree.tostring(root)
+        self.send(status, body, {'Content-Type': 'application/xml'})
+
+    def send_error_code(self, status, code, message):
+        root = ElementTree.Element('Error')
+        ElementTree.SubElement(root, 'Code').text = code
+        ElementTree.SubElement(root, 'Message').text = message
+        if self.command == 'HEAD':
+            self.send(status)
+        else:
+            self.send_xml(status, root)
+
+    def handle_operation(self, operation, handler):
+        self.server.record(operation)
+        try:
+            handler()
+        except Exception as e:
+            self.send_error_code(500, 'InternalError', str(e))
+
+    def do_HEAD(self):
+        self.handle_operation('HeadObject', self.get_object)
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if not key:
+            self.handle_operation('ListObjectsV2', lambda: self.list_objects(bucket, query))
+        else:
+            self.handle_operation('GetObject', self.get_object)
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        if 'uploadId' in query:
+            self.handle_operation('UploadPart', lambda: self.upload_part(key, query))
+        else:
+            self.handle_operation('PutObject', lambda: self.put_object(key))
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        if 'delete' in query:
+            self.handle_operation('DeleteObjects', self.delete_objects)
+        elif 'uploads' in query:
+            self.handle_operation('CreateMultipartUpload', lambda: self.create_multipart_upload(bucket, key))
+        else:
+            self.handle_operation('CompleteMultipartUpload', lambda: self.complete_multipart_upload(bucket, key, query))
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        if 'uploadId' in query:
+            self.handle_operation('AbortMultipartUpload', lambda: self.abort_multipart_upload(query))
+        else:
+            self.handle_operation('DeleteObject', lambda: self.delete_object(key))
+
+    def get_object(self):
+        _, key, _ = self.parse()
+        stored = self.server.objects.get(key)
+        if stored is None:
+            return self.send_error_code(404, 'NoSuchKey', 'The specified key does not exist.')
+        headers = {
+            'ETag': stored.etag,
+            'Content-Type': stored.content_type,
+            'Last-Modified': formatdate(stored.last_modified, usegmt=True),
+            'Accept-Ranges': 'bytes',
+        }
+        if self.headers.get('If-None-Match') == stored.etag:
+            return self.send(304, headers=headers, length=0)
+        start, end, status = 0, stored.size, 200
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes='):
+            first, _, last = byte_range[len('bytes='):].partition('-')
+            if first:
+                start, end = int(first), min(int(last) + 1, stored.size) if last else stored.size
+            else:
+                start = max(stored.size - int(last), 0)
+            if start >= stored.size:
+                return self.send_error_code(416, 'InvalidRange', 'The requested range is not satisfiable')
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{stored.size}"
+            status = 206
+        self.send(status, headers=headers, chunks=stored.chunks(start, end), length=end - start)
+
+    def put_object(self, key):
+        data = self.read_body()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.server.objects[key] = StoredObject(len(data), etag, self.headers.get('Content-Type', 'binary/octet-stream'), data)
+        self.send(200, headers={'ETag': etag})
+
+    def delete_object(self, key):
+        self.server.objects.pop(key, None)
+        self.send(204)
+
+    def delete_objects(self):
+        request = ElementTree.fromstring(self.read_body())
+        root = ElementTree.Element('DeleteResult', xmlns=S3_NAMESPACE)
+        for key in request.iter():
+            if key.tag.rpartition('}')[2] == 'Key':
+                self.server.objects.pop(key.text, None)
+                ElementTree.SubElement(ElementTree.SubElement(root, 'Deleted'), 'Key').text = key.text
+        self.send_xml(200, root)
+
+    def create_multipart_upload(self, bucket, key):
+        upload_id = uuid.uuid4().hex
+        self.server.uploads[upload_id] = (key, self.headers.get('Content-Type', 'binary/octet-stream'), {})
+        root = ElementTree.Element('InitiateMultipartUploadResult', xmlns=S3_NAMESPACE)
+        ElementTree.SubElement(root, 'Bucket').text = bucket
+        ElementTree.SubElement(root, 'Key').text = key
+        ElementTree.SubElement(root, 'UploadId').text = upload_id
+        self.send_xml(200, root)
+
+    def upload_part(self, key, query):
+        upload = self.server.uploads.get(query['uploadId'][0])
+        if upload is None:
+            return self.send_error_code(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        data = self.read_body()
+        upload[2][int(query['partNumber'][0])] = data
+        self.send(200, headers={'ETag': f'"{hashlib.md5(data).hexdigest()}"'})
+
+    def complete_multipart_upload(self, bucket, key, query):
+        self.read_body()
+        upload = self.server.uploads.pop(query['uploadId'][0], None)
+        if upload is None:
+            return self.send_error_code(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        parts = [upload[2][number] for number in sorted(upload[2])]
+        data = b''.join(parts)
+        etag = f'"{hashlib.md5(b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest()}-{len(parts)}"'
+        self.server.objects[key] = StoredObject(len(data), etag, upload[1], data)
+        root = ElementTree.Element('CompleteMultipartUploadResult', xmlns=S3_NAMESPACE)
+        ElementTree.SubElement(root, 'Bucket').text = bucket
+        ElementTree.SubElement(root, 'Key').text = key
+        ElementTree.SubElement(root, 'ETag').text = etag
+        self.send_xml(200, root)
+
+    def abort_multipart_upload(self, query):
+        if self.server.uploads.pop(query['uploadId'][0], None) is None:
+            return self.send_error_code(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        self.send(204)
+
+    def list_objects(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        after = query.get('continuation-token', query.get('start-after', ['']))[0]
+        keys = sorted(key for key in list(self.server.objects) if key.startswith(prefix) and key > after)
+        page = keys[:max_keys]
+        root = ElementTree.Element('ListBucketResult', xmlns=S3_NAMESPACE)
+        ElementTree.SubElement(root, 'Name').text = bucket
+        ElementTree.SubElement(root, 'Prefix').text = prefix
+        ElementTree.SubElement(root, 'KeyCount').text = str(len(page))
+        ElementTree.SubElement(root, 'MaxKeys').text = str(max_keys)
+        ElementTree.SubElement(root, 'IsTruncated').text = 'true' if len(keys) > max_keys else 'false'
+        for key in page:
+            stored = self.server.objects.get(key)
+            if stored is None:
+                continue
+            contents = ElementTree.SubElement(root, 'Contents')
+            ElementTree.SubElement(contents, 'Key').text = key
+            ElementTree.SubElement(contents, 'LastModified').text = datetime.datetime.fromtimestamp(stored.last_modified, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            ElementTree.SubElement(contents, 'ETag').text = stored.etag
+            ElementTree.SubElement(contents, 'Size').text = str(stored.size)
+            ElementTree.SubElement(contents, 'StorageClass').text = 'STANDARD'
+        if len(keys) > max_keys:
+            ElementTree.SubElement(root, 'NextContinuationToken').text = page[-1]
+        self.send_xml(200, root)
+
+def decode_aws_chunked(body):
+    """Decodes a body sent with the aws-chunked content encoding, dropping the chunk signatures and trailers."""
+    data = bytearray()
+    offset = 0
+    while True:
+        line_end = body.index(b'\r\n', offset)
+        size = int(body[offset:line_end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        offset = line_end + 2 + size + 2
+
+class StandInS3(ThreadingHTTPServer):
+    """In-process S3 stand-in adding a fixed latency to each request and a bandwidth limit to each transfer."""
+    daemon_threads = True
+
+    def __init__(self, latency, bandwidth):
+        super().__init__(('127.0.0.1', 0), StandInS3Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects = {}
+        self.uploads = {}
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # Clients closing idle pooled connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def record(self, operation):
+        with self._lock:
+            self.requests[operation] += 1
+        time.sleep(self.latency)
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def seed(self, key, size):
+        self.objects[key] = StoredObject(size, f'"{hashlib.md5(key.encode()).hexdigest()}"', 'audio/mpeg')
+
+def find_postgres_binary(name, pg_bin):
+    """Returns the path of a Postgres server binary, looking in pg_bin, the PATH and the usual install locations."""
+    candidates = [os.path.join(pg_bin, name)] if pg_bin else []
+    candidates.append(shutil.which(name))
+    candidates.extend(sorted(
+        (os.path.join('/usr/lib/postgresql', version, 'bin', name) for version in os.listdir('/usr/lib/postgresql')),
+        reverse=True
+    ) if os.path.isdir('/usr/lib/postgresql') else [])
+    for candidate in candidates:
+        if candidate and os.access(candidate, os.X_OK):
+            return candidate
+    raise SystemExit(f"Could not find the Postgres '{name}' binary, pass its directory with --pg-bin or use --database-url")
+
+def start_postgres(directory, pg_bin):
+    """
+    Initialises and starts a throwaway Postgres cluster in directory, listening on a free local port.
+
+    Returns:
+        tuple: (database URL, function stopping the cluster)
+    """
+    data_directory = os.path.join(directory, 'pgdata')
+    port = free_port()
+    subprocess.run(
+        [find_postgres_binary('initdb', pg_bin), '-D', data_directory, '-U', 'bench', '-A', 'trust', '--no-sync'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+    pg_ctl = find_postgres_binary('pg_ctl', pg_bin)
+    subprocess.run(
+        [pg_ctl, '-D', data_directory, '-l', os.path.join(directory, 'postgres.log'), '-w',
+         '-o', f"-p {port} -k {directory} -c listen_addresses=127.0.0.1", 'start'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+
+    def stop():
+        subprocess.run([pg_ctl, '-D', data_directory, '-m', 'fast', '-w', 'stop'], stdout=subprocess.DEVNULL)
+    return f"postgresql://bench@127.0.0.1:{port}/postgres", stop
+
+def file_size_sampler(args, rng):
+    """Returns a function drawing file sizes from the configured distribution."""
+    if args.size_distribution == 'fixed':
+        return lambda: args.file_size
+    sigma = args.size_sigma
+    # Log-normal with the given median, clipped to the given bounds
+    return lambda: int(min(max(rng.lognormvariate(math.log(args.file_size), sigma), args.min_file_size), args.max_file_size))
+
+def seed(app, s3, args, rng):
+    """
+    Inserts the users, blobs and audio files of the synthetic libraries in bulk and stores their objects
+    in the stand-in. Every user has the same password, hashed once.
+
+    Returns:
+        list: (username, user id, list of audio file ids) of each user.
+    """
+    from sqlalchemy import insert
+    from db import db
+    from models import User, AudioFile, Blob
+    from passwords import hash_password
+
+    sample_size = file_size_sampler(args, rng)
+    hashed_password = hash_password(PASSWORD)
+    users = []
+    with app.app_context():
+        for user_index in range(args.users):
+            user_id = str(uuid.uuid4())
+            username = f"bench{user_index}"
+            blobs, audio_files = [], []
+            for file_index in range(args.files_per_user):
+                size = sample_size()
+                digest = hashlib.sha256(f"{user_id}/{file_index}".encode()).hexdigest()
+                s3_key = f"blobs/{digest}"
+                s3.seed(s3_key, size)
+                blobs.append({"digest": digest, "s3_bucket": BUCKET, "s3_key": s3_key, "size": size, "ref_count": 1})
+                audio_files.append({
+                    "id": str(uuid.uuid4()),
+                    "file_name": f"track {file_index:05d} {rng.choice(['live', 'demo', 'mix', 'edit'])}.mp3",
+                    "s3_bucket": BUCKET,
+                    "s3_key": s3_key,
+                    "user_id": user_id,
+                    "liked": rng.random() < args.liked_fraction,
+                    "size": size,
+                    "checksum": digest,
+                    "blob_digest": digest,
+                })
+            db.session.execute(insert(User), [{
+                "id": user_id, "username": username, "role": "member", "password": hashed_password,
+                "file_count": len(audio_files), "storage_bytes": sum(audio_file["size"] for audio_file in audio_files),
+            }])
+            for start in range(0, len(audio_files), 1000):
+                db.session.execute(insert(Blob), blobs[start:start + 1000])
+                db.session.execute(insert(AudioFile), audio_files[start:start + 1000])
+            db.session.commit()
+            users.append((username, user_id, [audio_file["id"] for audio_file in audio_files]))
+    return users
+
+class HttpClient:
+    """Keeps one keep-alive connection to the app per thread."""
+    def __init__(self, port):
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request and reads the whole response, returning its status and length, or 0 on connection errors."""
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                length = len(response.read())
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+                    self._local.connection = None
+                return response.status, length
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                self._local.connection = None
+        return 0, 0
+
+def access_token(user_id, secret_key):
+    import jwt
+    return jwt.encode({'user_id': user_id, 'exp': int(time.time()) + 2 * 60 * 60}, secret_key, algorithm="HS256")
+
+def multipart_body(file_name, content):
+    """Encodes a file as multipart/form-data, returning the body and its Content-Type."""
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        "Content-Type: audio/mpeg\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def build_workloads(args, users, secret_key, rng):
+    """
+    Returns a function per workload performing its index'th request, spreading requests over the users.
+    Requests are prepared up front so that generating them is not timed.
+    """
+    tokens = [{"Authorization": f"Bearer {access_token(user_id, secret_key)}"} for _, user_id, _ in users]
+    sample_size = file_size_sampler(args, rng)
+    deletable = [(index, audio_file_id) for index, (_, _, ids) in enumerate(users) for audio_file_id in ids]
+    rng.shuffle(deletable)
+
+    def user(index):
+        return index % len(users)
+
+    def login(index):
+        body = json.dumps({"username": users[user(index)][0], "password": PASSWORD})
+        return 'POST', '/login', body, {"Content-Type": "application/json"}
+
+    def upload(index):
+        # A unique prefix so every upload is new content rather than deduplicated
+        size = sample_size()
+        content =(uuid.uuid4().bytes + PATTERN * (size // len(PATTERN) + 1))[:size]
+        body, content_type = multipart_body(f"upload {index}.mp3", content)
+        return 'POST', '/audiofiles', body, {**tokens[user(index)], "Content-Type": content_type}
+
+    def list_files(index):
+        return 'GET', f"/audiofiles?limit={args.page_size}", None, tokens[user(index)]
+
+    def favourites(index):
+        return 'GET', f"/audiofiles/favourites?limit={args.page_size}", None, tokens[user(index)]
+
+    def like(index):
+        ids = users[user(index)][2]
+        body = json.dumps({"liked": rng.random() < 0.5})
+        return 'PATCH', f"/audiofiles/{quote(rng.choice(ids))}/like", body, {**tokens[user(index)], "Content-Type": "application/json"}
+
+    def stream(index):
+        ids = users[user(index)][2]
+        return 'GET', f"/audiofiles/{quote(rng.choice(ids))}/stream", None, tokens[user(index)]
+
+    def delete(index):
+        user_index, audio_file_id = deletable[index]
+        return 'DELETE', f"/audiofiles/{quote(audio_file_id)}", None, tokens[user_index]
+
+    return {
+        'login': login, 'upload': upload, 'list': list_files, 'favourites': favourites,
+        'like': like, 'stream': stream, 'delete': delete,
+    }, len(deletable)
+
+def percentile(values, fraction):
+    """Returns the value at the given fraction of the sorted values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 4)
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of this process so far."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def run_workload(client, make_request, count, concurrency):
+    """Sends count requests from concurrency threads and summarises their latencies and statuses."""
+    requests = [make_request(index) for index in range(count)]
+
+    def timed(prepared):
+        method, path, body, headers = prepared
+        start = time.perf_counter()
+        status, length = client.request(method, path, body, headers)
+        return status, length, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, requests))
+    elapsed = time.perf_counter() - start
+
+    ok = [result for result in results if 200 <= result[0] < 400]
+    latencies = [result[2] for result in ok]
+    return {
+        "requests": count,
+        "ok": len(ok),
+        "errors": dict(Counter(str(result[0]) for result in results if not 200 <= result[0] < 400)),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(ok) / elapsed, 1) if elapsed else None,
+        "bytes_received": sum(result[1] for result in ok),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": round(max(latencies), 4) if latencies else None,
+        },
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', choices=['sqlite', 'postgres'], default='sqlite', help="Throwaway database to run against")
+    parser.add_argument('--database-url', help="Use this existing, empty database instead of a throwaway one")
+    parser.add_argument('--pg-bin', help="Directory of the initdb and pg_ctl binaries for --db postgres")
+    parser.add_argument('--users', type=int, default=10, help="Number of users seeded")
+    parser.add_argument('--files-per-user', type=int, default=100, help="Number of audio files seeded per user")
+    parser.add_argument('--size-distribution', choices=['lognormal', 'fixed'], default='lognormal')
+    parser.add_argument('--file-size', type=int, default=256 * 1024, help="Median (or fixed) file size in bytes")
+    parser.add_argument('--size-sigma', type=float, default=1.0, help="Spread of the log-normal file sizes")
+    parser.add_argument('--min-file-size', type=int, default=1024)
+    parser.add_argument('--max-file-size', type=int, default=16 * 1024 ** 2)
+    parser.add_argument('--liked-fraction', type=float, default=0.2, help="Fraction of seeded files that are liked")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help=f"Comma separated workloads to run in order, from {','.join(WORKLOADS)}")
+    parser.add_argument('--requests', type=int, default=200, help="Number of requests per workload")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of requests in flight at once")
+    parser.add_argument('--page-size', type=int, default=50, help="Page size of the list and favourites requests")
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds of latency added to each S3 request")
+    parser.add_argument('--bandwidth', type=float, default=100 * 1024 ** 2, help="S3 bandwidth per transfer in bytes per second, 0 for unlimited")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workloads = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(sorted(unknown))}")
+    rng = random.Random(args.seed)
+
+    directory = tempfile.mkdtemp(prefix='audiovault-bench-')
+    stop_postgres = None
+    s3 = StandInS3(args.latency, args.bandwidth)
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+    try:
+        if args.database_url:
+            database_url = args.database_url
+        elif args.db == 'postgres':
+            database_url, stop_postgres = start_postgres(directory, args.pg_bin)
+        else:
+            database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+
+        # Config is read when app.py is imported
+        os.environ['DATABASE_URL'] = database_url
+        os.environ['S3_ENDPOINT_URL'] = s3.url
+        os.environ['S3_BUCKET'] = BUCKET
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+        # Uploads are sent with a plain Content-Length rather than aws-chunked with trailing checksums
+        os.environ.setdefault('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+        os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+        os.environ.setdefault('TRANSCODE_ENABLED', 'false')
+
+        from flask_migrate import upgrade
+        from werkzeug.serving import make_server, WSGIRequestHandler
+        from app import app
+
+        with app.app_context():
+            upgrade(directory=os.path.join(BACKEND_DIR, 'migrations'))
+        start = time.perf_counter()
+        users = seed(app, s3, args, rng)
+        seed_seconds = time.perf_counter() - start
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = HttpClient(server.server_port)
+
+        make_requests, deletable = build_workloads(args, users, app.config['SECRET_KEY'], rng)
+        results = {}
+        for name in workloads:
+            count = min(args.requests, deletable) if name == 'delete' else args.requests
+            s3.requests.clear()
+            results[name] = run_workload(client, make_requests[name], count, args.concurrency)
+            results[name]["s3_requests"] = dict(s3.requests)
+        server.shutdown()
+
+        print(json.dumps({
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "database": database_url.split(':', 1)[0].split('+', 1)[0],
+            "users": args.users,
+            "files_per_user": args.files_per_user,
+            "file_size": {
+                "distribution": args.size_distribution,
+                "median": args.file_size,
+                "sigma": args.size_sigma,
+                "min": args.min_file_size,
+                "max": args.max_file_size,
+            },
+            "concurrency": args.concurrency,
+            "s3_latency_seconds": args.latency,
+            "s3_bandwidth": args.bandwidth,
+            "seed_seconds": round(seed_seconds, 3),
+            "workloads": results,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }, indent=2))
+    finally:
+        s3.shutdown()
+        if stop_postgres:
+            stop_postgres()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
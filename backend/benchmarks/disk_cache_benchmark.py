@@ -0,0 +1,147 @@
+"""
+Benchmark of the local disk cache (disk_cache.DiskCache) against an in-process S3 stand-in.
+
+Serves a skewed (Zipf) mix of reads for a set of objects from several threads, first straight from the
+stand-in and then through the disk cache, and reports latency percentiles, throughput, the number of S3
+requests made, and the cache's hit ratio and bytes saved as JSON. The stand-in adds a fixed latency per
+request and a bandwidth limit so the numbers resemble reading from S3 over the network, e.g.
+
+    python benchmarks/disk_cache_benchmark.py --objects 200 --object-size 4194304 --requests 2000 --latency 0.05
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from disk_cache import DiskCache
+
+class StandInBody:
+    """Mimics the streaming body returned by botocore's get_object."""
+    def __init__(self, data, bandwidth):
+        self.data = data
+        self.bandwidth = bandwidth
+
+    def iter_chunks(self, chunk_size):
+        for offset in range(0, len(self.data), chunk_size):
+            chunk = self.data[offset:offset + chunk_size]
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            yield chunk
+
+    def read(self):
+        return b''.join(self.iter_chunks(1024 * 1024))
+
+    def close(self):
+        pass
+
+class StandInS3:
+    """In-process S3 stand-in serving generated objects with artificial latency and bandwidth."""
+    def __init__(self, objects, latency, bandwidth):
+        self.objects = objects
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        data = self.objects[Key]
+        return {
+            "Body": StandInBody(data, self.bandwidth),
+            "ContentLength": len(data),
+            "ETag": f'"{Key}"',
+            "ContentType": "audio/mpeg",
+        }
+
+def percentile(values, fraction):
+    """Returns the value at the given fraction of the sorted values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 4)
+
+def run(read, keys, concurrency):
+    """Performs one read per key on a thread pool, returning the latency of each and the total elapsed time."""
+    def timed(key):
+        start = time.perf_counter()
+        read(key)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, keys))
+    return latencies, time.perf_counter() - start
+
+def summarize(latencies, elapsed, s3_requests):
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "s3_requests": s3_requests,
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=100, help="Number of distinct objects")
+    parser.add_argument('--object-size', type=int, default=1024 ** 2, help="Size of each object in bytes")
+    parser.add_argument('--requests', type=int, default=2000, help="Number of reads")
+    parser.add_argument('--concurrency', type=int, default=16, help="Number of reads in flight at once")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Skew of the key popularity, higher is more skewed")
+    parser.add_argument('--latency', type=float, default=0.03, help="Seconds of latency added to each S3 request")
+    parser.add_argument('--bandwidth', type=float, default=100 * 1024 ** 2, help="S3 bandwidth per request in bytes per second, 0 for unlimited")
+    parser.add_argument('--cache-size', type=int, default=None, help="Cache size in bytes, defaults to a quarter of the data set")
+    parser.add_argument('--policy', choices=['lru', 'lfu'], default='lru')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    objects = {f"object-{index}": os.urandom(args.object_size) for index in range(args.objects)}
+    names = list(objects)
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(len(names))]
+    keys = rng.choices(names, weights=weights, k=args.requests)
+    cache_size = args.cache_size or args.objects * args.object_size // 4
+
+    direct_s3 = StandInS3(objects, args.latency, args.bandwidth)
+    latencies, elapsed = run(lambda key: direct_s3.get_object(Bucket='bench', Key=key)["Body"].read(), keys, args.concurrency)
+    direct = summarize(latencies, elapsed, direct_s3.requests)
+
+    cached_s3 = StandInS3(objects, args.latency, args.bandwidth)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, cache_size, cache_size, args.policy, client=cached_s3)
+
+        def read_cached(key):
+            cached = cache.get('bench', key, size=len(objects[key]))
+            with cached.file as cached_file:
+                size = len(cached_file.read())
+            cache.record_bytes_served(size)
+
+        latencies, elapsed = run(read_cached, keys, args.concurrency)
+        cached = summarize(latencies, elapsed, cached_s3.requests)
+        cached["cache"] = cache.stats()
+
+    print(json.dumps({
+        "objects": args.objects,
+        "object_size": args.object_size,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "latency_seconds": args.latency,
+        "cache_size": cache_size,
+        "policy": args.policy,
+        "direct": direct,
+        "disk_cache": cached,
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
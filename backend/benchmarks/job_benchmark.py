@@ -0,0 +1,160 @@
+"""
+Throughput benchmark of the job queue in jobs.py, against a throwaway database.
+
+The database is a SQLite file, an ephemeral Postgres cluster started as in app_benchmark.py, or an existing
+empty database given with --database-url, with the schema created by the migrations. For each worker count,
+--jobs jobs are enqueued one transaction each, as the upload routes do, then drained by that many workers
+claiming with the same claim_jobs and run_job as `flask jobs work`. Workers are threads of this process, or
+forked processes with --processes. Each job sleeps for --job-ms to stand in for its handler. The report
+gives the enqueue rate, the jobs run per second and the jobs run more than once per worker count, as JSON, e.g.
+
+    python benchmarks/job_benchmark.py --db postgres --workers 1,2,4,8,16 --jobs 5000
+    python benchmarks/job_benchmark.py --db postgres --processes --claim-batch 10 --job-ms 0
+
+SQLite serializes writers, so its numbers show the cost of a claim rather than how the queue scales.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from app_benchmark import start_postgres, git_commit, peak_rss_bytes
+
+def work(app, worker_id, claim_batch, errors):
+    """Claims and runs jobs until none are left."""
+    from db import db
+    from jobs import claim_jobs, run_job
+
+    with app.app_context():
+        while True:
+            try:
+                jobs = claim_jobs(worker_id, claim_batch)
+            except Exception:
+                # SQLite gives up on busy writers, the claim is simply retried
+                db.session.rollback()
+                errors.append(worker_id)
+                continue
+            if not jobs:
+                break
+            for job in jobs:
+                run_job(job, worker_id)
+        db.session.remove()
+
+def process_work(app, worker_id, claim_batch):
+    from db import db
+    with app.app_context():
+        # Connections inherited from the parent must not be shared
+        db.engine.dispose(close=False)
+    errors = []
+    work(app, worker_id, claim_batch, errors)
+    sys.exit(1 if errors else 0)
+
+def run(app, workers, args):
+    """Enqueues the jobs, then drains them with the given number of workers and reports the rates."""
+    from db import db
+    from models import Job
+    from jobs import enqueue_job
+
+    with app.app_context():
+        Job.query.delete()
+        db.session.commit()
+        start = time.perf_counter()
+        for i in range(args.jobs):
+            enqueue_job('benchmark', {"index": i}, priority=i % 3)
+            db.session.commit()
+        enqueue_seconds = time.perf_counter() - start
+
+    errors = []
+    start = time.perf_counter()
+    if args.processes:
+        context = multiprocessing.get_context('fork')
+        runners = [context.Process(target=process_work, args=(app, f"bench-{i}", args.claim_batch)) for i in range(workers)]
+    else:
+        runners = [threading.Thread(target=work, args=(app, f"bench-{i}", args.claim_batch, errors)) for i in range(workers)]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    seconds = time.perf_counter() - start
+    if args.processes:
+        errors = [runner for runner in runners if runner.exitcode]
+
+    with app.app_context():
+        done = Job.query.filter_by(status='done').count()
+        repeated = Job.query.filter(Job.attempts > 1).count()
+    return {
+        "workers": workers,
+        "enqueue_per_second": round(args.jobs / enqueue_seconds, 1),
+        "seconds": round(seconds, 3),
+        "jobs_done": done,
+        "jobs_per_second": round(done / seconds, 1),
+        "jobs_run_more_than_once": repeated,
+        "claim_errors": len(errors),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', choices=['sqlite', 'postgres'], default='sqlite', help="Throwaway database to run against")
+    parser.add_argument('--database-url', help="Use this existing, empty database instead of a throwaway one")
+    parser.add_argument('--pg-bin', help="Directory of the initdb and pg_ctl binaries for --db postgres")
+    parser.add_argument('--jobs', type=int, default=2000, help="Number of jobs run per worker count")
+    parser.add_argument('--workers', default='1,2,4,8', help="Comma separated worker counts to measure")
+    parser.add_argument('--processes', action='store_true', help="Run each worker in a forked process rather than a thread")
+    parser.add_argument('--claim-batch', type=int, default=1, help="Jobs claimed at once by each worker")
+    parser.add_argument('--job-ms', type=float, default=1.0, help="Milliseconds each job takes")
+    args = parser.parse_args()
+    worker_counts = [int(count) for count in args.workers.split(',') if count.strip()]
+
+    directory = tempfile.mkdtemp(prefix='audiovault-jobs-bench-')
+    stop_postgres = None
+    try:
+        if args.database_url:
+            database_url = args.database_url
+        elif args.db == 'postgres':
+            database_url, stop_postgres = start_postgres(directory, args.pg_bin)
+        else:
+            database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+
+        # Config is read when app.py is imported, the benchmark's workers are the only ones running jobs
+        os.environ['DATABASE_URL'] = database_url
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ['JOB_WORKER_THREADS'] = '0'
+
+        from flask_migrate import upgrade
+        from app import app
+        from jobs import job_handler
+
+        @job_handler('benchmark')
+        def benchmark_job(index):
+            time.sleep(args.job_ms / 1000)
+
+        with app.app_context():
+            upgrade(directory=os.path.join(BACKEND_DIR, 'migrations'))
+        results = [run(app, workers, args) for workers in worker_counts]
+
+        print(json.dumps({
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "database": database_url.split(':', 1)[0].split('+', 1)[0],
+            "jobs": args.jobs,
+            "mode": "processes" if args.processes else "threads",
+            "claim_batch": args.claim_batch,
+            "job_ms": args.job_ms,
+            "results": results,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }, indent=2))
+    finally:
+        if stop_postgres:
+            stop_postgres()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
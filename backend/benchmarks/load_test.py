@@ -0,0 +1,85 @@
+"""
+Concurrent-connection load test for the audio endpoints.
+
+Opens the given number of connections at once against a running backend, each requesting the same
+path, and reports how many completed within the timeout along with latency percentiles as JSON.
+Run it against both serving paths with the same S3 and database to compare their capacity, e.g.
+
+    gunicorn -w 4 -b 0.0.0.0:5000 app:app
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+    python benchmarks/load_test.py --url http://localhost:5000 --path /audiofiles/<id>/stream --token <token> --connections 1000
+    python benchmarks/load_test.py --url http://localhost:5001 --path /audiofiles/<id>/stream --token <token> --connections 1000
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+async def fetch(host, port, path, token, timeout):
+    """Sends one GET request over a new connection and reads the full response, returning (status, bytes, seconds)."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write((
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            f"Authorization: Bearer {token}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(-1), timeout)
+    finally:
+        writer.close()
+    status = int(response.split(b" ", 2)[1]) if response else 0
+    return status, len(response), time.perf_counter() - start
+
+def percentile(values, fraction):
+    """Returns the value at the given fraction of the sorted values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 4)
+
+async def run(url, path, token, connections, timeout):
+    parts = urlsplit(url)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(fetch(parts.hostname, parts.port or 80, path, token, timeout) for _ in range(connections)),
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+
+    completed = [result for result in results if not isinstance(result, BaseException) and 200 <= result[0] < 400]
+    latencies = [result[2] for result in completed]
+    return {
+        "url": url,
+        "path": path,
+        "connections": connections,
+        "completed": len(completed),
+        "failed": connections - len(completed),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(completed) / elapsed, 1) if elapsed else None,
+        "bytes_received": sum(result[1] for result in completed),
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True, help="Base URL of the running backend")
+    parser.add_argument('--path', default='/audiofiles', help="Path to request on every connection")
+    parser.add_argument('--token', required=True, help="Access token to authenticate with")
+    parser.add_argument('--connections', type=int, default=500, help="Number of concurrent connections")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds before a connection counts as failed")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.url, args.path, args.token, args.connections, args.timeout))
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Cold start benchmark of the backend: how long a fresh process takes to import app.py and to answer its
+first request, as an autoscaled replica or a newly forked worker would.
+
+A throwaway SQLite database is migrated and bootstrapped once (or pass an existing one with --database-url).
+Then each run starts a new Python process which times the import of app.py, its first authenticated request
+to --path through the Flask test client, which opens the first database connection and builds any client
+the route needs, and a second request for comparison. The parent also times the whole process, interpreter
+start included. The report gives the median and p95 of each over --runs runs as JSON, e.g.
+
+    python benchmarks/startup_benchmark.py --runs 20
+    python benchmarks/startup_benchmark.py --path '/audiofiles?limit=50' --presigned-urls
+
+Requests to S3 are not made by the default path, so no S3 endpoint is needed.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from app_benchmark import git_commit, percentile
+
+# Run in each fresh process, prints its timings as JSON on the last line
+CHILD = r'''
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, os.environ['BACKEND_DIR'])
+from app import app
+imported = time.perf_counter()
+from s3_client import s3_client
+s3_client_at_import = s3_client._client is not None
+
+import datetime, jwt
+token = jwt.encode({'user_id': os.environ['BENCH_USER_ID'], 'exp': datetime.datetime.now() + datetime.timedelta(minutes=5)},
+                   app.config['SECRET_KEY'], algorithm='HS256')
+client = app.test_client()
+headers = {'Authorization': f'Bearer {token}'}
+first_started = time.perf_counter()
+first = client.get(os.environ['BENCH_PATH'], headers=headers)
+first_finished = time.perf_counter()
+second = client.get(os.environ['BENCH_PATH'], headers=headers)
+second_finished = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - started,
+    "first_request_seconds": first_finished - first_started,
+    "second_request_seconds": second_finished - first_finished,
+    "status": first.status_code,
+    "s3_client_at_import": s3_client_at_import,
+}))
+'''
+
+def bootstrap(env):
+    """Migrates the database and creates the master user, returning the master's id."""
+    subprocess.run([sys.executable, '-m', 'flask', 'bootstrap'], cwd=BACKEND_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    script = "from app import app\nfrom models import User\nwith app.app_context(): print(User.query.filter_by(username='master').one().id)"
+    return subprocess.run([sys.executable, '-c', script], cwd=BACKEND_DIR, env=env, check=True, capture_output=True, text=True).stdout.split()[-1]
+
+def summarize(values):
+    return {"median": round(percentile(values, 0.5), 4), "p95": round(percentile(values, 0.95), 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help="Use this existing, bootstrapped database instead of a throwaway one")
+    parser.add_argument('--runs', type=int, default=10, help="Number of fresh processes started")
+    parser.add_argument('--path', default='/audiofiles', help="Path of the authenticated GET request timed")
+    parser.add_argument('--presigned-urls', action='store_true', help="Enable presigned URLs, so listings build the S3 client")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='audiovault-startup-bench-')
+    try:
+        database_url = args.database_url or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        env = dict(os.environ, DATABASE_URL=database_url, BACKEND_DIR=BACKEND_DIR, BENCH_PATH=args.path, FLASK_APP='app.py')
+        env.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        env.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+        env.setdefault('RATE_LIMIT_ENABLED', 'false')
+        env['S3_PRESIGNED_URLS'] = 'true' if args.presigned_urls else env.get('S3_PRESIGNED_URLS', 'false')
+        env['BENCH_USER_ID'] = bootstrap(env)
+
+        runs = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-c', CHILD], cwd=directory, env=env, capture_output=True, text=True)
+            if process.returncode != 0:
+                raise SystemExit(process.stderr)
+            run = json.loads(process.stdout.strip().splitlines()[-1])
+            run["process_seconds"] = time.perf_counter() - start
+            runs.append(run)
+
+        print(json.dumps({
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "database": database_url.split(':', 1)[0].split('+', 1)[0],
+            "path": args.path,
+            "runs": args.runs,
+            "statuses": sorted({run["status"] for run in runs}),
+            "s3_client_at_import": any(run["s3_client_at_import"] for run in runs),
+            "import_seconds": summarize([run["import_seconds"] for run in runs]),
+            "first_request_seconds": summarize([run["first_request_seconds"] for run in runs]),
+            "second_request_seconds": summarize([run["second_request_seconds"] for run in runs]),
+            "process_seconds": summarize([run["process_seconds"] for run in runs]),
+        }, indent=2))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
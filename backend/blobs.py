@@ -0,0 +1,169 @@
+import hashlib
+from collections import Counter
+from sqlalchemy.exc import IntegrityError
+from db import db
+from models import Blob
+from outbox import cancel_s3_deletions, enqueue_s3_deletions
+
+# Size of each read while hashing an upload
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class ContentNotStored(Exception):
+    """Raised when content expected to be held by a blob is not, because the blob was released in the meantime."""
+
+def blob_s3_key(digest):
+    """Returns the key content with the given digest is stored under when uploaded through the backend."""
+    return f"blobs/{digest}"
+
+def hash_fileobj(fileobj):
+    """
+    Hashes a seekable file in chunks and rewinds it, so it can then be uploaded if its content is new.
+
+    Returns:
+        tuple: (hex SHA-256 digest, size in bytes)
+    """
+    checksum = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = fileobj.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        checksum.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return checksum.hexdigest(), size
+
+def blob_stored(digest):
+    """Returns whether a blob holds the content with the given digest, in which case it need not be uploaded."""
+    return db.session.query(Blob.digest).filter(Blob.digest == digest, Blob.ref_count > 0).first() is not None
+
+def prepare_blob_upload(s3_bucket, digest):
+    """
+    Drops the deletions still queued for content from when it was last deleted, so they cannot remove it once
+    it is uploaded again, see outbox.cancel_s3_deletions. Commits, so the content can then be uploaded outside
+    of any transaction.
+
+    Returns:
+        str: The key to upload the content to.
+    """
+    s3_key = blob_s3_key(digest)
+    cancel_s3_deletions(s3_bucket, s3_key)
+    db.session.commit()
+    return s3_key
+
+def add_blob_reference(digest, s3_bucket, size, s3_key=None):
+    """
+    Counts a new reference to the content with the given digest. If no blob holds it yet, a blob is created
+    for the content uploaded beforehand under s3_key. No S3 request is made, so the transaction only holds
+    its locks for its own statements. Does not commit, see commit_with_blob_reference.
+
+    Args:
+        digest (str): Hex SHA-256 of the content.
+        s3_bucket (str): S3 bucket the content is stored in.
+        size (int): Size of the content in bytes.
+        s3_key (str): Key the content was uploaded to, None if it was held by a blob and not uploaded.
+
+    Returns:
+        Blob: The blob referenced.
+
+    Raises:
+        ContentNotStored: If no blob holds the content and it was not uploaded.
+    """
+    # A single UPDATE so concurrent uploads of the same content cannot lose an increment
+    if Blob.query.filter_by(digest=digest).update({Blob.ref_count: Blob.ref_count + 1}):
+        return db.session.get(Blob, digest)
+    if s3_key is None:
+        raise ContentNotStored(digest)
+    cancel_s3_deletions(s3_bucket, s3_key)
+    blob = Blob(digest=digest, s3_bucket=s3_bucket, s3_key=s3_key, size=size, ref_count=1)
+    db.session.add(blob)
+    return blob
+
+def discard_stored_blob(digest, s3_bucket):
+    """
+    Queues the deletion of content that was stored for a transaction that then failed, unless another upload
+    of the same content has since committed a blob holding it. Commits.
+
+    Returns:
+        bool: Whether a deletion was queued.
+    """
+    if db.session.get(Blob, digest) is not None:
+        return False
+    enqueue_s3_deletions(s3_bucket, [blob_s3_key(digest)])
+    db.session.commit()
+    return True
+
+def commit_with_blob_reference(reference, store=None):
+    """
+    Calls reference, which adds a blob reference and the rows pointing to it to the session, then commits.
+    If another upload of the same content created the blob in the meantime, the transaction is retried
+    once and references the existing blob instead. If the blob that was to be referenced was released in
+    the meantime, the transaction is rolled back, store is called to upload the content outside of it, and
+    it is retried.
+
+    Returns:
+        The return value of reference.
+    """
+    def commit():
+        try:
+            result = reference()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            result = reference()
+            db.session.commit()
+        return result
+
+    try:
+        return commit()
+    except ContentNotStored:
+        db.session.rollback()
+        if store is None:
+            raise
+        store()
+        return commit()
+
+def plan_blob_release(audio_files, derived_keys):
+    """
+    Works out which S3 objects go away when the given audio files are deleted. The blobs involved are
+    locked in one query, so concurrent uploads of the same content wait until the deletion is committed and
+    then cancel it. Nothing is changed until release_blobs is called for the files actually deleted.
+
+    Args:
+        audio_files (list): The audio files being deleted.
+        derived_keys (dict): Keys of the objects produced from each file's content at ingest (renditions and peaks), by id.
+
+    Returns:
+        dict: The keys to delete from S3 for each audio file id, empty for files whose content is still
+        referenced by audio files that are not being deleted.
+    """
+    digests = sorted({audio_file.blob_digest for audio_file in audio_files if audio_file.blob_digest})
+    blobs = {}
+    if digests:
+        # Locked in a consistent order so overlapping batches cannot deadlock
+        blobs = {blob.digest: blob for blob in Blob.query.filter(Blob.digest.in_(digests)).order_by(Blob.digest).with_for_update()}
+    remaining = {digest: blob.ref_count for digest, blob in blobs.items()}
+
+    keys = {}
+    for audio_file in audio_files:
+        blob = blobs.get(audio_file.blob_digest)
+        if blob is None:
+            keys[audio_file.id] = [audio_file.s3_key] + derived_keys[audio_file.id]
+            continue
+        # Content shared with other audio files is only deleted along with its last reference
+        remaining[blob.digest] -= 1
+        keys[audio_file.id] = [blob.s3_key] + derived_keys[audio_file.id] if remaining[blob.digest] <= 0 else []
+    return keys
+
+def release_blobs(audio_files):
+    """
+    Removes the references of deleted audio files from their blobs, deleting blobs that are no longer
+    referenced. Must follow plan_blob_release in the same transaction, which holds the blobs' locks. Does not commit.
+    """
+    released = Counter(audio_file.blob_digest for audio_file in audio_files if audio_file.blob_digest)
+    if not released:
+        return
+    for blob in Blob.query.filter(Blob.digest.in_(released)):
+        blob.ref_count -= released[blob.digest]
+        if blob.ref_count <= 0:
+            db.session.delete(blob)
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Bounded, thread-safe in-process cache whose entries expire after a time to live.
+    Once max_size entries are stored the least recently used entry is evicted.
+
+    Attributes:
+        hits (int): Number of lookups that found a live entry.
+        misses (int): Number of lookups that found no entry or an expired one.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the live value stored for key, or default if there is none."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Stores value for key, expiring after ttl seconds or the cache's default time to live."""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Removes the entry stored for key, if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache's size and hit/miss counters."""
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,48 @@
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from db import db
+from models import CollectionVersion
+
+# The list of users served by GET /users, written to when users are created, changed or deleted
+USERS_COLLECTION = 'users'
+
+def audiofiles_collection(user_id):
+    """Returns the name of the collection of a user's audio files, which backs all of their audio file listings."""
+    return f"audiofiles:{user_id}"
+
+def bump_versions_statement(names, dialect_name):
+    """
+    Builds the upsert incrementing the versions of the given collections, see bump_versions.
+
+    Args:
+        names (iterable): The collections written to.
+        dialect_name (str): Name of the database dialect, 'postgresql' or 'sqlite'.
+    """
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    # Sorted so that transactions bumping several collections lock their rows in the same order
+    statement = insert(CollectionVersion).values([{"name": name, "version": 1} for name in sorted(set(names))])
+    return statement.on_conflict_do_update(
+        index_elements=[CollectionVersion.name],
+        set_={"version": CollectionVersion.version + 1}
+    )
+
+def bump_versions(*names):
+    """
+    Increments the versions of the given collections, so that responses cached for them are no longer
+    served and clients polling them get the new data. Must be in the transaction that writes to them,
+    whose commit then publishes the data and the version together. Does not commit.
+    """
+    if names:
+        db.session.execute(bump_versions_statement(names, db.session.get_bind().dialect.name))
+
+def forget_versions(*names):
+    """Deletes the versions of collections that no longer exist, e.g. those of a deleted user. Does not commit."""
+    CollectionVersion.query.filter(CollectionVersion.name.in_(names)).delete(synchronize_session=False)
+
+def collection_version_statement(name):
+    """Builds the query reading the version of a collection, see collection_version."""
+    return select(CollectionVersion.version).where(CollectionVersion.name == name)
+
+def collection_version(name):
+    """Returns the current version of a collection, 0 if it has never been written to."""
+    return db.session.scalar(collection_version_statement(name)) or 0
@@ -1,6 +1,145 @@
 import os
 
 class Config:
-    SQLALCHEMY_DATABASE_URI = 'postgresql://user:password@db:5432/audiovault'
+    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'postgresql://user:password@db:5432/audiovault')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'default-secret-key')
+
+    # Database connection pool, per worker process
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    DB_POOL_RECYCLE_SECONDS = int(os.getenv('DB_POOL_RECYCLE_SECONDS', '1800'))
+    # Postgres aborts any statement running longer than this, 0 disables the timeout
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    if SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_pre_ping': DB_POOL_PRE_PING,
+            'pool_recycle': DB_POOL_RECYCLE_SECONDS,
+            'connect_args': {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'},
+        }
+
+    # Database URI used by the async serving path in asgi.py
+    ASYNC_SQLALCHEMY_DATABASE_URI = os.getenv('ASYNC_DATABASE_URL', 'postgresql+asyncpg://user:password@db:5432/audiovault')
+
+    # Bucket that audio files are stored in, and an optional endpoint for S3 compatible stores such as MinIO
+    S3_BUCKET = os.getenv('S3_BUCKET', 'audiovault-s3')
+    S3_REGION = os.getenv('S3_REGION', 'ap-southeast-1')
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+
+    # S3 connection pool shared by all threads, should be at least S3_FETCH_CONCURRENCY
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32'))
+    # Number of objects fetched from S3 in parallel by bulk content retrieval
+    S3_FETCH_CONCURRENCY = int(os.getenv('S3_FETCH_CONCURRENCY', '16'))
+
+    # Maximum total size of a chunked upload, and how long an unfinished upload is kept before it is aborted
+    UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', str(2 * 1024 ** 3)))
+    UPLOAD_EXPIRY_SECONDS = int(os.getenv('UPLOAD_EXPIRY_SECONDS', str(24 * 60 * 60)))
+
+    # When enabled, clients upload and play audio directly from S3 through short-lived presigned URLs
+    S3_PRESIGNED_URLS = os.getenv('S3_PRESIGNED_URLS', 'false').lower() == 'true'
+    PRESIGNED_URL_EXPIRY_SECONDS = int(os.getenv('PRESIGNED_URL_EXPIRY_SECONDS', '900'))
+    # Issued GET URLs are reused until this many seconds before they expire
+    PRESIGNED_URL_REFRESH_MARGIN_SECONDS = int(os.getenv('PRESIGNED_URL_REFRESH_MARGIN_SECONDS', '60'))
+    PRESIGNED_URL_CACHE_SIZE = int(os.getenv('PRESIGNED_URL_CACHE_SIZE', '10000'))
+
+    # In-process cache of verified tokens and authenticated users used by token_required
+    AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+    AUTH_CACHE_TTL_SECONDS = int(os.getenv('AUTH_CACHE_TTL_SECONDS', '60'))
+
+    # bcrypt cost factor, stored hashes with a different cost are rehashed on the next login
+    BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+    # Processes that run bcrypt, and how many more hashes may wait for one before requests get a 503
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', '32'))
+    # Rows of a bulk user import checked, hashed and inserted together, each batch in its own transaction
+    USER_IMPORT_BATCH_SIZE = int(os.getenv('USER_IMPORT_BATCH_SIZE', '500'))
+
+    # Compressed renditions produced in the background after each upload, bitrates in kbit/s
+    TRANSCODE_ENABLED = os.getenv('TRANSCODE_ENABLED', 'true').lower() == 'true'
+    RENDITION_BITRATES = [int(bitrate) for bitrate in os.getenv('RENDITION_BITRATES', '64,128,192').split(',')]
+    # ffmpeg executable, defaults to the binary bundled with imageio-ffmpeg
+    FFMPEG_BINARY = os.getenv('FFMPEG_BINARY')
+    # Waveform peaks computed at ingest, one zoom level per number of samples per peak. Each level should be
+    # a multiple of the finest one, as coarser levels are derived from it
+    WAVEFORM_ZOOM_LEVELS = [int(level) for level in os.getenv('WAVEFORM_ZOOM_LEVELS', '256,1024,4096').split(',')]
+
+    # Local disk read-through cache of hot audio in front of S3, disabled unless a directory is set.
+    # The directory can be shared by every worker process on the host. Policy is 'lru' or 'lfu'
+    DISK_CACHE_DIR = os.getenv('DISK_CACHE_DIR')
+    DISK_CACHE_MAX_BYTES = int(os.getenv('DISK_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))
+    DISK_CACHE_MAX_OBJECT_BYTES = int(os.getenv('DISK_CACHE_MAX_OBJECT_BYTES', str(256 * 1024 ** 2)))
+    DISK_CACHE_POLICY = os.getenv('DISK_CACHE_POLICY', 'lru')
+
+    # Background deletion of S3 objects queued in the outbox, retried with exponential backoff on failure
+    S3_DELETION_BATCH_SIZE = int(os.getenv('S3_DELETION_BATCH_SIZE', '1000'))
+    S3_DELETION_POLL_SECONDS = int(os.getenv('S3_DELETION_POLL_SECONDS', '30'))
+    S3_DELETION_RETRY_BASE_SECONDS = int(os.getenv('S3_DELETION_RETRY_BASE_SECONDS', '5'))
+    S3_DELETION_RETRY_MAX_SECONDS = int(os.getenv('S3_DELETION_RETRY_MAX_SECONDS', '3600'))
+    # Objects younger than this are never treated as orphans by the reconciler, as direct uploads reach S3
+    # before their audio file is stored
+    RECONCILE_MIN_AGE_SECONDS = int(os.getenv('RECONCILE_MIN_AGE_SECONDS', str(24 * 60 * 60)))
+
+    # Durable background jobs such as the analysis and transcoding of new uploads, see jobs.py. They run in
+    # `flask jobs work` processes, web processes only queue them unless JOB_WORKER_THREADS is set, e.g. to
+    # run everything in a single process during development
+    JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', '0'))
+    JOB_POLL_SECONDS = int(os.getenv('JOB_POLL_SECONDS', '5'))
+    JOB_CLAIM_BATCH_SIZE = int(os.getenv('JOB_CLAIM_BATCH_SIZE', '1'))
+    # A job still running past its lease is claimed again, workers extend the leases of the jobs they run
+    JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '60'))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+    JOB_RETRY_BASE_SECONDS = int(os.getenv('JOB_RETRY_BASE_SECONDS', '10'))
+    JOB_RETRY_MAX_SECONDS = int(os.getenv('JOB_RETRY_MAX_SECONDS', '3600'))
+    # Done jobs are kept this long, so their idempotency keys keep deduplicating
+    JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', str(7 * 24 * 60 * 60)))
+
+    # Token bucket rate limits per user and per client IP, see rate_limit.py for the RATE_LIMITS format.
+    # The 'memory' backend keeps buckets per process, 'redis' shares them through a Redis compatible server
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMITS = os.getenv(
+        'RATE_LIMITS',
+        'default=user:20/s:100,ip:50/s:200;'
+        'utils.login=ip:10/m:10;'
+        'audiofiles.create_audiofile=user:1/s:20;'
+        'audiofiles.export_audiofiles=user:2/m:2'
+    )
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+    # Requests are let through if the shared backend does not answer within this time
+    RATE_LIMIT_REDIS_TIMEOUT_MS = int(os.getenv('RATE_LIMIT_REDIS_TIMEOUT_MS', '100'))
+    # Buckets kept by the memory backend, the least recently used are dropped beyond this
+    RATE_LIMIT_MEMORY_MAX_KEYS = int(os.getenv('RATE_LIMIT_MEMORY_MAX_KEYS', '100000'))
+    # Reverse proxies in front of the app that append to X-Forwarded-For, whose entries are then trusted for the
+    # client IP. With 0 the IP of the connection is used, which behind a proxy is the proxy's
+    RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+
+    # Per-user quotas on the number and total size of audio files, 0 for unlimited
+    USER_FILE_QUOTA = int(os.getenv('USER_FILE_QUOTA', '0'))
+    USER_STORAGE_QUOTA_BYTES = int(os.getenv('USER_STORAGE_QUOTA_BYTES', '0'))
+
+    # Per-request timings of auth, SQL and S3 in a Server-Timing header, and Prometheus metrics at /metrics
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'true').lower() == 'true'
+    SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'true').lower() == 'true'
+    # Bearer token required to read /metrics, empty to only serve it to clients connecting from the host itself
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+    # Sampling profiler keeping the stacks of the slowest requests in PROFILE_DIR for flame graphs, 0 disables it
+    PROFILE_SLOWEST_REQUESTS = int(os.getenv('PROFILE_SLOWEST_REQUESTS', '0'))
+    PROFILE_SAMPLE_INTERVAL_MS = int(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+    PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/audiovault-profiles')
+
+    # Serialized listing responses cached by collection version, larger bodies are rebuilt on every request
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+    RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '300'))
+    RESPONSE_CACHE_MAX_BODY_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BODY_BYTES', str(1024 ** 2)))
+    # The user list is versioned by changes to users only, the usage and liked counts it shows may lag this long
+    USERS_LISTING_MAX_AGE_SECONDS = int(os.getenv('USERS_LISTING_MAX_AGE_SECONDS', '60'))
+    # Listing responses of at least this size are compressed with zstd, brotli or gzip as the client accepts
+    COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+    GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+    BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+    ZSTD_LEVEL = int(os.getenv('ZSTD_LEVEL', '3'))
@@ -0,0 +1,278 @@
+import fcntl
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from config import Config
+from s3_client import s3_client
+
+CachedObject = namedtuple('CachedObject', ['file', 'size', 'etag', 'content_type'])
+
+# Size of each chunk copied from the S3 body into the cache file
+FILL_CHUNK_SIZE = 1024 * 1024
+
+# Eviction frees space down to this fraction of the maximum size, so it does not run on every fill
+EVICTION_LOW_WATERMARK = 0.9
+
+class DiskCache:
+    """
+    Size-bounded read-through cache of S3 objects on local disk, keyed by (bucket, key).
+
+    Objects are written to a temporary file and renamed into place, so readers never see partial files,
+    and an index in SQLite records their size and accesses for LRU or LFU eviction. The directory can be
+    shared by several worker processes: concurrent misses for the same key are collapsed into one S3 fetch
+    by a per-key lock within a process and a per-key lock file across processes.
+
+    Attributes:
+        directory (str): Directory the cached objects and index are stored in.
+        max_bytes (int): Total size the cache is kept under.
+        max_object_bytes (int): Objects larger than this are never cached.
+        policy (str): 'lru' to evict the least recently used objects first, 'lfu' the least frequently used.
+    """
+    def __init__(self, directory, max_bytes, max_object_bytes, policy='lru', client=None):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("Cache policy must be 'lru' or 'lfu'")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self.policy = policy
+        self.client = client or s3_client
+        self._local = threading.local()
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "uncacheable": 0, "bytes_served": 0, "bytes_fetched": 0, "evictions": 0}
+
+    def _db(self):
+        """
+        Returns this thread's connection to the index, reconnecting in a forked worker. The directory and
+        the index are created on the first connection rather than when the cache is built at import.
+        """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.join(self.directory, 'locks'), exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.directory, 'index.db'), timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, etag TEXT, content_type TEXT, "
+                "last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _count(self, **increments):
+        with self._stats_lock:
+            for name, value in increments.items():
+                self._stats[name] += value
+
+    def _path(self, bucket, key):
+        digest = hashlib.sha256(f"{bucket}/{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _lookup(self, path):
+        """Opens the cached object stored at path and records the access, or returns None if it is not cached."""
+        db = self._db()
+        row = db.execute("SELECT size, etag, content_type FROM entries WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        try:
+            # Opened here so the file stays readable even if it is evicted before it has been served
+            cached_file = open(path, 'rb')
+        except FileNotFoundError:
+            db.execute("DELETE FROM entries WHERE path = ?", (path,))
+            return None
+        db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE path = ?", (time.time(), path))
+        return CachedObject(cached_file, *row)
+
+    def _key_lock(self, path):
+        with self._key_locks_lock:
+            entry = self._key_locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        return entry
+
+    def _release_key_lock(self, path, entry):
+        with self._key_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[path]
+
+    def _lock_path(self, path):
+        return os.path.join(self.directory, 'locks', os.path.basename(path))
+
+    def _lock_file(self, path):
+        """
+        Takes the lock file of an object across processes and returns it open, the lock being released when it
+        is closed. Lock files are removed while held once their object is no longer cached, so a waiter that
+        finds the file it locked was removed or replaced takes the current one instead.
+        """
+        lock_path = self._lock_path(path)
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    def _remove_lock_file(self, path):
+        """Removes the lock file of an object that was evicted, unless a process holds it to fetch the object again."""
+        lock_path = self._lock_path(path)
+        try:
+            lock_file = open(lock_path, 'rb')
+        except FileNotFoundError:
+            return
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, bucket, key, size=None):
+        """
+        Returns the object from the cache, fetching it from S3 into the cache on a miss.
+
+        Args:
+            bucket (str): S3 bucket of the object.
+            key (str): Key of the object.
+            size (int): Size of the object if known, so objects too large to cache are skipped without a request.
+
+        Returns:
+            CachedObject: The open cached file, which the caller must close, with its size, ETag and content type.
+            None if the object is too large to cache and should be read from S3 directly.
+        """
+        if size is not None and size > self.max_object_bytes:
+            self._count(uncacheable=1)
+            return None
+        path = self._path(bucket, key)
+        cached = self._lookup(path)
+        if cached:
+            self._count(hits=1)
+            return cached
+
+        # Single flight: the first request for the key fetches it, the others wait and then read the file.
+        # The lock file is per key, so fetches of other objects never wait on it
+        key_lock = self._key_lock(path)
+        try:
+            with key_lock[0], self._lock_file(path):
+                cached = self._lookup(path)
+                if cached:
+                    self._count(hits=1)
+                    return cached
+                self._count(misses=1)
+                try:
+                    cached = self._fill(bucket, key, path, size)
+                finally:
+                    if cached is None:
+                        # Nothing was cached, so the lock file is not kept around for eviction to remove
+                        os.unlink(self._lock_path(path))
+                return cached
+        finally:
+            self._release_key_lock(path, key_lock)
+
+    def _fill(self, bucket, key, path, size):
+        if size is None:
+            # Checked before the body is requested, so an object too large to cache is only fetched by the caller
+            if self.client.head_object(Bucket=bucket, Key=key)["ContentLength"] > self.max_object_bytes:
+                self._count(uncacheable=1)
+                return None
+        s3_object = self.client.get_object(Bucket=bucket, Key=key)
+        body = s3_object["Body"]
+        if s3_object["ContentLength"] > self.max_object_bytes:
+            body.close()
+            self._count(uncacheable=1)
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.fill-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in body.iter_chunks(FILL_CHUNK_SIZE):
+                    temp_file.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        cached = CachedObject(open(path, 'rb'), s3_object["ContentLength"], s3_object.get("ETag"), s3_object.get("ContentType"))
+        self._db().execute(
+            "INSERT OR REPLACE INTO entries (path, size, etag, content_type, last_access, hits) VALUES (?, ?, ?, ?, ?, 0)",
+            (path, cached.size, cached.etag, cached.content_type, time.time())
+        )
+        self._count(bytes_fetched=cached.size)
+        self._evict()
+        return cached
+
+    def _evict(self):
+        """Removes entries in policy order until the cache is back under its low watermark."""
+        db = self._db()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        with open(os.path.join(self.directory, 'locks', 'evict'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already evicting
+                return
+            order = "last_access" if self.policy == 'lru' else "hits, last_access"
+            target = self.max_bytes * EVICTION_LOW_WATERMARK
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            for path, size in db.execute(f"SELECT path, size FROM entries ORDER BY {order}").fetchall():
+                if total <= target:
+                    break
+                db.execute("DELETE FROM entries WHERE path = ?", (path,))
+                try:
+                    # Readers that already opened the file keep reading it after the unlink
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self._remove_lock_file(path)
+                total -= size
+                self._count(evictions=1)
+
+    def discard(self, bucket, key):
+        """Removes an object from the cache, called when it is deleted from S3."""
+        path = self._path(bucket, key)
+        self._db().execute("DELETE FROM entries WHERE path = ?", (path,))
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._remove_lock_file(path)
+
+    def record_bytes_served(self, size):
+        """Records bytes served to clients from the cache."""
+        self._count(bytes_served=size)
+
+    def stats(self):
+        """
+        Returns this process's hit/miss counters and the bytes it served from and fetched into the cache,
+        the S3 transfer saved being the difference, along with the entries and bytes stored in the cache.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["bytes_saved"] = max(stats["bytes_served"] - stats["bytes_fetched"], 0)
+        stats["entries"], stats["bytes_stored"] = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return stats
+
+# Disabled unless a cache directory is configured. Building it opens nothing, each process and thread
+# connects to the index on first use like the S3 client
+disk_cache = DiskCache(
+    Config.DISK_CACHE_DIR,
+    Config.DISK_CACHE_MAX_BYTES,
+    Config.DISK_CACHE_MAX_OBJECT_BYTES,
+    Config.DISK_CACHE_POLICY
+) if Config.DISK_CACHE_DIR else None
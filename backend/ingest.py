@@ -0,0 +1,363 @@
+import hashlib
+import re
+import struct
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from db import db
+from models import AudioFile
+from config import Config
+from s3_client import s3_client
+from transcoding import get_ffmpeg_binary, transcode_audiofile
+from blobs import add_blob_reference, commit_with_blob_reference
+from outbox import enqueue_s3_deletions, s3_deletion_worker
+from collection_versions import audiofiles_collection, bump_versions
+from jobs import job_handler, enqueue_job_statement
+
+# Peaks sidecar format, little endian:
+#   header: magic 'AVPK', version (u8), sample rate (u32), channels (u16), frames (u64), level count (u16)
+#   per level: samples per peak (u32), peak count (u32), then peak count (min, max) pairs of int16
+PEAKS_MAGIC = b'AVPK'
+PEAKS_VERSION = 1
+PEAKS_HEADER = struct.Struct('<4sBIHQH')
+PEAKS_LEVEL_HEADER = struct.Struct('<II')
+
+READ_CHUNK_SIZE = 256 * 1024
+
+# Container tags kept at ingest, made searchable alongside the file name
+SEARCHABLE_TAGS = ('title', 'artist', 'album', 'album_artist', 'composer', 'genre', 'date')
+
+def peaks_s3_key(audio_file):
+    """Returns the key the peaks sidecar of an audio file is stored under, derived from the original's key."""
+    return f"peaks/{audio_file.s3_key}.dat"
+
+class PeakAccumulator:
+    """
+    Computes the min/max of every window of samples_per_peak frames across all channels,
+    as 16-bit PCM arrives in chunks of any size.
+    """
+    def __init__(self, samples_per_peak, channels):
+        self.samples_per_peak = samples_per_peak
+        self.channels = channels
+        self.frames = 0
+        self._frame_size = 2 * channels
+        self._pending_bytes = b''
+        self._partial_window = np.empty((0, channels), dtype='<i2')
+        self._mins = []
+        self._maxs = []
+
+    def add(self, data):
+        data = self._pending_bytes + data
+        usable = len(data) - len(data) % self._frame_size
+        self._pending_bytes = data[usable:]
+        frames = np.frombuffer(data[:usable], dtype='<i2').reshape(-1, self.channels)
+        self.frames += len(frames)
+        if len(self._partial_window):
+            frames = np.concatenate([self._partial_window, frames])
+
+        complete = len(frames) - len(frames) % self.samples_per_peak
+        if complete:
+            windows = frames[:complete].reshape(-1, self.samples_per_peak * self.channels)
+            self._mins.append(windows.min(axis=1))
+            self._maxs.append(windows.max(axis=1))
+        self._partial_window = frames[complete:]
+
+    def finish(self):
+        """Returns the (mins, maxs) arrays, including the final partial window."""
+        if len(self._partial_window):
+            self._mins.append(self._partial_window.min(keepdims=True).ravel())
+            self._maxs.append(self._partial_window.max(keepdims=True).ravel())
+            self._partial_window = self._partial_window[:0]
+        if not self._mins:
+            return np.empty(0, dtype='<i2'), np.empty(0, dtype='<i2')
+        return np.concatenate(self._mins), np.concatenate(self._maxs)
+
+def build_levels(mins, maxs, base_samples_per_peak, zoom_levels):
+    """
+    Derives each zoom level from the finest peaks by reducing groups of consecutive peaks.
+
+    Returns:
+        list: (samples_per_peak, mins, maxs) for each zoom level.
+    """
+    levels = []
+    for samples_per_peak in zoom_levels:
+        factor = samples_per_peak // base_samples_per_peak
+        starts = np.arange(0, len(mins), factor)
+        if len(starts):
+            levels.append((samples_per_peak, np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts)))
+        else:
+            levels.append((samples_per_peak, mins, maxs))
+    return levels
+
+def encode_peaks(sample_rate, channels, frames, levels):
+    """Serializes peaks into the compact binary sidecar format described above."""
+    parts = [PEAKS_HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, sample_rate, channels, frames, len(levels))]
+    for samples_per_peak, mins, maxs in levels:
+        parts.append(PEAKS_LEVEL_HEADER.pack(samples_per_peak, len(mins)))
+        parts.append(np.column_stack((mins, maxs)).astype('<i2').tobytes())
+    return b''.join(parts)
+
+def decode_peaks(data):
+    """
+    Parses a peaks sidecar.
+
+    Returns:
+        dict: 'sample_rate', 'channels', 'frames' and 'levels', a list of (samples_per_peak, peaks array of shape (n, 2)).
+
+    Raises:
+        ValueError: If the data is not a peaks sidecar.
+    """
+    magic, version, sample_rate, channels, frames, level_count = PEAKS_HEADER.unpack_from(data)
+    if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+        raise ValueError("Not a peaks file")
+    offset = PEAKS_HEADER.size
+    levels = []
+    for _ in range(level_count):
+        samples_per_peak, count = PEAKS_LEVEL_HEADER.unpack_from(data, offset)
+        offset += PEAKS_LEVEL_HEADER.size
+        peaks = np.frombuffer(data, dtype='<i2', count=count * 2, offset=offset).reshape(-1, 2)
+        offset += count * 4
+        levels.append((samples_per_peak, peaks))
+    return {"sample_rate": sample_rate, "channels": channels, "frames": frames, "levels": levels}
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of decoded audio")
+    return data
+
+def read_wav_header(stream):
+    """
+    Reads the header of a WAV stream written by ffmpeg up to the start of the sample data.
+
+    Returns:
+        tuple: (sample_rate, channels)
+    """
+    riff, _, wave = struct.unpack('<4sI4s', read_exactly(stream, 12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError("Decoded audio is not WAV")
+    sample_rate = channels = None
+    while True:
+        chunk_id, chunk_size = struct.unpack('<4sI', read_exactly(stream, 8))
+        if chunk_id == b'data':
+            if sample_rate is None:
+                raise ValueError("Decoded audio has no format chunk")
+            return sample_rate, channels
+        chunk = read_exactly(stream, chunk_size + chunk_size % 2)
+        if chunk_id == b'fmt ':
+            channels, sample_rate = struct.unpack_from('<HI', chunk, 2)
+
+def parse_ffmetadata(text):
+    """
+    Parses the global section of an ffmetadata file written by ffmpeg into the searchable tags it holds.
+
+    Returns:
+        dict: Tag values by lower-cased tag name, only for the tags in SEARCHABLE_TAGS that are not blank.
+    """
+    tags = {}
+    # Values escape '=', ';', '#', '\\' and newlines with a backslash
+    lines = re.split(r'(?<!\\)\n', text)
+    for line in lines:
+        if line.startswith('['):
+            # Stream and chapter sections follow the global tags
+            break
+        if not line or line.startswith((';', '#')) or '=' not in line:
+            continue
+        name, value = re.split(r'(?<!\\)=', line, maxsplit=1)
+        name = re.sub(r'\\(.)', r'\1', name, flags=re.S).strip().lower()
+        value = re.sub(r'\\(.)', r'\1', value, flags=re.S).strip()
+        if name in SEARCHABLE_TAGS and value:
+            tags[name] = value
+    return tags
+
+def search_text(tags):
+    """Returns the tag values of an audio file joined into the text indexed for search."""
+    return ' '.join(tags[name] for name in SEARCHABLE_TAGS if name in (tags or {})) or None
+
+def analyse_audiofile(audio_file_id):
+    """
+    Streams an uploaded audio file once, hashing the original bytes while ffmpeg decodes them to PCM,
+    and stores its size, checksum, duration, sample rate, channels, tags and a peaks sidecar for drawing waveforms.
+    Files that were not hashed on upload are deduplicated against the stored blobs, and the analysis of
+    content already analysed for another audio file is reused. Must be called inside an application context.
+    """
+    audio_file = db.session.get(AudioFile, audio_file_id)
+    if not audio_file:
+        return
+    if audio_file.blob_digest and copy_analysis(audio_file):
+        return
+
+    body = s3_client.get_object(Bucket=audio_file.s3_bucket, Key=audio_file.s3_key)["Body"]
+    # The tags are written to a second output in the same pass, as the input can only be read once
+    with tempfile.NamedTemporaryFile(suffix='.txt') as metadata_file:
+        sample_rate, channels, accumulator, source, checksum = decode_audiofile(body, metadata_file.name)
+        metadata_file.seek(0)
+        tags = parse_ffmetadata(metadata_file.read().decode('utf-8', 'replace'))
+
+    if not audio_file.blob_digest:
+        adopt_blob(audio_file, checksum.hexdigest(), source["size"])
+        if copy_analysis(audio_file):
+            return
+
+    zoom_levels = sorted(Config.WAVEFORM_ZOOM_LEVELS)
+    mins, maxs = accumulator.finish()
+    levels = build_levels(mins, maxs, zoom_levels[0], zoom_levels)
+    s3_client.put_object(
+        Bucket=audio_file.s3_bucket,
+        Key=peaks_s3_key(audio_file),
+        Body=encode_peaks(sample_rate, channels, accumulator.frames, levels),
+        ContentType='application/octet-stream'
+    )
+
+    audio_file.size = source["size"]
+    audio_file.checksum = checksum.hexdigest()
+    audio_file.sample_rate = sample_rate
+    audio_file.channels = channels
+    audio_file.duration = accumulator.frames / sample_rate if sample_rate else None
+    audio_file.tags = tags
+    audio_file.tags_text = search_text(tags)
+    audio_file.peaks_s3_key = peaks_s3_key(audio_file)
+    bump_versions(audiofiles_collection(audio_file.user_id))
+    db.session.commit()
+
+def decode_audiofile(body, metadata_path):
+    """
+    Feeds an S3 body through ffmpeg, hashing it on the way, and accumulates the peaks of the decoded PCM.
+    The container's tags are written to metadata_path in ffmetadata format.
+
+    Returns:
+        tuple: (sample rate, channels, PeakAccumulator, {"size": bytes read}, sha256 of the bytes read)
+    """
+    process = subprocess.Popen(
+        [
+            get_ffmpeg_binary(), '-v', 'error', '-y',
+            '-i', 'pipe:0',
+            '-map', '0:a:0', '-vn',
+            '-c:a', 'pcm_s16le', '-f', 'wav', 'pipe:1',
+            '-f', 'ffmetadata', metadata_path,
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    checksum = hashlib.sha256()
+    source = {"size": 0}
+    feed_errors = []
+    def feed():
+        try:
+            for chunk in body.iter_chunks(READ_CHUNK_SIZE):
+                checksum.update(chunk)
+                source["size"] += len(chunk)
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            # ffmpeg would decode the truncated input successfully, so the read error must fail the analysis
+            feed_errors.append(e)
+        finally:
+            process.stdin.close()
+    stderr = []
+    feeder = threading.Thread(target=feed)
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    feeder.start()
+    stderr_reader.start()
+
+    decode_error = None
+    try:
+        sample_rate, channels = read_wav_header(process.stdout)
+        accumulator = PeakAccumulator(min(Config.WAVEFORM_ZOOM_LEVELS), channels)
+        while True:
+            chunk = process.stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            accumulator.add(chunk)
+    except ValueError as e:
+        decode_error = e
+    finally:
+        process.stdout.close()
+        feeder.join()
+        process.wait()
+        stderr_reader.join()
+    if feed_errors:
+        raise feed_errors[0]
+    # Prefer ffmpeg's own explanation when the file could not be decoded
+    if process.returncode != 0:
+        raise RuntimeError(b''.join(stderr).decode('utf-8', 'replace').strip() or f"ffmpeg exited with {process.returncode}")
+    if decode_error:
+        raise decode_error
+    return sample_rate, channels, accumulator, source, checksum
+
+def copy_analysis(audio_file):
+    """
+    Copies the metadata and peaks of another audio file with the same content, if one has already been analysed.
+
+    Returns:
+        bool: Whether the analysis was copied.
+    """
+    analysed = AudioFile.query.filter(
+        AudioFile.blob_digest == audio_file.blob_digest,
+        AudioFile.id != audio_file.id,
+        AudioFile.peaks_s3_key.isnot(None)
+    ).first()
+    if not analysed:
+        return False
+    for column in ('size', 'checksum', 'duration', 'sample_rate', 'channels', 'tags', 'tags_text', 'peaks_s3_key'):
+        setattr(audio_file, column, getattr(analysed, column))
+    bump_versions(audiofiles_collection(audio_file.user_id))
+    db.session.commit()
+    return True
+
+def adopt_blob(audio_file, digest, size):
+    """
+    Moves an audio file uploaded straight to S3 (presigned or chunked uploads) into content-addressed storage
+    once its digest is known. If the content is already stored, the audio file is pointed at the existing
+    blob and its own copy queued for deletion, otherwise its object becomes the blob in place, avoiding a copy.
+    """
+    # Imported here as the routes import this module to schedule ingests
+    from routes.audiofiles import forget_presigned_urls
+
+    uploaded_key = audio_file.s3_key
+    def reference():
+        blob = add_blob_reference(digest, audio_file.s3_bucket, size, uploaded_key)
+        audio_file.s3_key = blob.s3_key
+        audio_file.blob_digest = digest
+        if blob.s3_key != uploaded_key:
+            # The content was already stored, so the uploaded copy is no longer needed
+            enqueue_s3_deletions(audio_file.s3_bucket, [uploaded_key])
+        return blob
+
+    blob = commit_with_blob_reference(reference)
+    if blob.s3_key != uploaded_key:
+        forget_presigned_urls(audio_file)
+        s3_deletion_worker.notify()
+
+def schedule_ingest_statement(audio_file_id, dialect_name):
+    """Builds the INSERT queueing the ingest of an audio file, see schedule_ingest."""
+    return enqueue_job_statement(dialect_name, 'ingest', {"audio_file_id": audio_file_id}, idempotency_key=f"ingest:{audio_file_id}")
+
+def schedule_ingest(audio_file_id):
+    """
+    Queues the post-upload pipeline of a new audio file in the transaction that stores it. Call
+    job_worker.notify after committing to start it straight away. Does not commit.
+    """
+    db.session.execute(schedule_ingest_statement(audio_file_id, db.session.get_bind().dialect.name))
+
+@job_handler('ingest')
+def ingest_audiofile(audio_file_id):
+    """
+    Runs the post-upload pipeline of an audio file: analysis for metadata and waveform peaks, then queueing the
+    transcode of its content into renditions, which runs as its own job. A failed analysis does not hold back
+    transcoding, and the job is retried if it failed.
+    """
+    analysis_error = None
+    try:
+        analyse_audiofile(audio_file_id)
+    except Exception as e:
+        db.session.rollback()
+        analysis_error = e
+    if Config.TRANSCODE_ENABLED:
+        transcode_audiofile(audio_file_id)
+    if analysis_error:
+        raise analysis_error
@@ -0,0 +1,329 @@
+import datetime
+import os
+import random
+import socket
+import threading
+import time
+from flask import current_app
+from sqlalchemy import select, update, delete, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from db import db
+from models import Job
+from config import Config
+
+# Handlers by job kind, registered with job_handler
+job_handlers = {}
+
+# How often each worker process deletes old done jobs and buries jobs whose last lease expired
+PRUNE_INTERVAL_SECONDS = 60
+
+class JobFailed(Exception):
+    """Raised by a handler when its job can never succeed, so the job is dead straight away instead of retried."""
+
+def job_handler(kind):
+    """
+    Decorator registering the function that runs the jobs of a kind. It is called with the job's payload as
+    keyword arguments inside an application context. A job is done once its handler returns, and retried
+    with exponential backoff if it raises. Jobs whose worker is lost are run again, so handlers must be
+    safe to run more than once.
+
+    Args:
+        kind (str): The kind of jobs the function runs.
+    """
+    def decorator(f):
+        job_handlers[kind] = f
+        return f
+    return decorator
+
+def enqueue_job_statement(dialect_name, kind, payload=None, priority=0, idempotency_key=None, run_at=None, max_attempts=None):
+    """
+    Builds the INSERT queueing a job, see enqueue_job.
+
+    Args:
+        dialect_name (str): Name of the database dialect, 'postgresql' or 'sqlite'.
+    """
+    now = datetime.datetime.utcnow()
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    statement = insert(Job).values(
+        kind=kind,
+        payload=payload or {},
+        priority=priority,
+        status='queued',
+        idempotency_key=idempotency_key,
+        attempts=0,
+        max_attempts=max_attempts or Config.JOB_MAX_ATTEMPTS,
+        run_at=run_at or now,
+        created_at=now
+    )
+    return statement.on_conflict_do_nothing(index_elements=[Job.idempotency_key])
+
+def enqueue_job(kind, payload=None, priority=0, idempotency_key=None, run_at=None, max_attempts=None):
+    """
+    Queues a job in the current transaction, so it only runs if the transaction commits, and always does
+    once it has. Call job_worker.notify after committing to run it straight away. Does not commit.
+
+    Args:
+        kind (str): The kind of job, see job_handler.
+        payload (dict): JSON serializable keyword arguments of the handler.
+        priority (int): Jobs with a lower priority are claimed first.
+        idempotency_key (str): If a job with this key is already queued, or done and not yet pruned, nothing is queued.
+        run_at (datetime): When the job is due, straight away by default.
+        max_attempts (int): Number of attempts before the job is dead, defaults to Config.JOB_MAX_ATTEMPTS.
+    """
+    db.session.execute(enqueue_job_statement(
+        db.session.get_bind().dialect.name, kind, payload, priority, idempotency_key, run_at, max_attempts
+    ))
+
+def retry_delay(attempts):
+    """Returns the delay before retrying a job that has failed attempts times, with jitter."""
+    delay = min(Config.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), Config.JOB_RETRY_MAX_SECONDS)
+    return datetime.timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+def claimable(now):
+    """Returns the condition of jobs that are due, or still running past their lease with attempts left."""
+    return (
+        and_(Job.status == 'queued', Job.run_at <= now)
+        | and_(Job.status == 'running', Job.locked_until < now, Job.attempts < Job.max_attempts)
+    )
+
+def claim_jobs(worker_id, batch_size=None):
+    """
+    Claims the next jobs to run, those whose worker was lost first, then the due jobs by priority, run_at and id.
+    The candidates are selected with FOR UPDATE SKIP LOCKED, so concurrent workers claim different jobs without
+    waiting on each other, and the UPDATE checks they are still claimable for databases without row locks.
+    Commits the claim, so the jobs are run outside of the transaction that locked them.
+
+    Args:
+        worker_id (str): Identifies the claiming worker process.
+        batch_size (int): Maximum number of jobs claimed, defaults to Config.JOB_CLAIM_BATCH_SIZE.
+
+    Returns:
+        list: Rows with the 'id', 'kind', 'payload' and 'attempts' of each job claimed.
+    """
+    batch_size = batch_size or Config.JOB_CLAIM_BATCH_SIZE
+    now = datetime.datetime.utcnow()
+    ids = list(db.session.scalars(
+        select(Job.id)
+        .where(Job.status == 'running', Job.locked_until < now, Job.attempts < Job.max_attempts)
+        .order_by(Job.locked_until).limit(batch_size).with_for_update(skip_locked=True)
+    ))
+    if len(ids) < batch_size:
+        ids.extend(db.session.scalars(
+            select(Job.id)
+            .where(Job.status == 'queued', Job.run_at <= now)
+            .order_by(Job.priority, Job.run_at, Job.id).limit(batch_size - len(ids)).with_for_update(skip_locked=True)
+        ))
+    if not ids:
+        db.session.commit()
+        return []
+    jobs = db.session.execute(
+        update(Job).where(Job.id.in_(ids), claimable(now)).values(
+            status='running',
+            locked_by=worker_id,
+            locked_until=now + datetime.timedelta(seconds=Config.JOB_LEASE_SECONDS),
+            attempts=Job.attempts + 1
+        ).returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    # RETURNING gives no order, run them in the order they were selected
+    order = {job_id: position for position, job_id in enumerate(ids)}
+    return sorted(jobs, key=lambda job: order[job.id])
+
+def finish_job(job, worker_id, error=None, permanent=False):
+    """
+    Records the outcome of an attempt: the job is done if there is no error, otherwise it is queued again
+    after a backoff, or dead once it has used all of its attempts or failed permanently. Nothing is recorded
+    if the job was claimed again after this worker's lease expired, as the newer attempt owns it. Commits.
+
+    Args:
+        job: The job as returned by claim_jobs.
+        worker_id (str): The worker that claimed it.
+        error (str): Why the attempt failed, None if it succeeded.
+        permanent (bool): Whether the job can never succeed.
+    """
+    now = datetime.datetime.utcnow()
+    if error is None:
+        values = {"status": 'done', "finished_at": now, "last_error": None}
+    elif permanent or job.attempts >= job.max_attempts:
+        values = {"status": 'dead', "finished_at": now, "last_error": error}
+    else:
+        values = {"status": 'queued', "run_at": now + retry_delay(job.attempts), "last_error": error}
+    db.session.execute(
+        update(Job).where(
+            Job.id == job.id, Job.status == 'running', Job.locked_by == worker_id, Job.attempts == job.attempts
+        ).values(locked_by=None, locked_until=None, **values).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+def run_job(job, worker_id):
+    """Runs a claimed job with its handler and records the outcome. Must be called inside an application context."""
+    handler = job_handlers.get(job.kind)
+    try:
+        if handler is None:
+            raise JobFailed(f"No handler for jobs of kind {job.kind}")
+        handler(**job.payload)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+        finish_job(job, worker_id, str(e) or type(e).__name__, isinstance(e, JobFailed))
+    else:
+        finish_job(job, worker_id)
+
+def extend_leases(worker_id, job_ids):
+    """Extends the leases of the jobs a worker is running, so long jobs are not claimed again. Commits."""
+    if job_ids:
+        db.session.execute(
+            update(Job).where(Job.id.in_(job_ids), Job.status == 'running', Job.locked_by == worker_id).values(
+                locked_until=datetime.datetime.utcnow() + datetime.timedelta(seconds=Config.JOB_LEASE_SECONDS)
+            ).execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+
+def prune_jobs(retention_seconds=None):
+    """
+    Deletes the jobs done more than retention_seconds ago, defaulting to Config.JOB_RETENTION_SECONDS, and
+    marks dead the jobs whose last attempt's worker was lost. Dead jobs are kept until requeued or deleted
+    by hand. Commits.
+
+    Returns:
+        tuple: (number of jobs deleted, number marked dead)
+    """
+    retention_seconds = Config.JOB_RETENTION_SECONDS if retention_seconds is None else retention_seconds
+    now = datetime.datetime.utcnow()
+    deleted = db.session.execute(
+        delete(Job).where(Job.status == 'done', Job.finished_at < now - datetime.timedelta(seconds=retention_seconds))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    buried = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.locked_until < now, Job.attempts >= Job.max_attempts).values(
+            status='dead', finished_at=now, locked_by=None, locked_until=None,
+            last_error="Worker lost during the last attempt"
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return deleted, buried
+
+def requeue_jobs(kind=None):
+    """
+    Queues the dead jobs again with fresh attempts, e.g. once the cause of their failure is fixed. Commits.
+
+    Args:
+        kind (str): Only requeue the jobs of this kind.
+
+    Returns:
+        int: Number of jobs requeued.
+    """
+    statement = update(Job).where(Job.status == 'dead')
+    if kind:
+        statement = statement.where(Job.kind == kind)
+    requeued = db.session.execute(statement.values(
+        status='queued', attempts=0, run_at=datetime.datetime.utcnow(), finished_at=None
+    ).execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return requeued
+
+class JobWorker:
+    """
+    Runs queued jobs on a pool of threads of the current process. In the web processes the pool is started
+    by the first notify, which the write paths call after committing jobs, with Config.JOB_WORKER_THREADS
+    threads, 0 by default leaving every job to dedicated worker processes started with `flask jobs work`.
+    Idle threads poll every Config.JOB_POLL_SECONDS for retries and jobs queued by other processes, and a
+    heartbeat thread extends the leases of the running jobs. Set up with init_app like the other extensions.
+    """
+    def __init__(self):
+        self.app = None
+        self.claim_batch_size = None
+        self._threads = []
+        self._pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._running = set()
+        self._last_prune = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def worker_id(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self, threads):
+        """Starts the given number of worker threads and the heartbeat, unless this process already has them."""
+        with self._lock:
+            # Threads do not survive a fork, so a forked process starts its own
+            if self._pid == os.getpid() and any(thread.is_alive() for thread in self._threads):
+                return
+            self._pid = os.getpid()
+            self._running = set()
+            self._threads = [threading.Thread(target=self.run, name=f'job-worker-{i}', daemon=True) for i in range(threads)]
+            self._threads.append(threading.Thread(target=self.heartbeat, name='job-heartbeat', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def notify(self):
+        """Wakes the workers to run jobs that were just committed, starting them on first use."""
+        if self.app is None or Config.JOB_WORKER_THREADS <= 0:
+            return
+        self.start(Config.JOB_WORKER_THREADS)
+        self._wake.set()
+
+    def work(self, threads):
+        """Runs jobs on the given number of threads until the process is stopped."""
+        self.start(threads)
+        for thread in self._threads:
+            thread.join()
+
+    def drain(self):
+        """Claims and runs jobs until none are due, returning the number run."""
+        total = 0
+        with self.app.app_context():
+            try:
+                while True:
+                    jobs = claim_jobs(self.worker_id, self.claim_batch_size)
+                    for job in jobs:
+                        with self._lock:
+                            self._running.add(job.id)
+                        try:
+                            run_job(job, self.worker_id)
+                        finally:
+                            with self._lock:
+                                self._running.discard(job.id)
+                    total += len(jobs)
+                    if not jobs:
+                        break
+                if time.monotonic() - self._last_prune > PRUNE_INTERVAL_SECONDS:
+                    self._last_prune = time.monotonic()
+                    prune_jobs()
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.warning(f"Running jobs failed: {e}")
+            finally:
+                db.session.remove()
+        return total
+
+    def run(self):
+        """Runs jobs whenever notified or the poll interval elapses, forever."""
+        while True:
+            self._wake.clear()
+            self.drain()
+            self._wake.wait(Config.JOB_POLL_SECONDS)
+
+    def heartbeat(self):
+        """Extends the leases of the running jobs a few times per lease, forever."""
+        while True:
+            time.sleep(Config.JOB_LEASE_SECONDS / 3)
+            with self._lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            with self.app.app_context():
+                try:
+                    extend_leases(self.worker_id, job_ids)
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.warning(f"Extending job leases failed: {e}")
+                finally:
+                    db.session.remove()
+
+job_worker = JobWorker()
@@ -0,0 +1,66 @@
+"""initial schema
+
+The schema previously created by db.create_all(). Databases created that way should be
+marked as already at this revision with `flask db stamp 0001` before upgrading.
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-17 15:10:39.423558
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('username', sa.String(length=30), nullable=False),
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('password', sa.String(length=120), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('username')
+    )
+    op.create_table('audio_file',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('file_name', sa.String(length=255), nullable=False),
+    sa.Column('s3_bucket', sa.String(length=255), nullable=False),
+    sa.Column('s3_key', sa.String(length=255), nullable=False),
+    sa.Column('user_id', sa.String(length=36), nullable=False),
+    sa.Column('liked', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('upload_session',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('file_name', sa.String(length=255), nullable=False),
+    sa.Column('s3_bucket', sa.String(length=255), nullable=False),
+    sa.Column('s3_key', sa.String(length=255), nullable=False),
+    sa.Column('s3_upload_id', sa.String(length=1024), nullable=False),
+    sa.Column('user_id', sa.String(length=36), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('upload_part',
+    sa.Column('upload_id', sa.String(length=36), nullable=False),
+    sa.Column('part_number', sa.Integer(), nullable=False),
+    sa.Column('etag', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['upload_id'], ['upload_session.id'], ),
+    sa.PrimaryKeyConstraint('upload_id', 'part_number')
+    )
+
+
+def downgrade():
+    op.drop_table('upload_part')
+    op.drop_table('upload_session')
+    op.drop_table('audio_file')
+    op.drop_table('user')
@@ -0,0 +1,35 @@
+"""add audio file and upload indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 15:10:42.408453
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so existing audio_file tables stay writable while the indexes are created
+    with op.get_context().autocommit_block():
+        op.create_index('ix_audio_file_user_id_file_name_id', 'audio_file', ['user_id', 'file_name', 'id'], unique=False,
+                        postgresql_include=['liked'], postgresql_concurrently=True)
+        op.create_index('ix_audio_file_user_id_liked_file_name_id', 'audio_file', ['user_id', 'file_name', 'id'], unique=False,
+                        postgresql_where=sa.text('liked'), postgresql_concurrently=True)
+
+    op.create_index(op.f('ix_upload_session_created_at'), 'upload_session', ['created_at'], unique=False)
+    op.create_index(op.f('ix_upload_session_user_id'), 'upload_session', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_upload_session_user_id'), table_name='upload_session')
+    op.drop_index(op.f('ix_upload_session_created_at'), table_name='upload_session')
+    op.drop_index('ix_audio_file_user_id_liked_file_name_id', table_name='audio_file')
+    op.drop_index('ix_audio_file_user_id_file_name_id', table_name='audio_file')
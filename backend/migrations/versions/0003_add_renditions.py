@@ -0,0 +1,37 @@
+"""add renditions
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 15:12:34.909482
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rendition',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('audio_file_id', sa.String(length=36), nullable=False),
+    sa.Column('bitrate', sa.Integer(), nullable=False),
+    sa.Column('codec', sa.String(length=20), nullable=False),
+    sa.Column('content_type', sa.String(length=100), nullable=False),
+    sa.Column('s3_bucket', sa.String(length=255), nullable=False),
+    sa.Column('s3_key', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.ForeignKeyConstraint(['audio_file_id'], ['audio_file.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('audio_file_id', 'bitrate', name='uq_rendition_audio_file_id_bitrate')
+    )
+
+
+def downgrade():
+    op.drop_table('rendition')
@@ -0,0 +1,36 @@
+"""add audio file metadata
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 15:16:01.998904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('size', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('checksum', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('duration', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('sample_rate', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('channels', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('peaks_s3_key', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.drop_column('peaks_s3_key')
+        batch_op.drop_column('channels')
+        batch_op.drop_column('sample_rate')
+        batch_op.drop_column('duration')
+        batch_op.drop_column('checksum')
+        batch_op.drop_column('size')
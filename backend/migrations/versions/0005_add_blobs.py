@@ -0,0 +1,47 @@
+"""add blobs
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 15:19:06.923741
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob',
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('s3_bucket', sa.String(length=255), nullable=False),
+    sa.Column('s3_key', sa.String(length=255), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('ref_count', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('blob_digest', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_audio_file_blob_digest'), ['blob_digest'], unique=False)
+        batch_op.create_foreign_key('fk_audio_file_blob_digest_blob', 'blob', ['blob_digest'], ['digest'])
+
+    with op.batch_alter_table('rendition', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_rendition_s3_key'), ['s3_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('rendition', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_rendition_s3_key'))
+
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_audio_file_blob_digest_blob', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_audio_file_blob_digest'))
+        batch_op.drop_column('blob_digest')
+
+    op.drop_table('blob')
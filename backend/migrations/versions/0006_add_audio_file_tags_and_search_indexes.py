@@ -0,0 +1,48 @@
+"""add audio file tags and search indexes
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 15:28:31.745798
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+SEARCH_DOCUMENT = "file_name || ' ' || coalesce(tags_text, '')"
+
+
+def upgrade():
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('tags', sa.JSON(), nullable=True))
+        batch_op.add_column(sa.Column('tags_text', sa.Text(), nullable=True))
+
+    # The search indexes are Postgres only, SQLite searches an in-memory index instead
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gin")
+    # Built concurrently so existing audio_file tables stay writable while the indexes are created
+    with op.get_context().autocommit_block():
+        op.create_index('ix_audio_file_user_id_search_tsv', 'audio_file',
+                        ['user_id', sa.text(f"to_tsvector('simple', {SEARCH_DOCUMENT})")],
+                        postgresql_using='gin', postgresql_concurrently=True)
+        op.create_index('ix_audio_file_user_id_search_trgm', 'audio_file',
+                        ['user_id', sa.text(f"({SEARCH_DOCUMENT}) gin_trgm_ops")],
+                        postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_audio_file_user_id_search_trgm', table_name='audio_file')
+        op.drop_index('ix_audio_file_user_id_search_tsv', table_name='audio_file')
+
+    with op.batch_alter_table('audio_file', schema=None) as batch_op:
+        batch_op.drop_column('tags_text')
+        batch_op.drop_column('tags')
@@ -0,0 +1,47 @@
+"""add s3 deletion outbox
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 15:32:01.093735
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('s3_deletion',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('s3_bucket', sa.String(length=255), nullable=False),
+    sa.Column('s3_key', sa.String(length=255), nullable=False),
+    sa.Column('s3_upload_id', sa.String(length=1024), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('s3_deletion', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_s3_deletion_next_attempt_at'), ['next_attempt_at'], unique=False)
+        batch_op.create_index('ix_s3_deletion_s3_bucket_s3_key', ['s3_bucket', 's3_key'], unique=False)
+
+    # Built concurrently so existing audio_file tables stay writable while the index is created
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_audio_file_s3_key'), 'audio_file', ['s3_key'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_audio_file_s3_key'), table_name='audio_file')
+
+    with op.batch_alter_table('s3_deletion', schema=None) as batch_op:
+        batch_op.drop_index('ix_s3_deletion_s3_bucket_s3_key')
+        batch_op.drop_index(batch_op.f('ix_s3_deletion_next_attempt_at'))
+
+    op.drop_table('s3_deletion')
@@ -0,0 +1,37 @@
+"""add user usage counters
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 15:36:02.254466
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('file_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('storage_bytes', sa.BigInteger(), server_default='0', nullable=False))
+
+    # Start the counters from the audio files users already have
+    op.execute(
+        'UPDATE "user" SET '
+        'file_count = (SELECT COUNT(*) FROM audio_file WHERE audio_file.user_id = "user".id), '
+        'storage_bytes = (SELECT COALESCE(SUM(audio_file.size), 0) FROM audio_file WHERE audio_file.user_id = "user".id)'
+    )
+
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('storage_bytes')
+        batch_op.drop_column('file_count')
+
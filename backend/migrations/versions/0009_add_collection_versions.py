@@ -0,0 +1,28 @@
+"""add collection versions
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 15:46:46.848244
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_version',
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('collection_version')
@@ -0,0 +1,40 @@
+"""add user summary
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17 15:53:08.926116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_summary',
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('user_count', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('file_count', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('storage_bytes', sa.BigInteger(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('role')
+    )
+
+    # Start from the users that already exist, every role has a row so writes only need to update it
+    op.execute(
+        'INSERT INTO user_summary (role, user_count, file_count, storage_bytes) '
+        'SELECT role, COUNT(*), COALESCE(SUM(file_count), 0), COALESCE(SUM(storage_bytes), 0) FROM "user" GROUP BY role'
+    )
+    op.execute(
+        "INSERT INTO user_summary (role) SELECT role FROM (SELECT 'member' AS role UNION ALL SELECT 'admin' UNION ALL SELECT 'master') AS roles "
+        "WHERE role NOT IN (SELECT role FROM user_summary)"
+    )
+
+
+def downgrade():
+    op.drop_table('user_summary')
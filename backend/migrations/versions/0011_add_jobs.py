@@ -0,0 +1,51 @@
+"""add jobs
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-17 15:55:47.448143
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=100), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('priority', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('idempotency_key', sa.String(length=255), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('locked_by', sa.String(length=100), nullable=True),
+    sa.Column('locked_until', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('idempotency_key')
+    )
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.create_index('ix_job_status_finished_at', ['status', 'finished_at'], unique=False)
+        batch_op.create_index('ix_job_status_locked_until', ['status', 'locked_until'], unique=False)
+        batch_op.create_index('ix_job_queued_priority_run_at_id', ['priority', 'run_at', 'id'], unique=False,
+                              postgresql_where=sa.text("status = 'queued'"))
+
+
+def downgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_index('ix_job_queued_priority_run_at_id')
+        batch_op.drop_index('ix_job_status_locked_until')
+        batch_op.drop_index('ix_job_status_finished_at')
+
+    op.drop_table('job')
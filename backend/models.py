@@ -1,4 +1,5 @@
 import uuid
+import datetime
 from db import db
 
 class User(db.Model):
@@ -10,12 +11,16 @@ class User(db.Model):
         username (str): The user's username, must be unique.
         role (str): The user's role either admin or member, defaults to member
         password (str): The user's hashed password.
+        file_count (int): Number of audio files the user has, counted against their file quota.
+        storage_bytes (int): Total size of the user's audio files, counted against their storage quota.
 
     """
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     username = db.Column(db.String(30), unique=True, nullable=False)
     role = db.Column(db.String(20), nullable=False, default='member')
     password = db.Column(db.String(120), nullable=False)
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    storage_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f'<User {self.username}, Role {self.role}>'
@@ -28,16 +33,274 @@ class AudioFile(db.Model):
         id (str): Unique identifier for the audio file (primary key).
         file_name (str): Name of the audio file.
         s3_bucket (str): S3 bucket where the audio file is stored.
-        s3_key (str): Key for the audio file in the S3 bucket. (currently s3_key is simply the id)
+        s3_key (str): Key for the audio file in the S3 bucket, the key of its blob once its content has been hashed.
         user_id (str): ID of the user who uploaded the audio file (foreign key).
         liked (bool): Indicates whether the audio file is liked by the user (default: False).
+        size (int): Size of the original file in bytes, filled in at ingest.
+        checksum (str): Hex SHA-256 of the original file, filled in at ingest.
+        duration (float): Duration in seconds, filled in at ingest.
+        sample_rate (int): Sample rate in Hz, filled in at ingest.
+        channels (int): Number of audio channels, filled in at ingest.
+        tags (dict): Title, artist, album and other tags read from the file's container at ingest.
+        tags_text (str): The tag values joined together, searched along with the file name.
+        peaks_s3_key (str): Key of the waveform peaks sidecar in the S3 bucket, set once it has been computed.
+        blob_digest (str): Digest of the blob holding the file's content (foreign key), shared by every audio file
+            with the same content. Null for files uploaded before deduplication or not hashed yet.
     """
     id = db.Column(db.String(36), primary_key=True)
     file_name = db.Column(db.String(255), nullable=False)
     s3_bucket = db.Column(db.String(255), nullable=False)
-    s3_key = db.Column(db.String(255), nullable=False)  
+    s3_key = db.Column(db.String(255), nullable=False, index=True)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)  
     liked = db.Column(db.Boolean, default=False, nullable=False)
+    size = db.Column(db.BigInteger)
+    checksum = db.Column(db.String(64))
+    duration = db.Column(db.Float)
+    sample_rate = db.Column(db.Integer)
+    channels = db.Column(db.Integer)
+    tags = db.Column(db.JSON)
+    tags_text = db.Column(db.Text)
+    peaks_s3_key = db.Column(db.String(255))
+    blob_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), index=True)
+
+    __table_args__ = (
+        # Listings, deletes and likes filter on user_id and page through (file_name, id)
+        db.Index('ix_audio_file_user_id_file_name_id', 'user_id', 'file_name', 'id', postgresql_include=['liked']),
+        # Favourites only index the liked rows
+        db.Index('ix_audio_file_user_id_liked_file_name_id', 'user_id', 'file_name', 'id', postgresql_where=db.text('liked')),
+        # Search matches words and prefixes with the full text index and substrings and typos with the trigram
+        # index, both scoped to the user by btree_gin. Postgres only, SQLite searches an in-memory index instead
+        db.Index(
+            'ix_audio_file_user_id_search_tsv', 'user_id',
+            db.func.to_tsvector(db.literal_column("'simple'"), db.text("file_name || ' ' || coalesce(tags_text, '')")),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+        db.Index(
+            'ix_audio_file_user_id_search_trgm', 'user_id',
+            db.literal_column("(file_name || ' ' || coalesce(tags_text, ''))").label('search_document'),
+            postgresql_using='gin', postgresql_ops={'search_document': 'gin_trgm_ops'}
+        ).ddl_if(dialect='postgresql'),
+    )
+
+    renditions = db.relationship('Rendition', backref='audio_file', cascade='all, delete-orphan', order_by='Rendition.bitrate')
 
     def __repr__(self):
         return f"<AudioFile {self.file_name}, S3 Path {self.s3_bucket}/{self.s3_key}, Liked: {self.liked}, Shared: {self.share}>"
+
+
+class Blob(db.Model):
+    """
+    Represents the content of uploaded audio files, stored once in S3 however many audio files share it.
+
+    Attributes:
+        digest (str): Hex SHA-256 of the content (primary key).
+        s3_bucket (str): S3 bucket where the content is stored.
+        s3_key (str): Key for the content in the S3 bucket, 'blobs/<digest>' for uploads through the backend.
+        size (int): Size of the content in bytes.
+        ref_count (int): Number of audio files referencing the blob, the content is deleted when it drops to zero.
+        created_at (datetime): When the content was first stored.
+    """
+    digest = db.Column(db.String(64), primary_key=True)
+    s3_bucket = db.Column(db.String(255), nullable=False)
+    s3_key = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Blob {self.digest}, S3 Path {self.s3_bucket}/{self.s3_key}, References {self.ref_count}>"
+
+class UploadSession(db.Model):
+    """
+    Represents an in-progress chunked upload backed by an S3 multipart upload.
+    The AudioFile row is only created once the upload is completed.
+
+    Attributes:
+        id (str): Unique identifier for the upload, returned to the client as the upload id.
+        file_name (str): Name of the audio file being uploaded.
+        s3_bucket (str): S3 bucket the audio file is uploaded to.
+        s3_key (str): Key the audio file will be stored under, also the id of the resulting AudioFile.
+        s3_upload_id (str): Id of the S3 multipart upload.
+        user_id (str): ID of the user uploading the file (foreign key).
+        created_at (datetime): When the upload was initiated, used to expire abandoned uploads.
+    """
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    file_name = db.Column(db.String(255), nullable=False)
+    s3_bucket = db.Column(db.String(255), nullable=False)
+    s3_key = db.Column(db.String(255), nullable=False)
+    s3_upload_id = db.Column(db.String(1024), nullable=False)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    parts = db.relationship('UploadPart', backref='upload', cascade='all, delete-orphan', order_by='UploadPart.part_number')
+
+    def __repr__(self):
+        return f"<UploadSession {self.id}, File {self.file_name}, S3 Path {self.s3_bucket}/{self.s3_key}>"
+
+class UploadPart(db.Model):
+    """
+    Represents a part of a chunked upload that has been stored in S3.
+
+    Attributes:
+        upload_id (str): ID of the upload the part belongs to (foreign key).
+        part_number (int): Position of the part in the file, from 1 to 10000.
+        etag (str): ETag returned by S3 for the part, needed to complete the upload.
+        size (int): Size of the part in bytes.
+    """
+    upload_id = db.Column(db.String(36), db.ForeignKey('upload_session.id'), primary_key=True)
+    part_number = db.Column(db.Integer, primary_key=True)
+    etag = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<UploadPart {self.upload_id}, Part {self.part_number}, Size {self.size}>"
+
+class Rendition(db.Model):
+    """
+    Represents a compressed copy of an audio file at a given bitrate, produced in the background after upload.
+
+    Attributes:
+        id (str): Unique identifier for the rendition, generated as a UUID.
+        audio_file_id (str): ID of the audio file the rendition was made from (foreign key).
+        bitrate (int): Target bitrate of the rendition in kbit/s.
+        codec (str): Codec of the rendition, e.g. 'aac'.
+        content_type (str): MIME type the rendition is served with.
+        s3_bucket (str): S3 bucket where the rendition is stored.
+        s3_key (str): Key for the rendition in the S3 bucket, derived from the audio file's key, so audio files
+            sharing a blob share their renditions.
+        size (int): Size of the rendition in bytes, once it is ready.
+        status (str): 'pending' while being transcoded, then 'ready' or 'failed'.
+    """
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    audio_file_id = db.Column(db.String(36), db.ForeignKey('audio_file.id'), nullable=False)
+    bitrate = db.Column(db.Integer, nullable=False)
+    codec = db.Column(db.String(20), nullable=False)
+    content_type = db.Column(db.String(100), nullable=False)
+    s3_bucket = db.Column(db.String(255), nullable=False)
+    s3_key = db.Column(db.String(255), nullable=False, index=True)
+    size = db.Column(db.BigInteger)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+
+    __table_args__ = (
+        db.UniqueConstraint('audio_file_id', 'bitrate', name='uq_rendition_audio_file_id_bitrate'),
+    )
+
+    def __repr__(self):
+        return f"<Rendition {self.audio_file_id} at {self.bitrate}k, S3 Path {self.s3_bucket}/{self.s3_key}, Status {self.status}>"
+
+class S3Deletion(db.Model):
+    """
+    Represents S3 cleanup waiting to be done, written in the same transaction as the rows that referenced
+    the objects (a transactional outbox) and carried out in the background by outbox.S3DeletionWorker.
+
+    Attributes:
+        id (int): Sequence number (primary key), pending deletions are attempted in this order.
+        s3_bucket (str): S3 bucket the object is in.
+        s3_key (str): Key of the object to delete.
+        s3_upload_id (str): Id of a multipart upload to abort instead, for uploads that were never completed.
+        attempts (int): Number of failed attempts so far.
+        next_attempt_at (datetime): When the deletion is next due, pushed back after each failed attempt.
+        last_error (str): Error of the last failed attempt.
+        created_at (datetime): When the deletion was queued.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    s3_bucket = db.Column(db.String(255), nullable=False)
+    s3_key = db.Column(db.String(255), nullable=False)
+    s3_upload_id = db.Column(db.String(1024))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # Storing content again cancels the pending deletions of its key
+        db.Index('ix_s3_deletion_s3_bucket_s3_key', 's3_bucket', 's3_key'),
+    )
+
+    def __repr__(self):
+        return f"<S3Deletion {self.id}, S3 Path {self.s3_bucket}/{self.s3_key}, Attempts {self.attempts}>"
+
+class CollectionVersion(db.Model):
+    """
+    Represents the version of a collection that clients poll, such as a user's audio files, bumped in the
+    same transaction as every write to it. Listing responses are tagged and cached by version, see
+    response_cache.py.
+
+    Attributes:
+        name (str): The collection (primary key), e.g. 'audiofiles:<user id>'.
+        version (int): Number of writes to the collection, collections never written have no row and are at 0.
+    """
+    name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<CollectionVersion {self.name} at {self.version}>"
+
+class UserSummary(db.Model):
+    """
+    Represents the totals of the users of a role, shown by the admin user listing. Kept up to date by the
+    transactions that create, delete or change the role of users and that add or remove audio files, so
+    they are read without scanning the users, see user_summary.py.
+
+    Attributes:
+        role (str): The role (primary key), 'member', 'admin' or 'master'.
+        user_count (int): Number of users with the role.
+        file_count (int): Number of audio files they have.
+        storage_bytes (int): Total size of their audio files.
+    """
+    role = db.Column(db.String(20), primary_key=True)
+    user_count = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    file_count = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    storage_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return f"<UserSummary {self.role}: {self.user_count} users, {self.file_count} files>"
+
+class Job(db.Model):
+    """
+    Represents a unit of background work in the durable job queue, run by jobs.JobWorker. Jobs are enqueued
+    in the same transaction as the rows they follow up on, claimed by workers with FOR UPDATE SKIP LOCKED,
+    and retried with exponential backoff until they succeed or run out of attempts.
+
+    Attributes:
+        id (int): Sequence number (primary key), jobs of the same priority due at the same time run in this order.
+        kind (str): Name of the handler that runs the job, see jobs.job_handler.
+        payload (dict): Arguments of the handler.
+        priority (int): Jobs with a lower priority are claimed first, 0 by default, negative for urgent work.
+        status (str): 'queued', 'running' while a worker holds it, 'done', or 'dead' once it has failed
+            max_attempts times or failed permanently.
+        idempotency_key (str): Optional unique key, enqueueing a job whose key is already queued or kept does nothing.
+        attempts (int): Number of times the job has been claimed.
+        max_attempts (int): Number of attempts before the job is dead.
+        run_at (datetime): When the job is next due, pushed back after each failed attempt.
+        locked_by (str): Worker running the job.
+        locked_until (datetime): When the worker's lease expires, extended while it runs. A job still running
+            past its lease is claimed again, as its worker is assumed lost.
+        last_error (str): Error of the last failed attempt.
+        created_at (datetime): When the job was enqueued.
+        finished_at (datetime): When the job succeeded or died, done jobs are deleted after Config.JOB_RETENTION_SECONDS.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    idempotency_key = db.Column(db.String(255), unique=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Claiming scans the queued jobs in priority order, only they are indexed as done jobs pile up
+        db.Index('ix_job_queued_priority_run_at_id', 'priority', 'run_at', 'id', postgresql_where=db.text("status = 'queued'")),
+        # Running jobs are checked for expired leases, finished ones for pruning
+        db.Index('ix_job_status_locked_until', 'status', 'locked_until'),
+        db.Index('ix_job_status_finished_at', 'status', 'finished_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.kind}, Status {self.status}, Attempts {self.attempts}>"
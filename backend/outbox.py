@@ -0,0 +1,214 @@
+import datetime
+import random
+import threading
+from flask import current_app
+from sqlalchemy import delete, or_, select
+from db import db
+from models import AudioFile, Blob, Rendition, S3Deletion
+from config import Config
+from s3_client import s3_client, delete_objects
+
+def s3_deletions(s3_bucket, keys):
+    """
+    Builds the outbox rows for deleting the given objects, to be added to the session in the same
+    transaction as the delete of the rows that referenced them.
+
+    Returns:
+        list: An S3Deletion per distinct key, due straight away.
+    """
+    now = datetime.datetime.utcnow()
+    return [S3Deletion(s3_bucket=s3_bucket, s3_key=key, attempts=0, next_attempt_at=now) for key in dict.fromkeys(keys)]
+
+def enqueue_s3_deletions(s3_bucket, keys):
+    """Queues the deletion of the given objects in the current transaction. Does not commit."""
+    db.session.add_all(s3_deletions(s3_bucket, keys))
+
+def cancel_s3_deletions_statement(s3_bucket, s3_key):
+    """
+    Builds the DELETE of the pending deletions of an object and of the renditions and peaks derived from its
+    key, see cancel_s3_deletions.
+    """
+    return delete(S3Deletion).where(
+        S3Deletion.s3_bucket == s3_bucket,
+        or_(
+            S3Deletion.s3_key == s3_key,
+            S3Deletion.s3_key.startswith(f"renditions/{s3_key}/", autoescape=True),
+            S3Deletion.s3_key == f"peaks/{s3_key}.dat",
+        )
+    )
+
+def cancel_s3_deletions(s3_bucket, s3_key):
+    """
+    Drops the pending deletions of content that is about to be stored again under a key it was released from,
+    along with those of its renditions and peaks, which will be produced again at ingest. The DELETE waits
+    for a worker that has already claimed them to finish, so the content is only stored once the old
+    objects are gone. Does not commit.
+    """
+    db.session.execute(cancel_s3_deletions_statement(s3_bucket, s3_key))
+
+def retry_delay(attempts):
+    """Returns the delay before the next attempt of a deletion that has failed attempts times, with jitter."""
+    delay = min(Config.S3_DELETION_RETRY_BASE_SECONDS * 2 ** (attempts - 1), Config.S3_DELETION_RETRY_MAX_SECONDS)
+    return datetime.timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+def drain_s3_deletions(batch_size=None, client=None):
+    """
+    Carries out one batch of the deletions that are due: objects are deleted with one DeleteObjects request
+    per bucket, and incomplete multipart uploads are aborted. The batch is claimed with FOR UPDATE SKIP LOCKED,
+    so several workers can drain the outbox at once. Failed deletions are retried with exponential backoff.
+
+    Args:
+        batch_size (int): Maximum number of deletions carried out, defaults to Config.S3_DELETION_BATCH_SIZE.
+        client: The S3 client to delete with, defaults to the shared s3_client.
+
+    Returns:
+        tuple: (number of deletions done, number that failed and were rescheduled)
+    """
+    batch_size = batch_size or Config.S3_DELETION_BATCH_SIZE
+    client = client or s3_client
+    now = datetime.datetime.utcnow()
+    deletions = S3Deletion.query.filter(S3Deletion.next_attempt_at <= now).order_by(S3Deletion.id).limit(batch_size).with_for_update(skip_locked=True).all()
+
+    errors = {}
+    keys_by_bucket = {}
+    for deletion in deletions:
+        if deletion.s3_upload_id:
+            try:
+                client.abort_multipart_upload(Bucket=deletion.s3_bucket, Key=deletion.s3_key, UploadId=deletion.s3_upload_id)
+            except client.exceptions.NoSuchUpload:
+                pass
+            except Exception as e:
+                errors[deletion.id] = str(e)
+        else:
+            keys_by_bucket.setdefault(deletion.s3_bucket, []).append(deletion)
+    for s3_bucket, bucket_deletions in keys_by_bucket.items():
+        try:
+            key_errors = delete_objects(s3_bucket, [deletion.s3_key for deletion in bucket_deletions], client)
+        except Exception as e:
+            key_errors = {deletion.s3_key: str(e) for deletion in bucket_deletions}
+        for deletion in bucket_deletions:
+            if deletion.s3_key in key_errors:
+                errors[deletion.id] = key_errors[deletion.s3_key]
+
+    done = [deletion.id for deletion in deletions if deletion.id not in errors]
+    if done:
+        S3Deletion.query.filter(S3Deletion.id.in_(done)).delete(synchronize_session=False)
+    for deletion in deletions:
+        if deletion.id in errors:
+            deletion.attempts += 1
+            deletion.last_error = errors[deletion.id]
+            deletion.next_attempt_at = now + retry_delay(deletion.attempts)
+    db.session.commit()
+    return len(done), len(errors)
+
+def referenced_keys(s3_bucket, keys):
+    """
+    Returns the subset of keys in a bucket that the database still references: originals of audio files
+    (blob keys, or the uuid keys of uploads from before deduplication), blobs, renditions, peaks of existing
+    audio files, and objects whose deletion is already queued.
+    """
+    referenced = set(db.session.scalars(select(AudioFile.s3_key).where(AudioFile.s3_bucket == s3_bucket, AudioFile.s3_key.in_(keys))))
+    referenced.update(db.session.scalars(select(Rendition.s3_key).where(Rendition.s3_bucket == s3_bucket, Rendition.s3_key.in_(keys))))
+    referenced.update(db.session.scalars(select(S3Deletion.s3_key).where(S3Deletion.s3_bucket == s3_bucket, S3Deletion.s3_key.in_(keys))))
+
+    # Blobs are looked up by digest, which is their primary key
+    blob_keys = {key.split('/', 1)[1]: key for key in keys if key.startswith('blobs/')}
+    if blob_keys:
+        referenced.update(
+            blob_keys[digest] for digest in db.session.scalars(select(Blob.digest).where(Blob.digest.in_(blob_keys)))
+        )
+
+    # Peaks are derived from the key of their audio file, which is indexed
+    peaks_keys = {key[len('peaks/'):-len('.dat')]: key for key in keys if key.startswith('peaks/') and key.endswith('.dat')}
+    if peaks_keys:
+        referenced.update(
+            peaks_keys[s3_key] for s3_key in db.session.scalars(
+                select(AudioFile.s3_key).where(AudioFile.s3_bucket == s3_bucket, AudioFile.s3_key.in_(peaks_keys))
+            )
+        )
+    return referenced
+
+def reconcile_bucket(s3_bucket, min_age_seconds=None, dry_run=False, client=None):
+    """
+    Lists a bucket page by page and queues the deletion of every object the database does not reference,
+    such as objects left behind by deletes from before the outbox or by failed requests.
+
+    Args:
+        s3_bucket (str): The bucket to reconcile.
+        min_age_seconds (int): Objects modified more recently are skipped, as presigned and chunked uploads
+            are in S3 before their audio file is stored. Defaults to Config.RECONCILE_MIN_AGE_SECONDS.
+        dry_run (bool): Only report the orphaned objects without queueing their deletion.
+        client: The S3 client to list with, defaults to the shared s3_client.
+
+    Returns:
+        list: The keys of the orphaned objects.
+    """
+    min_age_seconds = Config.RECONCILE_MIN_AGE_SECONDS if min_age_seconds is None else min_age_seconds
+    client = client or s3_client
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=min_age_seconds)
+    orphans = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket):
+        keys = [s3_object["Key"] for s3_object in page.get("Contents", []) if s3_object["LastModified"] <= cutoff]
+        if not keys:
+            continue
+        referenced = referenced_keys(s3_bucket, keys)
+        page_orphans = [key for key in keys if key not in referenced]
+        if page_orphans and not dry_run:
+            enqueue_s3_deletions(s3_bucket, page_orphans)
+        db.session.commit()
+        orphans.extend(page_orphans)
+    return orphans
+
+class S3DeletionWorker:
+    """
+    Drains the S3 deletion outbox on a background thread of each worker process. The thread is started
+    by the first notify, which the write paths call after committing deletions, and then also polls every
+    Config.S3_DELETION_POLL_SECONDS for retries and deletions queued by other processes. Set up with
+    init_app like the other extensions.
+    """
+    def __init__(self):
+        self.app = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    def notify(self):
+        """Wakes the worker to carry out deletions that were just committed, starting it on first use."""
+        if self.app is None:
+            return
+        with self._lock:
+            # Threads do not survive a fork, so a forked server process starts its own
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='s3-deletion', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def drain(self):
+        """Carries out every deletion that is due, returning the number done and failed."""
+        total_done = total_failed = 0
+        with self.app.app_context():
+            try:
+                while True:
+                    done, failed = drain_s3_deletions()
+                    total_done += done
+                    total_failed += failed
+                    if done + failed < Config.S3_DELETION_BATCH_SIZE:
+                        break
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.warning(f"Draining the S3 deletion outbox failed: {e}")
+            finally:
+                db.session.remove()
+        return total_done, total_failed
+
+    def run(self):
+        """Drains the outbox whenever notified or the poll interval elapses, forever."""
+        while True:
+            self._wake.clear()
+            self.drain()
+            self._wake.wait(Config.S3_DELETION_POLL_SECONDS)
+
+s3_deletion_worker = S3DeletionWorker()
@@ -0,0 +1,142 @@
+import bcrypt
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from profiling import phase
+
+class PasswordHashPoolFull(Exception):
+    """Raised when every password hashing worker is busy and the queue of waiting requests is full."""
+
+_executor = None
+_executor_lock = threading.Lock()
+# Hashes running or waiting for a worker, bounded so a login storm is rejected quickly instead of piling up
+_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS + Config.PASSWORD_HASH_QUEUE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {"in_flight": 0, "completed": 0, "failed": 0, "rejected": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+          "bulk_completed": 0, "bulk_failed": 0}
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password, hashed_password):
+    return bcrypt.checkpw(password, hashed_password)
+
+def get_executor():
+    """
+    Returns the process pool that runs bcrypt, creating it on first use.
+    Hashing in separate processes keeps the CPU-bound work off the request threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS)
+        return _executor
+
+def _run(fn, *args):
+    """
+    Runs fn on the hashing pool and waits for its result, recording queue depth and latency. Only hashes
+    that returned count as completed and in the latency, those that raised count as failed.
+
+    Raises:
+        PasswordHashPoolFull: If the pool and its queue are already full.
+    """
+    if not _slots.acquire(blocking=False):
+        with _stats_lock:
+            _stats["rejected"] += 1
+        raise PasswordHashPoolFull("Too many password requests, please try again shortly")
+
+    start = time.perf_counter()
+    with _stats_lock:
+        _stats["in_flight"] += 1
+    try:
+        with phase('password'):
+            result = get_executor().submit(fn, *args).result()
+    except BaseException:
+        with _stats_lock:
+            _stats["failed"] += 1
+        raise
+    else:
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            _stats["completed"] += 1
+            _stats["total_seconds"] += elapsed
+            _stats["max_seconds"] = max(_stats["max_seconds"], elapsed)
+        return result
+    finally:
+        with _stats_lock:
+            _stats["in_flight"] -= 1
+        _slots.release()
+
+def hash_password(password):
+    """
+    Hashes a password with bcrypt at the configured cost factor (Config.BCRYPT_ROUNDS).
+
+    Args:
+        password (str): The plain text password.
+
+    Returns:
+        str: The bcrypt hash to store.
+    """
+    return _run(_hashpw, password.encode('utf-8'), Config.BCRYPT_ROUNDS).decode('utf-8')
+
+def hash_passwords(passwords):
+    """
+    Hashes many passwords in parallel on the hashing pool, for bulk imports. At most
+    Config.PASSWORD_HASH_WORKERS of them are submitted at a time, so a login arriving meanwhile
+    waits for at most one hash per worker rather than for the whole batch.
+
+    Args:
+        passwords (list): The plain text passwords.
+
+    Returns:
+        list: Their bcrypt hashes, in the same order.
+    """
+    window = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS)
+    futures = []
+    with phase('password'):
+        for password in passwords:
+            window.acquire()
+            future = get_executor().submit(_hashpw, password.encode('utf-8'), Config.BCRYPT_ROUNDS)
+            future.add_done_callback(lambda future: window.release())
+            futures.append(future)
+        try:
+            hashed_passwords = [future.result().decode('utf-8') for future in futures]
+        finally:
+            # Hashes still running when one raised are counted once they finish
+            for future in futures:
+                future.add_done_callback(_count_bulk_hash)
+    return hashed_passwords
+
+def _count_bulk_hash(future):
+    failed = future.cancelled() or future.exception() is not None
+    with _stats_lock:
+        _stats["bulk_failed" if failed else "bulk_completed"] += 1
+
+def check_password(password, hashed_password):
+    """
+    Checks a plain text password against a stored bcrypt hash.
+
+    Returns:
+        bool: Whether the password matches.
+    """
+    return _run(_checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def needs_rehash(hashed_password):
+    """
+    Returns whether a stored bcrypt hash was created with a different cost factor than Config.BCRYPT_ROUNDS.
+    """
+    try:
+        return int(hashed_password.split('$')[2]) != Config.BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def password_hash_stats():
+    """
+    Returns the number of hashes in flight (running or queued), completed, failed and rejected, and the latency
+    of the completed ones. Hashes of bulk imports are only counted in bulk_completed and bulk_failed.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["average_seconds"] = stats["total_seconds"] / stats["completed"] if stats["completed"] else 0.0
+    return stats
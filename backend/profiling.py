@@ -0,0 +1,376 @@
+import heapq
+import ipaddress
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import request, current_app, g, Response, jsonify
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import Config
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RequestProfile:
+    """
+    Timings of the request being served. S3 calls can be made from the fetch threads, so updates are locked.
+
+    Attributes:
+        phases (dict): Seconds spent in each phase, e.g. 'auth', 'db', 's3' and 'encode'. Phases can overlap,
+            e.g. the principal lookup is counted in both 'auth' and 'db'.
+        db_queries (int): Number of SQL statements executed.
+        s3_calls (int): Number of S3 requests made.
+        s3_bytes (int): Bytes sent to and received from S3.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = Counter()
+        self.db_queries = 0
+        self.s3_calls = 0
+        self.s3_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds, db_queries=0, s3_calls=0, s3_bytes=0):
+        with self._lock:
+            self.phases[phase] += seconds
+            self.db_queries += db_queries
+            self.s3_calls += s3_calls
+            self.s3_bytes += s3_bytes
+
+    def server_timing(self, total):
+        """Returns the Server-Timing header value, durations being in milliseconds."""
+        metrics = [f"total;dur={total * 1000:.1f}"]
+        for phase, seconds in sorted(self.phases.items()):
+            description = ''
+            if phase == 'db':
+                description = f';desc="{self.db_queries} queries"'
+            elif phase == 's3' and self.s3_calls:
+                description = f';desc="{self.s3_calls} requests, {self.s3_bytes} bytes"'
+            metrics.append(f"{phase};dur={seconds * 1000:.1f}{description}")
+        return ', '.join(metrics)
+
+# Profile of the request being served in this context, None outside requests. The fetch threads are given
+# a copy of the request's context, see s3_client.fetch_objects
+current_profile = ContextVar('current_profile', default=None)
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block to the named phase of the current request, if it is profiled."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+def format_labels(labels):
+    """Formats label pairs in the Prometheus text format, escaping their values."""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class Metrics:
+    """Counters and histograms of this process, rendered in the Prometheus text exposition format."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help):
+        self._help[name] = (kind, help)
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self, gauges=()):
+        """
+        Renders every metric, plus the given gauges.
+
+        Args:
+            gauges (iterable): (name, labels, value) of values read at scrape time, such as cache sizes.
+
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), (buckets, count, total) in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+
+        output = []
+        for name in sorted(samples):
+            kind, help = self._help.get(name, ('gauge', name.replace('_', ' ')))
+            output.append(f"# HELP {name} {help}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+metrics = Metrics()
+metrics.describe('audiovault_http_requests_total', 'counter', 'HTTP requests served, by endpoint, method and status.')
+metrics.describe('audiovault_http_request_duration_seconds', 'histogram', 'Time to produce the response, by endpoint.')
+metrics.describe('audiovault_http_request_phase_seconds_total', 'counter', 'Time spent in each phase of requests, by endpoint.')
+metrics.describe('audiovault_db_queries_total', 'counter', 'SQL statements executed.')
+metrics.describe('audiovault_db_query_duration_seconds', 'histogram', 'Duration of SQL statements.')
+metrics.describe('audiovault_s3_requests_total', 'counter', 'S3 requests made, by operation and outcome.')
+metrics.describe('audiovault_s3_request_duration_seconds', 'histogram', 'Duration of S3 requests, by operation.')
+metrics.describe('audiovault_s3_bytes_total', 'counter', 'Bytes sent to and received from S3.')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    metrics.inc('audiovault_db_queries_total')
+    metrics.observe('audiovault_db_query_duration_seconds', (), elapsed)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add('db', elapsed, db_queries=1)
+
+@event.listens_for(Engine, 'handle_error')
+def handle_db_error(exception_context):
+    # Failed statements never reach after_cursor_execute
+    started = exception_context.connection.info.get('query_started') if exception_context.connection is not None else None
+    if started:
+        started.pop()
+
+def before_s3_call(context, **kwargs):
+    context['profiling_started'] = time.perf_counter()
+
+def before_s3_send(request, **kwargs):
+    sent = int(request.headers.get('Content-Length') or 0)
+    if sent:
+        metrics.inc('audiovault_s3_bytes_total', (('direction', 'sent'),), sent)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.add('s3', 0.0, s3_bytes=sent)
+
+def after_s3_call(http_response, parsed, model, context, **kwargs):
+    started = context.get('profiling_started')
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    # Streamed bodies are read after the call, their length is counted from the response headers
+    received = int(http_response.headers.get('content-length') or 0)
+    outcome = 'error' if http_response.status_code >= 400 else 'ok'
+    metrics.inc('audiovault_s3_requests_total', (('operation', model.name), ('outcome', outcome)))
+    metrics.observe('audiovault_s3_request_duration_seconds', (('operation', model.name),), elapsed)
+    if received:
+        metrics.inc('audiovault_s3_bytes_total', (('direction', 'received'),), received)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add('s3', elapsed, s3_calls=1, s3_bytes=received)
+
+def instrument_s3_client(client):
+    """Registers botocore event hooks on an S3 client that count its requests, bytes and latency."""
+    client.meta.events.register('before-call.s3', before_s3_call, unique_id='profiling-before-call')
+    client.meta.events.register('before-send.s3', before_s3_send, unique_id='profiling-before-send')
+    client.meta.events.register('after-call.s3', after_s3_call, unique_id='profiling-after-call')
+
+def collapse_stack(frame):
+    """Returns a stack as a line of the folded format read by flamegraph.pl and speedscope, outermost frame first."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+class StackSampler:
+    """
+    Sampling profiler recording the stacks of the threads serving profiled requests every interval.
+    Its thread only runs while requests are being sampled.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, ident):
+        with self._lock:
+            self._samples[ident] = Counter()
+            # Threads do not survive a fork, so a forked server process starts its own
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, ident):
+        """Stops sampling a thread, returning the number of samples of each collapsed stack."""
+        with self._lock:
+            return self._samples.pop(ident, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._samples:
+                    self._thread = None
+                    return
+                for ident, samples in self._samples.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[collapse_stack(frame)] += 1
+
+class SlowestRequests:
+    """Keeps the folded stacks of the slowest requests in a directory, deleting those pushed out by slower ones."""
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+        self._slowest = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def offer(self, duration, endpoint, samples):
+        """Writes the samples of a request if it is one of the slowest so far."""
+        if not samples:
+            return
+        with self._lock:
+            if len(self._slowest) >= self.count and duration <= self._slowest[0][0]:
+                return
+            name = re.sub(r'[^\w.-]', '_', endpoint)
+            path = os.path.join(self.directory, f"{int(time.time() * 1000)}-{os.getpid()}-{name}-{duration * 1000:.0f}ms.folded")
+            with open(path, 'w') as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in samples.most_common())
+            if len(self._slowest) < self.count:
+                heapq.heappush(self._slowest, (duration, path))
+            else:
+                _, evicted = heapq.heappushpop(self._slowest, (duration, path))
+                os.remove(evicted)
+
+def collect_stats():
+    """Returns the gauges read from the in-process caches and pools at scrape time."""
+    # Imported here as the routes use phase() from this module
+    from routes.utils import auth_cache_stats
+    from passwords import password_hash_stats
+    from disk_cache import disk_cache
+    from response_cache import response_cache
+
+    gauges = []
+    for cache, stats in auth_cache_stats().items():
+        gauges.extend((f"audiovault_auth_cache_{stat}", (('cache', cache),), value) for stat, value in stats.items())
+    gauges.extend((f"audiovault_password_hash_{stat}", (), value) for stat, value in password_hash_stats().items())
+    gauges.extend((f"audiovault_response_cache_{stat}", (), value) for stat, value in response_cache.stats().items())
+    if disk_cache is not None:
+        gauges.extend((f"audiovault_disk_cache_{stat}", (), value) for stat, value in disk_cache.stats().items())
+    return gauges
+
+def is_local_request(request):
+    """
+    Returns whether the request comes straight from the host itself. Requests passed on by a reverse proxy
+    carry X-Forwarded-For and are not local, even if the proxy runs on the host.
+    """
+    if request.headers.get('X-Forwarded-For'):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+class RequestProfiler:
+    """
+    Times each request and the phases it spends in authentication, SQL statements and S3 requests, adding
+    a Server-Timing header to the response and recording the totals in the metrics served at /metrics.
+    Timings stop when the response is returned, so the transfer of streamed bodies is not included.
+    Optionally samples the stacks of every request and keeps those of the slowest ones for flame graphs.
+    Set up with init_app like the other extensions.
+    """
+    def __init__(self):
+        self.sampler = None
+        self.slowest = None
+
+    def init_app(self, app, s3_client):
+        if not Config.PROFILING_ENABLED:
+            return
+        s3_client.on_create(instrument_s3_client)
+        if Config.PROFILE_SLOWEST_REQUESTS:
+            self.sampler = StackSampler(Config.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+            self.slowest = SlowestRequests(Config.PROFILE_DIR, Config.PROFILE_SLOWEST_REQUESTS)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def start_request(self):
+        g.profile_token = current_profile.set(RequestProfile())
+        if self.sampler:
+            self.sampler.start(threading.get_ident())
+
+    def finish_request(self, response):
+        profile = current_profile.get()
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.started
+        endpoint = request.endpoint or 'unmatched'
+        metrics.inc('audiovault_http_requests_total', (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)))
+        metrics.observe('audiovault_http_request_duration_seconds', (('endpoint', endpoint),), total)
+        for name, seconds in profile.phases.items():
+            metrics.inc('audiovault_http_request_phase_seconds_total', (('endpoint', endpoint), ('phase', name)), seconds)
+        if Config.SERVER_TIMING_ENABLED:
+            response.headers['Server-Timing'] = profile.server_timing(total)
+        if self.sampler:
+            self.slowest.offer(total, endpoint, self.sampler.stop(threading.get_ident()))
+        return response
+
+    def teardown_request(self, exception=None):
+        if self.sampler:
+            self.sampler.stop(threading.get_ident())
+        token = g.pop('profile_token', None)
+        if token is not None:
+            current_profile.reset(token)
+
+    def metrics_view(self):
+        """
+        Serves this process's metrics in the Prometheus text format. If Config.METRICS_TOKEN is set,
+        it must be given as a Bearer token, otherwise only local clients are served, as the metrics
+        show request paths and stack samples.
+        """
+        if Config.METRICS_TOKEN:
+            if request.headers.get('Authorization') != f"Bearer {Config.METRICS_TOKEN}":
+                return jsonify({"error": "Unauthorized"}), 401
+        elif not is_local_request(request):
+            return jsonify({"error": "Set METRICS_TOKEN to read the metrics from another host"}), 403
+        try:
+            gauges = collect_stats()
+        except Exception as e:
+            current_app.logger.warning(f"Collecting cache stats for /metrics failed: {e}")
+            gauges = []
+        return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,85 @@
+from collections import Counter
+from sqlalchemy import select, update
+from db import db
+from models import User
+from config import Config
+from user_summary import user_role, adjust_summary_statement
+
+class QuotaExceeded(Exception):
+    """Raised when storing an audio file would take a user over their file or storage quota."""
+
+def quota_error(file_count, storage_bytes, size):
+    """Returns why a new audio file of the given size does not fit the quotas, or None if it does."""
+    if Config.USER_FILE_QUOTA and file_count >= Config.USER_FILE_QUOTA:
+        return f"File quota of {Config.USER_FILE_QUOTA} audio files reached"
+    if Config.USER_STORAGE_QUOTA_BYTES and storage_bytes + size > Config.USER_STORAGE_QUOTA_BYTES:
+        return f"Storage quota of {Config.USER_STORAGE_QUOTA_BYTES} bytes exceeded"
+    return None
+
+def check_quota(user_id, size):
+    """
+    Checks that a new audio file of the given size fits the user's quotas before it is uploaded,
+    reading the user's counters. charge_quota remains the authoritative check.
+
+    Raises:
+        QuotaExceeded: If it does not fit.
+    """
+    counters = db.session.execute(select(User.file_count, User.storage_bytes).where(User.id == user_id)).first()
+    error = counters and quota_error(counters.file_count, counters.storage_bytes, size)
+    if error:
+        raise QuotaExceeded(error)
+
+def charge_quota_statement(user_id, size, enforce=True):
+    """
+    Builds the UPDATE counting a new audio file against the user's counters, which only matches if the
+    file fits the quotas so concurrent uploads cannot overshoot them, see charge_quota.
+    """
+    statement = update(User).where(User.id == user_id).values(
+        file_count=User.file_count + 1,
+        storage_bytes=User.storage_bytes + size
+    ).execution_options(synchronize_session=False)
+    if enforce and Config.USER_FILE_QUOTA:
+        statement = statement.where(User.file_count < Config.USER_FILE_QUOTA)
+    if enforce and Config.USER_STORAGE_QUOTA_BYTES:
+        statement = statement.where(User.storage_bytes + size <= Config.USER_STORAGE_QUOTA_BYTES)
+    return statement
+
+def charge_quota(user_id, size, enforce=True):
+    """
+    Counts a new audio file of the given size against the user's quotas with a single conditional UPDATE,
+    and adds it to the totals of the user's role. Must be in the transaction that stores the audio file.
+    Does not commit.
+
+    Args:
+        user_id (str): ID of the user storing the audio file.
+        size (int): Size of the audio file in bytes.
+        enforce (bool): Whether to refuse files that do not fit, otherwise they are only counted.
+
+    Raises:
+        QuotaExceeded: If the file does not fit the quotas.
+    """
+    if not db.session.execute(charge_quota_statement(user_id, size, enforce)).rowcount:
+        check_quota(user_id, size)
+        # The counters changed since the UPDATE, report the quotas anyway
+        raise QuotaExceeded("Quota exceeded")
+    db.session.execute(adjust_summary_statement(user_role(user_id), files=1, storage_bytes=size))
+
+def release_quota_statements(audio_files):
+    """Builds the UPDATEs removing deleted audio files from their users' counters and the totals of their roles, two per user."""
+    file_counts = Counter(audio_file.user_id for audio_file in audio_files)
+    sizes = Counter()
+    for audio_file in audio_files:
+        sizes[audio_file.user_id] += audio_file.size or 0
+    statements = []
+    for user_id, file_count in file_counts.items():
+        statements.append(update(User).where(User.id == user_id).values(
+            file_count=User.file_count - file_count,
+            storage_bytes=User.storage_bytes - sizes[user_id]
+        ).execution_options(synchronize_session=False))
+        statements.append(adjust_summary_statement(user_role(user_id), files=-file_count, storage_bytes=-sizes[user_id]))
+    return statements
+
+def release_quota(audio_files):
+    """Removes deleted audio files from their users' counters. Does not commit."""
+    for statement in release_quota_statements(audio_files):
+        db.session.execute(statement)
@@ -0,0 +1,294 @@
+import logging
+import math
+import os
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlparse
+from flask import request, jsonify, current_app
+from config import Config
+from routes.utils import decode_token
+
+logger = logging.getLogger(__name__)
+
+# A token bucket: requests are counted per 'user' or per client 'ip', refilled at rate tokens per second
+# up to burst tokens
+RateLimit = namedtuple('RateLimit', ['scope', 'rate', 'burst'])
+
+PERIOD_SECONDS = {'s': 1, 'm': 60, 'h': 3600}
+
+def parse_rate_limits(spec):
+    """
+    Parses the RATE_LIMITS setting into the limits of each rule.
+
+    The setting is a ';' separated list of rules 'name=limit,limit...', where the name is 'default', the
+    name of a blueprint (e.g. 'audiofiles') or of an endpoint (e.g. 'utils.login'), and each limit is
+    'scope:count/period[:burst]' with scope 'user' or 'ip' and period 's', 'm' or 'h'. The burst defaults
+    to the count. For example 'default=user:20/s:100,ip:50/s;utils.login=ip:10/m'.
+
+    Returns:
+        dict: The list of RateLimit of each rule name.
+
+    Raises:
+        ValueError: If the setting is malformed.
+    """
+    rules = {}
+    for rule in filter(None, (rule.strip() for rule in spec.split(';'))):
+        name, _, limits = rule.partition('=')
+        rules[name.strip()] = []
+        for limit in limits.split(','):
+            match = re.fullmatch(r'\s*(user|ip):(\d+)/([smh])(?::(\d+))?\s*', limit)
+            if not match:
+                raise ValueError(f"Invalid rate limit '{limit}' for '{name}'")
+            scope, count, period, burst = match.groups()
+            rules[name.strip()].append(RateLimit(scope, int(count) / PERIOD_SECONDS[period], int(burst or count)))
+    return rules
+
+class MemoryBackend:
+    """
+    Token buckets held in this process, so each worker process enforces the limits separately.
+    The least recently used buckets are dropped beyond max_keys, which resets them to full.
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1):
+        """
+        Takes cost tokens from the bucket if it has them.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until the bucket will have them.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+# Token bucket update run atomically by Redis, with the server's clock so every process agrees on time
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + 1) * 1000))
+return tostring(retry_after)
+"""
+
+class RedisError(Exception):
+    """Raised for error replies from the Redis server."""
+
+class RedisConnection:
+    """Minimal client for the Redis protocol (RESP), enough to run the token bucket script."""
+    def __init__(self, url, timeout):
+        parsed = urlparse(url)
+        self.sock = socket.create_connection((parsed.hostname or 'localhost', parsed.port or 6379), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        if parsed.password:
+            self.execute('AUTH', *([parsed.username] if parsed.username else []), parsed.password)
+        database = parsed.path.lstrip('/')
+        if database and database != '0':
+            self.execute('SELECT', database)
+
+    def execute(self, *args):
+        """Sends a command and returns its reply."""
+        command = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            arg = str(arg).encode()
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b''.join(command))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the Redis server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            raise RedisError(value.decode())
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if value == b'-1':
+                return None
+            data = self.reader.read(int(value) + 2)
+            return data[:-2].decode()
+        if kind == b'*':
+            if value == b'-1':
+                return None
+            return [self._read_reply() for _ in range(int(value))]
+        raise ConnectionError(f"Unexpected reply from the Redis server: {line!r}")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class RedisBackend:
+    """
+    Token buckets shared by every process through a Redis compatible server, each update being a single
+    script call. Keeps one connection per thread, reconnected after a failure or in a forked worker.
+    """
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+        self._script_sha = None
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = None
+            self._local.pid = os.getpid()
+        if self._local.connection is None:
+            self._local.connection = RedisConnection(self.url, self.timeout)
+        return self._local.connection
+
+    def consume(self, key, rate, burst, cost=1):
+        """Takes cost tokens from the bucket if it has them, see MemoryBackend.consume."""
+        try:
+            connection = self._connection()
+            if self._script_sha is None:
+                self._script_sha = connection.execute('SCRIPT', 'LOAD', TOKEN_BUCKET_SCRIPT)
+            try:
+                retry_after = connection.execute('EVALSHA', self._script_sha, 1, key, rate, burst, cost)
+            except RedisError as e:
+                if not str(e).startswith('NOSCRIPT'):
+                    raise
+                # The server restarted and lost its script cache
+                retry_after = connection.execute('EVAL', TOKEN_BUCKET_SCRIPT, 1, key, rate, burst, cost)
+            return float(retry_after)
+        except (OSError, RedisError):
+            connection = getattr(self._local, 'connection', None)
+            self._local.connection = None
+            if connection is not None:
+                connection.close()
+            raise
+
+class RateLimiter:
+    """
+    Rate limits requests with token buckets per authenticated user and per client IP. The limits of the
+    endpoint's rule apply if there is one, otherwise those of its blueprint, otherwise the default ones.
+    Requests over a limit get a 429 with a Retry-After header. If the shared backend cannot be reached,
+    requests are let through rather than failed. Set up with init_app like the other extensions.
+    """
+    def __init__(self):
+        self.backend = None
+        self.rules = {}
+
+    def init_app(self, app):
+        if not Config.RATE_LIMIT_ENABLED:
+            return
+        self.rules = parse_rate_limits(Config.RATE_LIMITS)
+        if Config.RATE_LIMIT_BACKEND == 'redis':
+            self.backend = RedisBackend(Config.RATE_LIMIT_REDIS_URL, Config.RATE_LIMIT_REDIS_TIMEOUT_MS / 1000)
+        else:
+            self.backend = MemoryBackend(Config.RATE_LIMIT_MEMORY_MAX_KEYS)
+        app.before_request(self.limit_request)
+
+    def rule_for(self, endpoint):
+        """Returns the name of the rule that applies to an endpoint, or None if no limits apply."""
+        if endpoint in self.rules:
+            return endpoint
+        blueprint = endpoint.rpartition('.')[0]
+        if blueprint in self.rules:
+            return blueprint
+        return 'default' if 'default' in self.rules else None
+
+    def check(self, endpoint, user_id, ip):
+        """
+        Takes a token from each bucket the request is counted in, stopping at the first one that is empty
+        so a rejected request does not use up the buckets after it. The tokens already taken from the
+        buckets before it are not given back.
+
+        Args:
+            endpoint (str): The endpoint the request was routed to.
+            user_id (str): ID of the authenticated user, or None for anonymous requests.
+            ip (str): The client's IP address.
+
+        Returns:
+            float: 0 if the request is allowed, otherwise the seconds to wait before retrying.
+        """
+        rule = self.rule_for(endpoint) if self.backend and endpoint else None
+        if rule is None:
+            return 0.0
+        for limit in self.rules[rule]:
+            identity = user_id if limit.scope == 'user' else ip
+            if identity is None:
+                continue
+            key = f"ratelimit:{rule}:{limit.scope}:{identity}"
+            try:
+                retry_after = self.backend.consume(key, limit.rate, limit.burst)
+            except (OSError, RedisError) as e:
+                logger.warning(f"Rate limiting backend unavailable, letting the request through: {e}")
+                continue
+            if retry_after:
+                return retry_after
+        return 0.0
+
+    def limit_request(self):
+        """before_request hook rejecting requests over their limits."""
+        if request.method == 'OPTIONS':
+            return None
+        retry_after = self.check(request.endpoint, request_user_id(request, current_app.config['SECRET_KEY']), client_ip(request))
+        if retry_after:
+            seconds = retry_after_seconds(retry_after)
+            return jsonify({"error": f"Too many requests, retry after {seconds} seconds"}), 429, {"Retry-After": str(seconds)}
+        return None
+
+def request_user_id(request, secret_key):
+    """
+    Returns the user id from the request's Authorization header, or None if it has no valid token. Tokens in
+    the query string of media routes are not used, so those requests are only limited per client IP.
+    """
+    token = request.headers.get('Authorization', '').partition(' ')[2]
+    if not token:
+        return None
+    try:
+        return decode_token(token, secret_key)['user_id']
+    except Exception:
+        return None
+
+def client_ip(request):
+    """
+    Returns the client's IP address. Behind Config.RATE_LIMIT_TRUSTED_PROXIES reverse proxies it is the address
+    the outermost of them put in X-Forwarded-For, entries before it are set by the client and not trusted.
+    """
+    trusted = Config.RATE_LIMIT_TRUSTED_PROXIES
+    if trusted <= 0:
+        return request.remote_addr
+    forwarded = [ip.strip() for ip in ','.join(request.headers.getlist('X-Forwarded-For')).split(',') if ip.strip()]
+    if len(forwarded) < trusted:
+        # Not sent through all the proxies, the connection's address is the only one known to be genuine
+        return request.remote_addr
+    return forwarded[-trusted]
+
+def retry_after_seconds(retry_after):
+    """Rounds the wait before a limited request can be retried up to the whole seconds of a Retry-After header."""
+    return max(1, math.ceil(retry_after))
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import time
+from functools import wraps
+from flask import request, current_app, Response
+from cache import TTLCache
+from config import Config
+from collection_versions import collection_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content codings offered to clients, in order of preference, each only if its library is installed
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda body: zstandard.ZstdCompressor(level=Config.ZSTD_LEVEL).compress(body)
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=Config.BROTLI_QUALITY)
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, compresslevel=Config.GZIP_LEVEL, mtime=0)
+
+def negotiate_encoding(accept_encodings, size):
+    """
+    Chooses how to encode a response body from the client's Accept-Encoding header.
+
+    Args:
+        accept_encodings: The request's parsed Accept-Encoding header (werkzeug Accept).
+        size (int): Size of the uncompressed body, bodies under Config.COMPRESSION_MIN_BYTES are not compressed.
+
+    Returns:
+        str: The content coding with the highest quality the client accepts, the most compact one on ties,
+        or None to send the body as is.
+    """
+    if size < Config.COMPRESSION_MIN_BYTES:
+        return None
+    chosen, chosen_quality = None, 0
+    for encoding in COMPRESSORS:
+        quality = accept_encodings.quality(encoding)
+        if quality > chosen_quality:
+            chosen, chosen_quality = encoding, quality
+    return chosen
+
+class CachedResponse:
+    """A serialized listing response, with its compressed forms added as clients ask for them."""
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.size = len(body)
+        self._bodies = {None: body}
+
+    def body(self, encoding):
+        """Returns the body in the given content coding, compressing it on first use."""
+        body = self._bodies.get(encoding)
+        if body is None:
+            # Concurrent requests may both compress it, which is harmless
+            body = self._bodies[encoding] = COMPRESSORS[encoding](self._bodies[None])
+        return body
+
+# Serialized responses by (collection, version, URL epoch, path with query string)
+response_cache = TTLCache(Config.RESPONSE_CACHE_SIZE, Config.RESPONSE_CACHE_TTL_SECONDS)
+
+def url_epoch():
+    """
+    Returns the current period in which listings may be served again unchanged. Listings embed presigned URLs
+    when they are enabled, which are reused for at most PRESIGNED_URL_REFRESH_MARGIN_SECONDS once they have
+    that long left to live, so listings are then refreshed that often. Always 0 otherwise.
+    """
+    if not Config.S3_PRESIGNED_URLS:
+        return 0
+    return int(time.time() // Config.PRESIGNED_URL_REFRESH_MARGIN_SECONDS)
+
+def listing_tag(name, version, full_path, max_age=None):
+    """
+    Identifies a listing response by the version of its collection.
+
+    Args:
+        name (str): The collection listed.
+        version (int): Its current version.
+        full_path (str): The request's path and query string, as each page and filter is a different listing.
+        max_age (int): Seconds after which the listing is built again even if its collection was not written
+            to, for listings that also show counters their version does not follow.
+
+    Returns:
+        tuple: The opaque tag of the listing, which changes whenever its collection is written to, and its
+        key in response_cache.
+    """
+    epoch = url_epoch()
+    if max_age:
+        epoch = f"{epoch}-{int(time.time() // max_age)}"
+    digest = hashlib.sha1(f"{name}\n{full_path}".encode('utf-8')).hexdigest()[:16]
+    return f"{version}.{epoch}.{digest}", (name, version, epoch, full_path)
+
+def cache_response(key, body, mimetype):
+    """Wraps a freshly built listing body, keeping it in response_cache unless it is too large to."""
+    cached = CachedResponse(body, mimetype)
+    # Listings with inlined content are too large to keep
+    if cached.size <= Config.RESPONSE_CACHE_MAX_BODY_BYTES:
+        response_cache.set(key, cached)
+    return cached
+
+def cache_headers(etag, encoding=None):
+    """Returns the headers of a listing response, or of the 304 answering a request for it."""
+    headers = {
+        "ETag": f'W/"{etag}"',
+        "Vary": "Accept-Encoding",
+        # Clients may keep the listing but must check it is still current before using it
+        "Cache-Control": "private, no-cache",
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+def versioned_collection(collection, max_age=None):
+    """
+    Decorator for listing routes, placed under token_required, serving their responses by the version of
+    the collection they list. A request whose If-None-Match holds the current tag gets a 304 without the
+    listing being built. Otherwise the serialized response is served from response_cache if it was already
+    built for this version, and compressed as the client accepts.
+
+    Args:
+        collection (function): Returns the name of the collection listed, given the current user.
+        max_age (int): Seconds after which the listing is built again anyway, see listing_tag.
+
+    Returns:
+        function: The decorator.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            name = collection(current_user)
+            # Read before the listing is built, so a write committed in between can only make the listing
+            # newer than its version, which the next request then replaces
+            version = collection_version(name)
+            etag, key = listing_tag(name, version, request.full_path, max_age)
+            if request.if_none_match.contains_weak(etag):
+                return Response(status=304, headers=cache_headers(etag))
+
+            cached = response_cache.get(key)
+            if cached is None:
+                response = current_app.make_response(f(current_user, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                cached = cache_response(key, response.get_data(), response.mimetype)
+
+            encoding = negotiate_encoding(request.accept_encodings, cached.size)
+            return Response(cached.body(encoding), mimetype=cached.mimetype, headers=cache_headers(etag, encoding))
+        return decorated
+    return decorator
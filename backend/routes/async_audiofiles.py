@@ -0,0 +1,503 @@
+from quart import Blueprint, jsonify, request, Response, redirect, current_app
+from quart.wrappers.response import ResponseBody
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from botocore.exceptions import ClientError
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from functools import wraps
+import asyncio
+import mimetypes
+import uuid
+from async_db import async_session
+from async_s3_client import get_async_s3_client
+from routes.utils import Principal, principal_cache, decode_token, encode_cursor, decode_cursor, parse_limit
+from routes.audiofiles import serialize_audiofile, get_presigned_url, forget_presigned_urls, derived_s3_keys, read_cached_audiofile, cached_audiofile_headers, STREAM_CHUNK_SIZE, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from outbox import s3_deletions, cancel_s3_deletions_statement, s3_deletion_worker
+from quotas import QuotaExceeded, quota_error, charge_quota_statement, release_quota_statements
+from user_summary import user_role, adjust_summary_statement
+from transcoding import choose_bitrate
+from ingest import schedule_ingest_statement
+from jobs import job_worker
+from models import AudioFile, User, Blob
+from blobs import ContentNotStored, blob_s3_key, hash_fileobj
+from disk_cache import disk_cache
+from collection_versions import audiofiles_collection, bump_versions_statement, collection_version_statement
+from response_cache import response_cache, listing_tag, cache_response, cache_headers, negotiate_encoding
+from config import Config
+
+# Async versions of the endpoints in routes/audiofiles.py, served by asgi.py with the same routes and JSON contracts
+async_audiofiles_routes = Blueprint('async_audiofiles', __name__)
+
+def async_authenticate(f, allow_query_token):
+    """
+    Async equivalent of routes.utils.authenticate, sharing its token and principal caches.
+    """
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        token = request.headers.get('Authorization')
+        if not token and allow_query_token and request.args.get('token'):
+            # Media elements such as <audio src=...> cannot set headers, see routes.utils.request_token
+            token = f"Bearer {request.args.get('token')}"
+        if not token:
+            return jsonify({"error": "Token is missing"}), 401
+
+        try:
+            data = decode_token(token.split(" ")[1], current_app.config['SECRET_KEY'])
+            current_user = principal_cache.get(data['user_id'])
+            if current_user is None:
+                async with async_session() as session:
+                    user = (await session.execute(select(User).where(User.id == data['user_id']))).scalar_one_or_none()
+                if not user:
+                    raise LookupError("User not found")
+                current_user = Principal(user.id, user.username, user.role)
+                principal_cache.set(user.id, current_user)
+        except Exception:
+            return jsonify({"error": "Your login session has expired please log out and log back in"}), 401
+        return await f(current_user, *args, **kwargs)
+    return decorated
+
+def async_token_required(f):
+    """Async equivalent of routes.utils.token_required."""
+    return async_authenticate(f, allow_query_token=False)
+
+def async_media_token_required(f):
+    """Async equivalent of routes.utils.media_token_required."""
+    return async_authenticate(f, allow_query_token=True)
+
+def async_versioned_collection(collection):
+    """
+    Async equivalent of response_cache.versioned_collection, sharing its response cache.
+    """
+    def decorator(f):
+        @wraps(f)
+        async def decorated(current_user, *args, **kwargs):
+            name = collection(current_user)
+            async with async_session() as session:
+                version = await session.scalar(collection_version_statement(name)) or 0
+            etag, key = listing_tag(name, version, request.full_path)
+            if request.if_none_match.contains_weak(etag):
+                return Response("", status=304, headers=cache_headers(etag))
+
+            cached = response_cache.get(key)
+            if cached is None:
+                response = await current_app.make_response(await f(current_user, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                cached = cache_response(key, await response.get_data(), response.mimetype)
+
+            encoding = negotiate_encoding(request.accept_encodings, cached.size)
+            # Compression is CPU bound, so it runs off the event loop
+            body = await asyncio.to_thread(cached.body, encoding)
+            return Response(body, mimetype=cached.mimetype, headers=cache_headers(etag, encoding))
+        return decorated
+    return decorator
+
+async def bump_versions(session, *names):
+    """Async equivalent of collection_versions.bump_versions. Does not commit."""
+    await session.execute(bump_versions_statement(names, session.bind.dialect.name))
+
+async def fetch_object(s3_client, semaphore, bucket, key):
+    """Reads the content of an S3 object, waiting on the semaphore to bound the number of concurrent reads."""
+    async with semaphore:
+        file_data = await s3_client.get_object(Bucket=bucket, Key=key)
+        async with file_data["Body"] as body:
+            return await body.read()
+
+async def blob_stored(session, digest):
+    """Async equivalent of blobs.blob_stored."""
+    return (await session.execute(select(Blob.digest).where(Blob.digest == digest, Blob.ref_count > 0))).first() is not None
+
+async def prepare_blob_upload(session, s3_bucket, digest):
+    """Async equivalent of blobs.prepare_blob_upload. Commits."""
+    s3_key = blob_s3_key(digest)
+    await session.execute(cancel_s3_deletions_statement(s3_bucket, s3_key))
+    await session.commit()
+    return s3_key
+
+async def add_blob_reference(session, digest, s3_bucket, size, s3_key=None):
+    """Async equivalent of blobs.add_blob_reference."""
+    result = await session.execute(update(Blob).where(Blob.digest == digest).values(ref_count=Blob.ref_count + 1))
+    if result.rowcount:
+        return await session.get(Blob, digest)
+    if s3_key is None:
+        raise ContentNotStored(digest)
+    await session.execute(cancel_s3_deletions_statement(s3_bucket, s3_key))
+    blob = Blob(digest=digest, s3_bucket=s3_bucket, s3_key=s3_key, size=size, ref_count=1)
+    session.add(blob)
+    return blob
+
+async def commit_with_blob_reference(session, reference, store):
+    """Async equivalent of blobs.commit_with_blob_reference, with async reference and store callables."""
+    async def commit():
+        try:
+            await reference(session)
+            await session.commit()
+        except IntegrityError:
+            # Another upload of the same content created the blob first, reference it instead
+            await session.rollback()
+            await reference(session)
+            await session.commit()
+
+    try:
+        await commit()
+    except ContentNotStored:
+        await session.rollback()
+        await store()
+        await commit()
+
+async def discard_stored_blob(session, digest, s3_bucket):
+    """Async equivalent of blobs.discard_stored_blob. Commits."""
+    if await session.get(Blob, digest) is not None:
+        return False
+    session.add_all(s3_deletions(s3_bucket, [blob_s3_key(digest)]))
+    await session.commit()
+    return True
+
+async def release_blob_reference(session, audio_file, derived_keys):
+    """Async equivalent of blobs.plan_blob_release followed by blobs.release_blobs for a single audio file. Does not commit."""
+    if not audio_file.blob_digest:
+        return [audio_file.s3_key] + derived_keys
+    blob = (await session.execute(select(Blob).where(Blob.digest == audio_file.blob_digest).with_for_update())).scalar_one_or_none()
+    if blob is None:
+        return [audio_file.s3_key] + derived_keys
+    blob.ref_count -= 1
+    if blob.ref_count > 0:
+        return []
+    await session.delete(blob)
+    return [blob.s3_key] + derived_keys
+
+async def check_quota(session, user_id, size):
+    """Async equivalent of quotas.check_quota."""
+    counters = (await session.execute(select(User.file_count, User.storage_bytes).where(User.id == user_id))).first()
+    error = counters and quota_error(counters.file_count, counters.storage_bytes, size)
+    if error:
+        raise QuotaExceeded(error)
+
+async def charge_quota(session, user_id, size):
+    """Async equivalent of quotas.charge_quota. Does not commit."""
+    if not (await session.execute(charge_quota_statement(user_id, size))).rowcount:
+        await check_quota(session, user_id, size)
+        raise QuotaExceeded("Quota exceeded")
+    await session.execute(adjust_summary_statement(user_role(user_id), files=1, storage_bytes=size))
+
+async def paginate_audiofiles(statement):
+    """
+    Async equivalent of routes.audiofiles.paginate_audiofiles.
+
+    Args:
+        statement: A select of AudioFile already filtered to the rows that should be listed.
+
+    Returns:
+        tuple: The JSON response and status code, 400 if the query parameters are invalid.
+    """
+    try:
+        limit = parse_limit(request.args.get('limit'), DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            file_name, id = decode_cursor(cursor, 2)
+            statement = statement.where(tuple_(AudioFile.file_name, AudioFile.id) > (file_name, id))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    include_content = 'content' in request.args.get('include', '').split(',')
+
+    # Fetch one extra row to know whether there is a next page
+    async with async_session() as session:
+        result = await session.execute(statement.order_by(AudioFile.file_name, AudioFile.id).limit(limit + 1))
+        audio_files = result.scalars().all()
+    next_cursor = None
+    if len(audio_files) > limit:
+        audio_files = audio_files[:limit]
+        next_cursor = encode_cursor(audio_files[-1].file_name, audio_files[-1].id)
+
+    if include_content:
+        s3_client = get_async_s3_client()
+        semaphore = asyncio.Semaphore(Config.S3_FETCH_CONCURRENCY)
+        file_contents = await asyncio.gather(*(
+            fetch_object(s3_client, semaphore, audio_file.s3_bucket, audio_file.s3_key) for audio_file in audio_files
+        ))
+        audio_files_data = [serialize_audiofile(audio_file, file_content) for audio_file, file_content in zip(audio_files, file_contents)]
+    else:
+        audio_files_data = [serialize_audiofile(audio_file) for audio_file in audio_files]
+    return jsonify({"audiofiles": audio_files_data, "next_cursor": next_cursor}), 200
+
+@async_audiofiles_routes.route('/audiofiles', methods=['POST'])
+@async_token_required
+async def create_audiofile(current_user):
+    """
+    Creates a new audio file, uploads it to an S3 bucket, and also stores the file information in the database.
+    See routes.audiofiles.create_audiofile.
+    """
+    files = await request.files
+    if 'file' not in files:
+        return jsonify({"error": "No file part"}), 400
+    file = files['file']
+
+    if file.filename == '':
+        return jsonify({"error": "No selected file"}), 400
+
+    filename = file.filename
+    s3_bucket = Config.S3_BUCKET
+    id = str(uuid.uuid4())
+    # Keys uploaded by store, deleted again if the audio file cannot be committed
+    stored = []
+
+    try:
+        # Hashing is CPU bound, so it runs off the event loop
+        digest, size = await asyncio.to_thread(hash_fileobj, file.stream)
+        async with async_session() as session:
+            await check_quota(session, current_user.id, size)
+            content_stored = await blob_stored(session, digest)
+
+        async def store():
+            async with async_session() as session:
+                s3_key = await prepare_blob_upload(session, s3_bucket, digest)
+            await get_async_s3_client().put_object(
+                Bucket=s3_bucket,
+                Key=s3_key,
+                Body=file.stream,
+                ContentType=file.mimetype or "application/octet-stream"
+            )
+            stored.append(s3_key)
+
+        # Uploaded before the transaction storing the audio file, see routes.audiofiles.create_audiofile
+        if not content_stored:
+            await store()
+
+        async def reference(session):
+            await charge_quota(session, current_user.id, size)
+            blob = await add_blob_reference(session, digest, s3_bucket, size, stored[0] if stored else None)
+            session.add(AudioFile(
+                id=id, file_name=filename, s3_bucket=blob.s3_bucket, s3_key=blob.s3_key, user_id=current_user.id,
+                size=size, checksum=digest, blob_digest=digest
+            ))
+            await bump_versions(session, audiofiles_collection(current_user.id))
+            await session.execute(schedule_ingest_statement(id, session.bind.dialect.name))
+
+        async with async_session() as session:
+            await commit_with_blob_reference(session, reference, store)
+        job_worker.notify()
+
+        return jsonify({"message": f"Audio file {filename} uploaded successfully!"}), 201
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        # The content was uploaded but no blob was committed for it
+        if stored:
+            async with async_session() as session:
+                if await discard_stored_blob(session, digest, s3_bucket):
+                    s3_deletion_worker.notify()
+        return jsonify({"error": str(e)}), 500
+
+@async_audiofiles_routes.route('/audiofiles', methods=['GET'])
+@async_token_required
+@async_versioned_collection(lambda user: audiofiles_collection(user.id))
+async def get_audiofiles(current_user):
+    """
+    Retrieves a page of the audio files uploaded by the authenticated user, ordered by file name.
+    See routes.audiofiles.get_audiofiles.
+    """
+    return await paginate_audiofiles(select(AudioFile).where(AudioFile.user_id == current_user.id))
+
+@async_audiofiles_routes.route('/audiofiles/favourites', methods=['GET'])
+@async_token_required
+@async_versioned_collection(lambda user: audiofiles_collection(user.id))
+async def get_favourite_audiofiles(current_user):
+    """
+    Retrieves a page of the audio files that the authenticated user has marked as liked (favourites).
+    See routes.audiofiles.get_favourite_audiofiles.
+    """
+    return await paginate_audiofiles(select(AudioFile).where(AudioFile.user_id == current_user.id, AudioFile.liked.is_(True)))
+
+class CachedFileBody(ResponseBody):
+    """
+    Response body reading a file already opened by the disk cache, in threads so the event loop is not
+    blocked. Keeping the open file means it stays readable even if it is evicted before it is sent.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.begin = 0
+        self.end = size
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.file.seek, self.begin)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.file.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        remaining = self.end - self.file.tell()
+        chunk = await asyncio.to_thread(self.file.read, min(STREAM_CHUNK_SIZE, remaining)) if remaining > 0 else b""
+        if not chunk:
+            raise StopAsyncIteration()
+        return chunk
+
+    async def make_conditional(self, begin, end):
+        self.begin = begin
+        self.end = self.size if end is None else min(self.size, end)
+        if begin >= self.end or abs(begin) > self.size:
+            raise RequestedRangeNotSatisfiable()
+        return self.size
+
+async def send_cached_audiofile(cached, audio_file, rendition):
+    """Serves an audio file from the local disk cache. See routes.audiofiles.send_cached_audiofile."""
+    content_type, headers = cached_audiofile_headers(cached, audio_file, rendition)
+    response = Response(CachedFileBody(cached.file, cached.size), mimetype=content_type, headers=headers)
+    response.content_length = cached.size
+    try:
+        response = await response.make_conditional(request, accept_ranges=True, complete_length=cached.size)
+    except RequestedRangeNotSatisfiable:
+        cached.file.close()
+        return jsonify({"error": "Requested range not satisfiable"}), 416
+    if response.status_code in (304, 412):
+        # The body was replaced, the cached file is never read
+        cached.file.close()
+    else:
+        disk_cache.record_bytes_served(response.content_length or 0)
+    return response
+
+@async_audiofiles_routes.route('/audiofiles/<id>/stream', methods=['GET'])
+@async_media_token_required
+async def stream_audiofile(current_user, id):
+    """
+    Streams the content of an audio file from S3 in fixed-size chunks without holding a thread
+    for the duration of the transfer. routes.audiofiles.stream_audiofile is the canonical
+    implementation and documents the behaviour, this one mirrors it: files are read through the
+    local disk cache when it is enabled, with the same helpers.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(AudioFile).options(selectinload(AudioFile.renditions)).where(AudioFile.id == id, AudioFile.user_id == current_user.id)
+        )
+        audio_file = result.scalar_one_or_none()
+    if not audio_file:
+        return jsonify({"error": "Audio file not found"}), 404
+
+    ready_renditions = {rendition.bitrate: rendition for rendition in audio_file.renditions if rendition.status == 'ready'}
+    rendition = ready_renditions.get(choose_bitrate(list(ready_renditions), request.args, request.headers))
+    if Config.S3_PRESIGNED_URLS:
+        return redirect(get_presigned_url(audio_file, rendition), 302)
+
+    s3_object = rendition or audio_file
+    # A miss fills the cache from S3 with blocking reads, it runs in a thread
+    cached, error = await asyncio.to_thread(read_cached_audiofile, s3_object)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    if cached:
+        return await send_cached_audiofile(cached, audio_file, rendition)
+
+    get_object_args = {"Bucket": s3_object.s3_bucket, "Key": s3_object.s3_key}
+    # Only a single byte range is forwarded to S3, multi-range requests are served in full
+    if request.range and len(request.range.ranges) == 1:
+        get_object_args["Range"] = request.range.to_header()
+    if request.if_none_match:
+        get_object_args["IfNoneMatch"] = request.headers.get('If-None-Match')
+
+    try:
+        file_data = await get_async_s3_client().get_object(**get_object_args)
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        if error_code in ("304", "NotModified"):
+            return Response("", status=304, headers={"ETag": request.headers.get('If-None-Match')})
+        if error_code == "InvalidRange":
+            return jsonify({"error": "Requested range not satisfiable"}), 416
+        if error_code in ("404", "NoSuchKey"):
+            return jsonify({"error": "Audio file content not found"}), 404
+        return jsonify({"error": str(e)}), 500
+
+    if rendition:
+        content_type = rendition.content_type
+    else:
+        content_type = mimetypes.guess_type(audio_file.file_name)[0] or file_data.get("ContentType") or "application/octet-stream"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(file_data["ContentLength"]),
+        "ETag": file_data["ETag"],
+        "Cache-Control": "private, no-cache",
+    }
+    status = 200
+    if file_data.get("ContentRange"):
+        headers["Content-Range"] = file_data["ContentRange"]
+        status = 206
+
+    async def generate():
+        async with file_data["Body"] as body:
+            async for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                yield chunk
+
+    return Response(generate(), status=status, headers=headers, mimetype=content_type)
+
+@async_audiofiles_routes.route('/audiofiles/<id>', methods=['DELETE'])
+@async_token_required
+async def delete_audiofile(current_user, id):
+    """
+    Deletes an audio file from the database, queueing the deletion of its objects from the S3 bucket.
+    See routes.audiofiles.delete_audiofile.
+    """
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                select(AudioFile).options(selectinload(AudioFile.renditions)).where(AudioFile.id == id, AudioFile.user_id == current_user.id)
+            )
+            audio_file = result.scalar_one_or_none()
+
+            if not audio_file:
+                return jsonify({"error": "Audio file not found or you do not have permission to delete it"}), 404
+
+            derived_keys = derived_s3_keys(audio_file)
+            # Remove the audio file before the blob it references
+            await session.delete(audio_file)
+            await session.flush()
+            s3_keys = await release_blob_reference(session, audio_file, derived_keys)
+            session.add_all(s3_deletions(audio_file.s3_bucket, s3_keys))
+            for statement in release_quota_statements([audio_file]):
+                await session.execute(statement)
+            await bump_versions(session, audiofiles_collection(current_user.id))
+            await session.commit()
+        forget_presigned_urls(audio_file)
+        if disk_cache is not None:
+            for key in s3_keys:
+                disk_cache.discard(audio_file.s3_bucket, key)
+        s3_deletion_worker.notify()
+
+        return jsonify({"message": f"Audio file {audio_file.file_name} deleted successfully!"}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@async_audiofiles_routes.route('/audiofiles/<id>/like', methods=['PATCH'])
+@async_token_required
+async def handle_like_file(current_user, id):
+    """
+    Allows the authenticated user to like or unlike their own audio file. See routes.audiofiles.handle_like_file.
+    """
+    try:
+        async with async_session() as session:
+            result = await session.execute(select(AudioFile).where(AudioFile.id == id, AudioFile.user_id == current_user.id))
+            audio_file = result.scalar_one_or_none()
+
+            if not audio_file:
+                return jsonify({"error": "Audio file not found"}), 404
+
+            liked_status = (await request.get_json()).get('liked')
+
+            if liked_status is None:
+                return jsonify({"error": "Liked status must be provided"}), 400
+
+            audio_file.liked = liked_status
+            await bump_versions(session, audiofiles_collection(current_user.id))
+            await session.commit()
+
+        return jsonify({
+            "id": audio_file.id,
+            "liked": audio_file.liked
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -1,13 +1,174 @@
-from flask import Blueprint, jsonify, request
-import uuid
+from flask import Blueprint, jsonify, request, Response, redirect, current_app
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
+from botocore.exceptions import ClientError
+from sqlalchemy import tuple_, update
+from sqlalchemy.orm import selectinload
 import base64
+import click
+import datetime
+import io
+import jwt
+import mimetypes
+import uuid
+import zipfile
 from db import db
-from routes.utils import token_required
+from routes.utils import token_required, media_token_required, encode_cursor, decode_cursor, parse_limit
 from models import AudioFile
-from s3_client import s3_client
+from config import Config
+from s3_client import s3_client, fetch_objects
+from cache import TTLCache
+from disk_cache import disk_cache
+from profiling import phase
+from blobs import hash_fileobj, blob_stored, prepare_blob_upload, add_blob_reference, commit_with_blob_reference, discard_stored_blob, plan_blob_release, release_blobs
+from transcoding import choose_bitrate
+from ingest import schedule_ingest, decode_peaks
+from jobs import job_worker
+from search import search_audiofiles
+from outbox import enqueue_s3_deletions, reconcile_bucket, s3_deletion_worker
+from quotas import QuotaExceeded, check_quota, charge_quota, release_quota
+from collection_versions import audiofiles_collection, bump_versions
+from response_cache import versioned_collection
 
 audiofiles_routes = Blueprint('audiofiles', __name__)
 
+# Size of each chunk piped from the S3 body to the client when streaming audio
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Page sizes for the audio file listings
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Page sizes for search results, kept small as search drives autocomplete
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Maximum number of audio files a batch like or delete can change
+MAX_BATCH_SIZE = 1000
+
+# Presigned GET URLs issued per (audio file, user), kept until shortly before they expire
+presigned_url_cache = TTLCache(
+    Config.PRESIGNED_URL_CACHE_SIZE,
+    Config.PRESIGNED_URL_EXPIRY_SECONDS - Config.PRESIGNED_URL_REFRESH_MARGIN_SECONDS
+)
+
+def get_presigned_url(audio_file, rendition=None):
+    """
+    Returns a short-lived presigned URL to download an audio file, or one of its renditions, directly from S3.
+    URLs are cached per (audio file, user, rendition) so repeated listings do not re-sign them.
+
+    Args:
+        audio_file (AudioFile): The audio file to issue the URL for.
+        rendition (Rendition): The rendition to issue the URL for instead of the original, if any.
+
+    Returns:
+        str: The presigned GET URL.
+    """
+    cache_key = (audio_file.id, audio_file.user_id, rendition.bitrate if rendition else None)
+    url = presigned_url_cache.get(cache_key)
+    if url is None:
+        s3_object = rendition or audio_file
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={"Bucket": s3_object.s3_bucket, "Key": s3_object.s3_key},
+            ExpiresIn=Config.PRESIGNED_URL_EXPIRY_SECONDS
+        )
+        presigned_url_cache.set(cache_key, url)
+    return url
+
+def forget_presigned_urls(audio_file):
+    """Drops the cached presigned URLs of an audio file and its renditions once it is deleted."""
+    for bitrate in [None] + Config.RENDITION_BITRATES:
+        presigned_url_cache.pop((audio_file.id, audio_file.user_id, bitrate))
+
+def derived_s3_keys(audio_file):
+    """Returns the keys of the objects produced from an audio file at ingest (renditions and peaks), to delete along with it."""
+    keys = [rendition.s3_key for rendition in audio_file.renditions]
+    if audio_file.peaks_s3_key:
+        keys.append(audio_file.peaks_s3_key)
+    return keys
+
+def select_rendition(audio_file):
+    """
+    Picks the ready rendition of an audio file matching the current request's hints (see transcoding.choose_bitrate).
+
+    Returns:
+        Rendition: The rendition to serve, or None to serve the original.
+    """
+    ready_renditions = {rendition.bitrate: rendition for rendition in audio_file.renditions if rendition.status == 'ready'}
+    bitrate = choose_bitrate(list(ready_renditions), request.args, request.headers)
+    return ready_renditions.get(bitrate)
+
+def serialize_audiofile(audio_file, file_content=None):
+    """
+    Builds the JSON representation of an audio file for the listing endpoints.
+
+    Args:
+        audio_file (AudioFile): The audio file to serialize.
+        file_content (bytes): The file's content to inline encoded in Base64, if it was requested.
+
+    Returns:
+        dict: The audio file's metadata (size, checksum, duration, sample rate, channels and tags are null until
+        the file has been analysed), plus 'file_content' if given and a presigned
+        'file_url' to play it from when presigned URLs are enabled.
+    """
+    audio_file_data = {
+        "id": audio_file.id,
+        "file_name": audio_file.file_name,
+        "liked": audio_file.liked,
+        "size": audio_file.size,
+        "checksum": audio_file.checksum,
+        "duration": audio_file.duration,
+        "sample_rate": audio_file.sample_rate,
+        "channels": audio_file.channels,
+        "tags": audio_file.tags,
+        "has_peaks": audio_file.peaks_s3_key is not None,
+    }
+    if Config.S3_PRESIGNED_URLS:
+        audio_file_data["file_url"] = get_presigned_url(audio_file)
+    if file_content is not None:
+        with phase('encode'):
+            audio_file_data["file_content"] = base64.b64encode(file_content).decode('utf-8')
+    return audio_file_data
+
+def paginate_audiofiles(query):
+    """
+    Applies keyset pagination on (file_name, id) to an AudioFile query using the 'limit', 'cursor'
+    and 'include' query parameters of the current request, and builds the listing response.
+
+    Args:
+        query: An AudioFile query already filtered to the rows that should be listed.
+
+    Returns:
+        tuple: The JSON response and status code, 400 if the query parameters are invalid.
+    """
+    try:
+        limit = parse_limit(request.args.get('limit'), DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            file_name, id = decode_cursor(cursor, 2)
+            query = query.filter(tuple_(AudioFile.file_name, AudioFile.id) > (file_name, id))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    include_content = 'content' in request.args.get('include', '').split(',')
+
+    # Fetch one extra row to know whether there is a next page
+    audio_files = query.order_by(AudioFile.file_name, AudioFile.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(audio_files) > limit:
+        audio_files = audio_files[:limit]
+        next_cursor = encode_cursor(audio_files[-1].file_name, audio_files[-1].id)
+
+    if include_content:
+        file_contents = fetch_objects((audio_file.s3_bucket, audio_file.s3_key) for audio_file in audio_files)
+        audio_files_data = [serialize_audiofile(audio_file, file_content) for audio_file, file_content in zip(audio_files, file_contents)]
+    else:
+        audio_files_data = [serialize_audiofile(audio_file) for audio_file in audio_files]
+    with phase('encode'):
+        response = jsonify({"audiofiles": audio_files_data, "next_cursor": next_cursor})
+    return response, 200
+
 @audiofiles_routes.route('/audiofiles', methods=['POST'])
 @token_required
 def create_audiofile(current_user):
@@ -21,6 +182,7 @@ def create_audiofile(current_user):
         - On success: JSON message confirming the file was uploaded successfully.
         - On failure:
             - 400 if no file is provided or no file is selected.
+            - 403 if the file would take the user over their file or storage quota.
             - 500 if there was an error during the file upload or database operation.
     """
     if 'file' not in request.files:
@@ -31,94 +193,571 @@ def create_audiofile(current_user):
         return jsonify({"error": "No selected file"}), 400
     
     filename = file.filename
-    s3_bucket = 'audiovault-s3'
+    s3_bucket = Config.S3_BUCKET
     id = str(uuid.uuid4())
-    s3_key = id
+    # Keys uploaded by store, deleted again if the audio file cannot be committed
+    stored = []
     
+    try:
+        # Content is stored once under its digest, a duplicate only costs the hash pass
+        digest, size = hash_fileobj(file.stream)
+        # Refuse files over quota before uploading them, charge_quota settles concurrent uploads
+        check_quota(current_user.id, size)
+
+        def store():
+            s3_key = prepare_blob_upload(s3_bucket, digest)
+            # The transfer runs on s3transfer's threads, outside the request's profile, so it is timed as a whole
+            with phase('s3'):
+                s3_client.upload_fileobj(file.stream, s3_bucket, s3_key, ExtraArgs={"ContentType": file.mimetype or "application/octet-stream"})
+            stored.append(s3_key)
+
+        # Uploaded before the transaction storing the audio file, which then makes no S3 request while it
+        # holds the locks on the user's counters and the role's totals
+        if not blob_stored(digest):
+            store()
+
+        def reference():
+            charge_quota(current_user.id, size)
+            blob = add_blob_reference(digest, s3_bucket, size, stored[0] if stored else None)
+            audio_file = AudioFile(
+                id = id,
+                file_name=filename,
+                s3_bucket=blob.s3_bucket,
+                s3_key=blob.s3_key,
+                user_id=current_user.id,
+                size=size,
+                checksum=digest,
+                blob_digest=digest
+            )
+            db.session.add(audio_file)
+            bump_versions(audiofiles_collection(current_user.id))
+            schedule_ingest(id)
+            return audio_file
+
+        commit_with_blob_reference(reference, store)
+        job_worker.notify()
+        
+        return jsonify({"message": f"Audio file {filename} uploaded successfully!"}), 201
+    except QuotaExceeded as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        db.session.rollback()
+        # The content was uploaded but no blob was committed for it
+        if stored and discard_stored_blob(digest, s3_bucket):
+            s3_deletion_worker.notify()
+        return jsonify({"error": str(e)}), 500
+
+@audiofiles_routes.route('/audiofiles/presigned', methods=['POST'])
+@token_required
+def create_presigned_upload(current_user):
+    """
+    Issues a short-lived presigned URL for uploading a new audio file directly to S3, so the
+    content never passes through the backend. Once the upload has finished the client must
+    call '/audiofiles/presigned/confirm' with the returned upload token to store the audio file.
+
+    Request:
+        - JSON body with the 'file_name' and optionally the 'content_type' of the audio file.
+
+    Response:
+        - On success: JSON with the 'upload_url' to PUT the file to, the headers to send with it
+          and the 'upload_token' to confirm the upload with.
+        - On failure:
+            - 400 if no file name is provided.
+            - 404 if presigned URLs are disabled.
+    """
+    if not Config.S3_PRESIGNED_URLS:
+        return jsonify({"error": "Presigned uploads are disabled"}), 404
+
+    data = request.get_json(silent=True) or {}
+    file_name = data.get('file_name')
+    if not file_name:
+        return jsonify({"error": "File name is required"}), 400
+    content_type = data.get('content_type') or mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+
+    id = str(uuid.uuid4())
+    upload_url = s3_client.generate_presigned_url(
+        'put_object',
+        Params={"Bucket": Config.S3_BUCKET, "Key": id, "ContentType": content_type},
+        ExpiresIn=Config.PRESIGNED_URL_EXPIRY_SECONDS
+    )
+    # Signed so the confirm endpoint can trust the key and owner without storing pending uploads,
+    # valid for longer than the URL so an upload started just before it expires can still be confirmed
+    upload_token = jwt.encode({
+        'audio_file_id': id,
+        'file_name': file_name,
+        'user_id': current_user.id,
+        'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=2 * Config.PRESIGNED_URL_EXPIRY_SECONDS)
+    }, current_app.config['SECRET_KEY'], algorithm="HS256")
+
+    return jsonify({
+        "upload_url": upload_url,
+        "headers": {"Content-Type": content_type},
+        "upload_token": upload_token,
+        "expires_in": Config.PRESIGNED_URL_EXPIRY_SECONDS
+    }), 201
+
+@audiofiles_routes.route('/audiofiles/presigned/confirm', methods=['POST'])
+@token_required
+def confirm_presigned_upload(current_user):
+    """
+    Stores an audio file uploaded directly to S3 through a presigned URL in the database.
+
+    Request:
+        - JSON body with the 'upload_token' returned by '/audiofiles/presigned'.
+
+    Response:
+        - On success: JSON with the id of the new audio file.
+        - On failure:
+            - 400 if the token is invalid, expired, already confirmed or the file was not uploaded.
+            - 403 if the file would take the user over their file or storage quota, it is then deleted.
+            - 404 if presigned URLs are disabled.
+            - 413 if the uploaded file exceeds the maximum size.
+            - 500 if there was an error storing the audio file.
+    """
+    if not Config.S3_PRESIGNED_URLS:
+        return jsonify({"error": "Presigned uploads are disabled"}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = jwt.decode(data.get('upload_token', ''), current_app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.PyJWTError:
+        return jsonify({"error": "Invalid or expired upload token"}), 400
+    if upload['user_id'] != current_user.id:
+        return jsonify({"error": "Invalid or expired upload token"}), 400
+    if AudioFile.query.filter_by(id=upload['audio_file_id']).first():
+        return jsonify({"error": "Upload has already been confirmed"}), 400
+
+    s3_bucket = Config.S3_BUCKET
+    s3_key = upload['audio_file_id']
+    try:
+        uploaded_object = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+    except ClientError:
+        return jsonify({"error": "File has not been uploaded"}), 400
+    if uploaded_object["ContentLength"] > Config.UPLOAD_MAX_SIZE:
+        s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
+        return jsonify({"error": f"Upload exceeds the maximum size of {Config.UPLOAD_MAX_SIZE} bytes"}), 413
+
     try:
         audio_file = AudioFile(
-            id = id,
-            file_name=filename,
+            id=s3_key,
+            file_name=upload['file_name'],
             s3_bucket=s3_bucket,
             s3_key=s3_key,
-            user_id=current_user.id
+            user_id=current_user.id,
+            size=uploaded_object["ContentLength"]
         )
-        s3_client.upload_fileobj(file, s3_bucket, s3_key)
         db.session.add(audio_file)
+        charge_quota(current_user.id, audio_file.size)
+        bump_versions(audiofiles_collection(current_user.id))
+        schedule_ingest(audio_file.id)
         db.session.commit()
-        
-        return jsonify({"message": f"Audio file {filename} uploaded successfully!"}), 201
+        job_worker.notify()
+
+        return jsonify({"id": audio_file.id, "message": f"Audio file {audio_file.file_name} uploaded successfully!"}), 201
+    except QuotaExceeded as e:
+        db.session.rollback()
+        enqueue_s3_deletions(s3_bucket, [s3_key])
+        db.session.commit()
+        s3_deletion_worker.notify()
+        return jsonify({"error": str(e)}), 403
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
-# Endpoint to getch all audiofiles and their information from s3
+# Endpoint to fetch a page of the user's audiofiles and their information
 @audiofiles_routes.route('/audiofiles', methods=['GET'])
 @token_required
+@versioned_collection(lambda user: audiofiles_collection(user.id))
 def get_audiofiles(current_user):
     """
-    Retrieves all audio files uploaded by the authenticated user and their metadata, 
-    including the file content encoded in Base64.
+    Retrieves a page of the audio files uploaded by the authenticated user, ordered by file name.
+    By default only metadata is returned, the audio content itself is served by '/audiofiles/<id>/stream'.
+
+    Request:
+        - Optional 'limit' query parameter with the page size (default 50, max 200).
+        - Optional 'cursor' query parameter with the 'next_cursor' of the previous page.
+        - Optional 'include=content' query parameter to also inline each file's content encoded in Base64.
         
     Response:
-        - On success: JSON containing all the user's audio files, with each file's metadata 
-          and content (encoded in Base64).
-        - On failure: 404 if no audio files are found for the user.
+        - On success: JSON containing the page of the user's audio files and the 'next_cursor'
+          to fetch the following page, which is null on the last page.
+        - On failure: 400 if the limit or cursor is invalid.
     """
-    audio_files = AudioFile.query.filter_by(user_id=current_user.id).order_by(AudioFile.file_name, AudioFile.id).all()
-    audio_files_data = []
-    
-    for audio_file in audio_files:
-        file_data = s3_client.get_object(Bucket=audio_file.s3_bucket, Key=audio_file.s3_key)
-        file_content = file_data["Body"].read()  
-        
-        # Encode the binary content in Base64 for JSON serialization
-        encoded_content = base64.b64encode(file_content).decode('utf-8')
-        
-        audio_files_data.append({
-            "id": audio_file.id,
-            "file_name": audio_file.file_name,
-            "file_content": encoded_content,
-            "liked":audio_file.liked
-        })
-    
-    return jsonify({"audiofiles": audio_files_data}), 200
+    query = AudioFile.query.filter_by(user_id=current_user.id)
+    return paginate_audiofiles(query)
 
 @audiofiles_routes.route('/audiofiles/favourites', methods=['GET'])
 @token_required
+@versioned_collection(lambda user: audiofiles_collection(user.id))
 def get_favourite_audiofiles(current_user):
     """
-    Retrieves all audio files that the authenticated user has marked as liked (favourites),
-    along with their metadata and content (encoded in Base64).
+    Retrieves a page of the audio files that the authenticated user has marked as liked (favourites),
+    ordered by file name. Accepts the same 'limit', 'cursor' and 'include' query parameters as '/audiofiles'.
         
     Response:
-        - On success: JSON containing all the user's favourite audio files, 
-          with each file's metadata and content (encoded in Base64).
-        - On failure: 404 if no favourite audio files are found for the user.
+        - On success: JSON containing the page of the user's favourite audio files and the 'next_cursor'
+          to fetch the following page, which is null on the last page.
+        - On failure: 400 if the limit or cursor is invalid.
     """
-    audio_files = AudioFile.query.filter_by(user_id=current_user.id, liked=True).all()
-    audio_files_data = []
-    
+    query = AudioFile.query.filter_by(user_id=current_user.id, liked=True)
+    return paginate_audiofiles(query)
+
+@audiofiles_routes.route('/audiofiles/search', methods=['GET'])
+@token_required
+@versioned_collection(lambda user: audiofiles_collection(user.id))
+def search_user_audiofiles(current_user):
+    """
+    Searches the authenticated user's audio files by file name and tags (title, artist, album...).
+    Every word of the query matches whole words or word prefixes, so it can be called as the user types,
+    and close spellings also match. Results are ordered by relevance, files whose name starts with the
+    query first.
+
+    Request:
+        - 'q' query parameter with the search text.
+        - Optional 'limit' query parameter with the page size (default 20, max 100).
+        - Optional 'cursor' query parameter with the 'next_cursor' of the previous page.
+
+    Response:
+        - On success: JSON containing the page of matching audio files, each with its relevance 'score',
+          and the 'next_cursor' to fetch the following page, which is null on the last page.
+        - On failure: 400 if the query is empty or the limit or cursor is invalid.
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Search query is required"}), 400
+    try:
+        limit = parse_limit(request.args.get('limit'), DEFAULT_SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+        after = None
+        cursor = request.args.get('cursor')
+        if cursor:
+            score, id = decode_cursor(cursor, 2)
+            after = (float(score), id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = search_audiofiles(current_user.id, query, limit, after)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(repr(results[-1][1]), results[-1][0].id)
+    audio_files_data = [dict(serialize_audiofile(audio_file), score=score) for audio_file, score in results]
+    return jsonify({"audiofiles": audio_files_data, "next_cursor": next_cursor}), 200
+
+def read_cached_audiofile(s3_object):
+    """
+    Reads an audio file or one of its renditions through the local disk cache. This lookup and
+    cached_audiofile_headers are shared by this module's stream_audiofile, the canonical implementation,
+    and the one in routes.async_audiofiles, which runs it in a thread as a miss fetches the object from S3.
+
+    Args:
+        s3_object: The AudioFile or Rendition to read.
+
+    Returns:
+        tuple: The open CachedObject, or None if the cache is disabled or the object is too large for it,
+        and the (error message, status code) to answer with if the object could not be read, or None.
+    """
+    if disk_cache is None:
+        return None, None
+    try:
+        return disk_cache.get(s3_object.s3_bucket, s3_object.s3_key, size=s3_object.size), None
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+            return None, ("Audio file content not found", 404)
+        return None, (str(e), 500)
+
+def cached_audiofile_headers(cached, audio_file, rendition):
+    """Returns the content type and headers an audio file served from the disk cache is sent with."""
+    if rendition:
+        content_type = rendition.content_type
+    else:
+        content_type = mimetypes.guess_type(audio_file.file_name)[0] or cached.content_type or "application/octet-stream"
+    headers = {"Cache-Control": "private, no-cache"}
+    if cached.etag:
+        headers["ETag"] = cached.etag
+    return content_type, headers
+
+def send_cached_audiofile(cached, audio_file, rendition):
+    """
+    Serves an audio file from the local disk cache. Ranges and conditional requests are answered from
+    the cached file, which is handed to the server's file wrapper so it can be sent with sendfile.
+    """
+    content_type, headers = cached_audiofile_headers(cached, audio_file, rendition)
+    response = Response(wrap_file(request.environ, cached.file), mimetype=content_type, headers=headers, direct_passthrough=True)
+    response.content_length = cached.size
+    try:
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=cached.size)
+    except RequestedRangeNotSatisfiable:
+        cached.file.close()
+        return jsonify({"error": "Requested range not satisfiable"}), 416
+    if response.status_code != 304:
+        disk_cache.record_bytes_served(response.content_length or 0)
+    return response
+
+@audiofiles_routes.route('/audiofiles/<id>/stream', methods=['GET'])
+@media_token_required
+def stream_audiofile(current_user, id):
+    """
+    Streams the content of an audio file from S3 in fixed-size chunks, so memory use stays
+    constant regardless of the file size. Supports single byte ranges for seeking and
+    conditional requests through the object's ETag. When the local disk cache is enabled
+    (Config.DISK_CACHE_DIR), files are read through it and served from disk.
+
+    Request:
+        - GET request to '/audiofiles/<id>/stream', where <id> is the audio file ID.
+        - Optional 'quality' query parameter ('low', 'high' or 'original'), 'bitrate' query parameter
+          in kbit/s or 'Save-Data: on' header to be served a compressed rendition instead of the original.
+        - Optional 'Range' header (e.g. 'bytes=0-1023') to fetch part of the file.
+        - Optional 'If-None-Match' header with a previously returned ETag.
+
+    Response:
+        - 200 with the full audio content, or 206 with the requested byte range.
+        - 302 to a presigned S3 URL instead when presigned URLs are enabled.
+        - 304 if the ETag in 'If-None-Match' still matches the stored object.
+        - On failure:
+            - 404 if the audio file is not found or does not belong to the user.
+            - 416 if the requested range cannot be satisfied.
+            - 500 if there was an error reading the file from S3.
+    """
+    audio_file = AudioFile.query.filter_by(id=id, user_id=current_user.id).first()
+    if not audio_file:
+        return jsonify({"error": "Audio file not found"}), 404
+    rendition = select_rendition(audio_file)
+    if Config.S3_PRESIGNED_URLS:
+        return redirect(get_presigned_url(audio_file, rendition), 302)
+
+    s3_object = rendition or audio_file
+    cached, error = read_cached_audiofile(s3_object)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+    if cached:
+        return send_cached_audiofile(cached, audio_file, rendition)
+
+    get_object_args = {"Bucket": s3_object.s3_bucket, "Key": s3_object.s3_key}
+    # Only a single byte range is forwarded to S3, multi-range requests are served in full
+    if request.range and len(request.range.ranges) == 1:
+        get_object_args["Range"] = request.range.to_header()
+    if request.if_none_match:
+        get_object_args["IfNoneMatch"] = request.headers.get('If-None-Match')
+
+    try:
+        file_data = s3_client.get_object(**get_object_args)
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        if error_code in ("304", "NotModified"):
+            return Response(status=304, headers={"ETag": request.headers.get('If-None-Match')})
+        if error_code == "InvalidRange":
+            return jsonify({"error": "Requested range not satisfiable"}), 416
+        if error_code in ("404", "NoSuchKey"):
+            return jsonify({"error": "Audio file content not found"}), 404
+        return jsonify({"error": str(e)}), 500
+
+    if rendition:
+        content_type = rendition.content_type
+    else:
+        content_type = mimetypes.guess_type(audio_file.file_name)[0] or file_data.get("ContentType") or "application/octet-stream"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(file_data["ContentLength"]),
+        "ETag": file_data["ETag"],
+        "Cache-Control": "private, no-cache",
+    }
+    status = 200
+    if file_data.get("ContentRange"):
+        headers["Content-Range"] = file_data["ContentRange"]
+        status = 206
+
+    return Response(
+        file_data["Body"].iter_chunks(STREAM_CHUNK_SIZE),
+        status=status,
+        headers=headers,
+        mimetype=content_type,
+        direct_passthrough=True,
+    )
+
+@audiofiles_routes.route('/audiofiles/<id>/peaks', methods=['GET'])
+@media_token_required
+def get_audiofile_peaks(current_user, id):
+    """
+    Retrieves the waveform peaks of an audio file computed at ingest, so players can draw the
+    waveform without downloading and decoding the audio.
+
+    Request:
+        - GET request to '/audiofiles/<id>/peaks', where <id> is the audio file ID.
+        - Optional 'format=json' query parameter to get a single zoom level as JSON instead of the binary sidecar.
+        - Optional 'samples_per_peak' query parameter with 'format=json' to pick the zoom level, the finest
+          level at or above it is returned (default: the coarsest level).
+
+    Response:
+        - On success: the binary peaks sidecar (see ingest.encode_peaks), or JSON with the 'sample_rate',
+          'channels', 'frames', 'samples_per_peak' and 'data', the interleaved min/max of each peak as 16-bit values.
+        - On failure:
+            - 400 if 'samples_per_peak' is not an integer.
+            - 404 if the audio file is not found, does not belong to the user, or has not been analysed yet.
+            - 500 if there was an error reading the peaks from S3.
+    """
+    audio_file = AudioFile.query.filter_by(id=id, user_id=current_user.id).first()
+    if not audio_file:
+        return jsonify({"error": "Audio file not found"}), 404
+    if not audio_file.peaks_s3_key:
+        return jsonify({"error": "Peaks have not been computed for this audio file yet"}), 404
+
+    samples_per_peak = request.args.get('samples_per_peak')
+    if samples_per_peak is not None:
+        try:
+            samples_per_peak = int(samples_per_peak)
+        except ValueError:
+            return jsonify({"error": "samples_per_peak must be an integer"}), 400
+
+    try:
+        file_data = s3_client.get_object(Bucket=audio_file.s3_bucket, Key=audio_file.peaks_s3_key)
+        content = file_data["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+            return jsonify({"error": "Peaks not found"}), 404
+        return jsonify({"error": str(e)}), 500
+
+    # Peaks never change once computed
+    headers = {"Cache-Control": "private, max-age=86400", "ETag": file_data["ETag"]}
+    if request.args.get('format') != 'json':
+        return Response(content, headers=headers, mimetype='application/octet-stream')
+
+    peaks = decode_peaks(content)
+    levels = peaks["levels"]
+    level_samples_per_peak, level_peaks = levels[-1]
+    if samples_per_peak is not None:
+        level_samples_per_peak, level_peaks = next(
+            (level for level in levels if level[0] >= samples_per_peak), levels[-1]
+        )
+    response = jsonify({
+        "sample_rate": peaks["sample_rate"],
+        "channels": peaks["channels"],
+        "frames": peaks["frames"],
+        "samples_per_peak": level_samples_per_peak,
+        "bits": 16,
+        "data": level_peaks.ravel().tolist(),
+    })
+    response.headers.update(headers)
+    return response
+
+class ZipStream(io.RawIOBase):
+    """
+    Unseekable write-only buffer that a ZipFile writes into while the written bytes are drained
+    chunk by chunk into the response.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+@audiofiles_routes.route('/audiofiles/export', methods=['GET'])
+@token_required
+def export_audiofiles(current_user):
+    """
+    Downloads the authenticated user's audio files as a single ZIP archive. The files are fetched
+    from S3 concurrently and written into the archive in order as they arrive.
+
+    Request:
+        - Optional 'liked=true' query parameter to only export the user's favourites.
+
+    Response:
+        - On success: a ZIP archive containing the user's audio files.
+    """
+    query = AudioFile.query.filter_by(user_id=current_user.id)
+    if request.args.get('liked') == 'true':
+        query = query.filter_by(liked=True)
+    # Copy out the columns needed, the archive is generated after the request's session is closed
+    audio_files = [
+        (audio_file.id, audio_file.file_name, audio_file.s3_bucket, audio_file.s3_key)
+        for audio_file in query.order_by(AudioFile.file_name, AudioFile.id).all()
+    ]
+
+    def generate():
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+            file_contents = fetch_objects((s3_bucket, s3_key) for _, _, s3_bucket, s3_key in audio_files)
+            for (id, file_name, _, _), file_content in zip(audio_files, file_contents):
+                # Prefix with the id as file names are not unique per user
+                archive.writestr(f"{id}_{file_name}", file_content)
+                yield stream.drain()
+        yield stream.drain()
+
+    return Response(generate(), mimetype='application/zip', headers={
+        "Content-Disposition": 'attachment; filename="audiovault-export.zip"',
+    })
+
+def parse_ids(data):
+    """
+    Reads the list of audio file ids from the JSON body of a batch request.
+
+    Returns:
+        list: The ids without duplicates, in the order given.
+
+    Raises:
+        ValueError: If 'ids' is not a non-empty list of strings or has more than MAX_BATCH_SIZE entries.
+    """
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids or not all(isinstance(id, str) for id in ids):
+        raise ValueError("ids must be a non-empty list of audio file ids")
+    if len(ids) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} audio files can be changed at once")
+    return list(dict.fromkeys(ids))
+
+def delete_audiofiles(audio_files):
+    """
+    Deletes audio files from the database and, in the same transaction, queues the deletion of the S3 objects
+    that no remaining audio file references in the outbox, for the background worker to carry out once
+    committed. Does not commit, call forget_deleted_audiofiles after committing.
+
+    Args:
+        audio_files (list): The audio files to delete, with their renditions loaded.
+
+    Returns:
+        dict: The keys queued for deletion for each audio file id.
+    """
+    s3_keys = plan_blob_release(audio_files, {audio_file.id: derived_s3_keys(audio_file) for audio_file in audio_files})
     for audio_file in audio_files:
-        file_data = s3_client.get_object(Bucket=audio_file.s3_bucket, Key=audio_file.s3_key)
-        file_content = file_data["Body"].read()
-        
-        encoded_content = base64.b64encode(file_content).decode('utf-8')
-        
-        audio_files_data.append({
-            "id": audio_file.id,
-            "file_name": audio_file.file_name,
-            "file_content": encoded_content,
-            "liked":audio_file.liked
-        })
-    
-    return jsonify({"audiofiles": audio_files_data}), 200
+        enqueue_s3_deletions(audio_file.s3_bucket, s3_keys[audio_file.id])
+        db.session.delete(audio_file)
+    # Remove the audio files before the blobs they reference
+    db.session.flush()
+    release_blobs(audio_files)
+    release_quota(audio_files)
+    bump_versions(*{audiofiles_collection(audio_file.user_id) for audio_file in audio_files})
+    return s3_keys
+
+def forget_deleted_audiofiles(audio_files, s3_keys):
+    """
+    Drops what is cached about audio files whose deletion was committed, and wakes the outbox worker
+    to delete their objects from S3.
+
+    Args:
+        audio_files (list): The deleted audio files.
+        s3_keys (dict): The keys queued for deletion for each audio file id, as returned by delete_audiofiles.
+    """
+    for audio_file in audio_files:
+        forget_presigned_urls(audio_file)
+        if disk_cache is not None:
+            for key in s3_keys[audio_file.id]:
+                disk_cache.discard(audio_file.s3_bucket, key)
+    s3_deletion_worker.notify()
 
 # Endpoint to delete an audiofile
 @audiofiles_routes.route('/audiofiles/<id>', methods=['DELETE'])
 @token_required
 def delete_audiofile(current_user, id):
     """
-    Deletes an audio file both from the S3 bucket and the database.
+    Deletes an audio file from the database. Its objects are deleted from the S3 bucket in the background.
 
     Request:
         - DELETE request to '/audiofiles/<id>', where <id> is the audio file ID.
@@ -135,15 +774,118 @@ def delete_audiofile(current_user, id):
         if not audio_file:
             return jsonify({"error": "Audio file not found or you do not have permission to delete it"}), 404
         
-        s3_client.delete_object(Bucket=audio_file.s3_bucket, Key=audio_file.s3_key)
-        
-        db.session.delete(audio_file)
+        s3_keys = delete_audiofiles([audio_file])
         db.session.commit()
+        forget_deleted_audiofiles([audio_file], s3_keys)
         
         return jsonify({"message": f"Audio file {audio_file.file_name} deleted successfully!"}), 200
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
-    
+
+@audiofiles_routes.route('/audiofiles/delete', methods=['POST'])
+@token_required
+def batch_delete_audiofiles(current_user):
+    """
+    Deletes several of the authenticated user's audio files at once, in one database transaction.
+    Their objects are deleted from S3 in the background in batches of up to 1000 keys.
+
+    Request:
+        - JSON body with the 'ids' of the audio files to delete (at most 1000).
+
+    Response:
+        - On success: JSON with the number of files 'deleted' and a 'results' entry per id, whose 'status' is
+          'deleted', or 'not_found' if the file does not exist or belongs to another user.
+        - On failure:
+            - 400 if the ids are missing or invalid.
+            - 500 if there was an error during the deletion process.
+    """
+    try:
+        ids = parse_ids(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        audio_files = AudioFile.query.options(selectinload(AudioFile.renditions)).filter(
+            AudioFile.id.in_(ids), AudioFile.user_id == current_user.id
+        ).all()
+        s3_keys = delete_audiofiles(audio_files)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+    forget_deleted_audiofiles(audio_files, s3_keys)
+
+    results = [{"id": id, "status": "deleted" if id in s3_keys else "not_found"} for id in ids]
+    return jsonify({"deleted": len(s3_keys), "results": results}), 200
+
+@audiofiles_routes.cli.command('reconcile')
+@click.option('--bucket', default=None, help="Bucket to reconcile, defaults to S3_BUCKET.")
+@click.option('--dry-run', is_flag=True, help="Only list the orphaned objects.")
+def reconcile_bucket_command(bucket, dry_run):
+    """Queue the deletion of S3 objects that nothing in the database references."""
+    orphans = reconcile_bucket(bucket or Config.S3_BUCKET, dry_run=dry_run)
+    for key in orphans:
+        click.echo(key)
+    if dry_run:
+        click.echo(f"Found {len(orphans)} orphaned objects")
+    else:
+        click.echo(f"Queued the deletion of {len(orphans)} orphaned objects")
+        s3_deletion_worker.drain()
+
+@audiofiles_routes.cli.command('drain-deletions')
+@click.option('--forever', is_flag=True, help="Keep draining the outbox as deletions are queued.")
+def drain_s3_deletions_command(forever):
+    """Carry out the S3 deletions queued in the outbox."""
+    if forever:
+        s3_deletion_worker.run()
+    done, failed = s3_deletion_worker.drain()
+    click.echo(f"Deleted {done} objects, {failed} failed and will be retried")
+
+@audiofiles_routes.route('/audiofiles/like', methods=['PATCH'])
+@token_required
+def batch_like_audiofiles(current_user):
+    """
+    Likes or unlikes several of the authenticated user's audio files with a single UPDATE.
+
+    Request:
+        - JSON body with the 'ids' of the audio files (at most 1000) and the 'liked' status (True/False) to set.
+
+    Response:
+        - On success: JSON with the number of files 'updated' and a 'results' entry per id, whose 'status'
+          is 'updated', or 'not_found' if the file does not exist or belongs to another user.
+        - On failure:
+            - 400 if the ids are missing or invalid, or the liked status is not a boolean.
+            - 500 if there was an error updating the files.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = parse_ids(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    liked_status = data.get('liked')
+    if not isinstance(liked_status, bool):
+        return jsonify({"error": "Liked status must be provided"}), 400
+
+    try:
+        updated = set(db.session.execute(
+            update(AudioFile)
+            .where(AudioFile.id.in_(ids), AudioFile.user_id == current_user.id)
+            .values(liked=liked_status)
+            .returning(AudioFile.id)
+        ).scalars())
+        if updated:
+            bump_versions(audiofiles_collection(current_user.id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "updated": len(updated),
+        "liked": liked_status,
+        "results": [{"id": id, "status": "updated" if id in updated else "not_found"} for id in ids],
+    }), 200
 
 @audiofiles_routes.route('/audiofiles/<id>/like', methods=['PATCH'])
 @token_required
@@ -176,6 +918,7 @@ def handle_like_file(current_user, id):
             return jsonify({"error": "Liked status must be provided"}), 400
 
         audio_file.liked = liked_status
+        bump_versions(audiofiles_collection(current_user.id))
 
         db.session.commit()
 
@@ -185,4 +928,5 @@ def handle_like_file(current_user, id):
         }), 200
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
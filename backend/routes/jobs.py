@@ -0,0 +1,50 @@
+import click
+import multiprocessing
+from flask import Blueprint, current_app
+from config import Config
+from jobs import job_worker, prune_jobs, requeue_jobs
+
+jobs_routes = Blueprint('jobs', __name__)
+
+def work_process(threads, claim_batch):
+    """Entry point of each worker process, forked ones drop their parent's connections in app.create_app."""
+    job_worker.claim_batch_size = claim_batch
+    job_worker.work(threads)
+
+@jobs_routes.cli.command('work')
+@click.option('--processes', default=1, show_default=True, help="Number of worker processes.")
+@click.option('--threads', default=None, type=int, help="Worker threads per process, defaults to JOB_WORKER_THREADS or 1 if it is 0.")
+@click.option('--claim-batch', default=None, type=int, help="Jobs claimed at once by each thread, defaults to JOB_CLAIM_BATCH_SIZE.")
+def work_command(processes, threads, claim_batch):
+    """Run queued jobs until stopped, in dedicated worker processes."""
+    threads = threads or Config.JOB_WORKER_THREADS or 1
+    click.echo(f"Running jobs on {processes} processes of {threads} threads")
+    if processes <= 1:
+        work_process(threads, claim_batch)
+        return
+    app = current_app._get_current_object()
+    def target():
+        with app.app_context():
+            work_process(threads, claim_batch)
+    workers = [multiprocessing.get_context('fork').Process(target=target, name=f'job-worker-{i}') for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+@jobs_routes.cli.command('requeue')
+@click.option('--kind', default=None, help="Only requeue the dead jobs of this kind.")
+def requeue_command(kind):
+    """Queue the dead jobs again with fresh attempts."""
+    click.echo(f"Requeued {requeue_jobs(kind)} jobs")
+
+@jobs_routes.cli.command('prune')
+@click.option('--retention-seconds', default=None, type=int, help="Age of the done jobs deleted, defaults to JOB_RETENTION_SECONDS.")
+def prune_command(retention_seconds):
+    """Delete old done jobs and bury jobs whose worker was lost on their last attempt."""
+    deleted, buried = prune_jobs(retention_seconds)
+    click.echo(f"Deleted {deleted} done jobs, {buried} jobs are now dead")
@@ -0,0 +1,290 @@
+from flask import Blueprint, jsonify, request
+import click
+import datetime
+import uuid
+from db import db
+from routes.utils import token_required
+from models import AudioFile, UploadSession, UploadPart
+from config import Config
+from s3_client import s3_client
+from ingest import schedule_ingest
+from jobs import job_worker
+from outbox import enqueue_s3_deletions, s3_deletion_worker
+from quotas import QuotaExceeded, check_quota, charge_quota
+from collection_versions import audiofiles_collection, bump_versions
+
+uploads_routes = Blueprint('uploads', __name__)
+
+# Limits imposed by S3 multipart uploads
+MIN_PART_SIZE = 5 * 1024 ** 2
+MAX_PART_SIZE = 5 * 1024 ** 3
+MAX_PART_NUMBER = 10000
+
+def serialize_upload(upload):
+    """
+    Builds the JSON representation of an upload, including the parts received so far
+    so that a client can resume an interrupted upload.
+    """
+    return {
+        "upload_id": upload.id,
+        "file_name": upload.file_name,
+        "min_part_size": MIN_PART_SIZE,
+        "max_size": Config.UPLOAD_MAX_SIZE,
+        "expires_at": (upload.created_at + datetime.timedelta(seconds=Config.UPLOAD_EXPIRY_SECONDS)).isoformat(),
+        "parts": [{"part_number": part.part_number, "size": part.size} for part in upload.parts],
+    }
+
+@uploads_routes.route('/audiofiles/uploads', methods=['POST'])
+@token_required
+def initiate_upload(current_user):
+    """
+    Starts a chunked upload of an audio file by creating an S3 multipart upload.
+
+    Request:
+        - JSON body with the 'file_name' of the audio file.
+
+    Response:
+        - On success: JSON with the 'upload_id' to upload parts to, and the upload's limits.
+        - On failure:
+            - 400 if no file name is provided.
+            - 500 if the multipart upload could not be created.
+    """
+    data = request.get_json(silent=True) or {}
+    file_name = data.get('file_name')
+    if not file_name:
+        return jsonify({"error": "File name is required"}), 400
+
+    s3_bucket = Config.S3_BUCKET
+    s3_key = str(uuid.uuid4())
+    try:
+        multipart_upload = s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key)
+        upload = UploadSession(
+            file_name=file_name,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            s3_upload_id=multipart_upload["UploadId"],
+            user_id=current_user.id
+        )
+        db.session.add(upload)
+        db.session.commit()
+
+        return jsonify(serialize_upload(upload)), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@uploads_routes.route('/audiofiles/uploads/<upload_id>', methods=['GET'])
+@token_required
+def get_upload(current_user, upload_id):
+    """
+    Retrieves the state of a chunked upload, used to resume an interrupted upload.
+
+    Response:
+        - On success: JSON with the upload's details and the parts received so far.
+        - On failure: 404 if the upload is not found or does not belong to the user.
+    """
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first()
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(serialize_upload(upload)), 200
+
+@uploads_routes.route('/audiofiles/uploads/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+@token_required
+def upload_part(current_user, upload_id, part_number):
+    """
+    Uploads one part of a chunked upload. The request body is streamed straight to S3 as the
+    corresponding multipart part without being buffered. Re-uploading a part number replaces it.
+
+    Request:
+        - PUT request to '/audiofiles/uploads/<upload_id>/parts/<part_number>' with the raw bytes
+          of the part as the body and a 'Content-Length' header. Every part except the last must
+          be at least 5 MiB.
+
+    Response:
+        - On success: JSON with the part number and its size.
+        - On failure:
+            - 400 if the part number is out of range, or if it is not the last part and either it or
+              a part before it is smaller than 5 MiB.
+            - 404 if the upload is not found or does not belong to the user.
+            - 411 if no Content-Length is provided.
+            - 413 if the part would take the upload over the maximum size.
+            - 500 if there was an error uploading the part.
+    """
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first()
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    if part_number < 1 or part_number > MAX_PART_NUMBER:
+        return jsonify({"error": f"Part number must be between 1 and {MAX_PART_NUMBER}"}), 400
+
+    size = request.content_length
+    if size is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+
+    # A re-uploaded part replaces the previous one, so it does not count towards the total
+    received = sum(part.size for part in upload.parts if part.part_number != part_number)
+    if size > MAX_PART_SIZE or received + size > Config.UPLOAD_MAX_SIZE:
+        return jsonify({"error": f"Upload exceeds the maximum size of {Config.UPLOAD_MAX_SIZE} bytes"}), 413
+    # Only the last part may be smaller than MIN_PART_SIZE, which S3 would otherwise only report on completion
+    if size < MIN_PART_SIZE and any(part.part_number > part_number for part in upload.parts):
+        return jsonify({"error": f"Every part except the last must be at least {MIN_PART_SIZE} bytes"}), 400
+    if any(part.part_number < part_number and part.size < MIN_PART_SIZE for part in upload.parts):
+        return jsonify({"error": f"Part {max(part.part_number for part in upload.parts if part.part_number < part_number)} "
+                                 f"is smaller than {MIN_PART_SIZE} bytes, so it must be the last part"}), 400
+
+    try:
+        uploaded_part = s3_client.upload_part(
+            Bucket=upload.s3_bucket,
+            Key=upload.s3_key,
+            UploadId=upload.s3_upload_id,
+            PartNumber=part_number,
+            Body=request.stream,
+            ContentLength=size
+        )
+        part = UploadPart.query.filter_by(upload_id=upload.id, part_number=part_number).first()
+        if not part:
+            part = UploadPart(upload_id=upload.id, part_number=part_number)
+            db.session.add(part)
+        part.etag = uploaded_part["ETag"]
+        part.size = size
+        db.session.commit()
+
+        return jsonify({"part_number": part_number, "size": size}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@uploads_routes.route('/audiofiles/uploads/<upload_id>/complete', methods=['POST'])
+@token_required
+def complete_upload(current_user, upload_id):
+    """
+    Completes a chunked upload by assembling its parts in S3, and stores the audio file in the database.
+    Retrying after a failure is safe: an object already assembled by a previous attempt is stored as is.
+    The session is kept until the audio file is stored, so an object left behind by a client that never
+    retries is deleted by the sweep.
+
+    Response:
+        - On success: JSON with the id of the new audio file.
+        - On failure:
+            - 400 if no parts have been uploaded, or a part other than the last is smaller than 5 MiB.
+            - 403 if the file would take the user over their file or storage quota.
+            - 404 if the upload is not found or does not belong to the user.
+            - 500 if there was an error completing the upload.
+    """
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first()
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    if not upload.parts:
+        return jsonify({"error": "No parts have been uploaded"}), 400
+    if any(part.size < MIN_PART_SIZE for part in upload.parts[:-1]):
+        return jsonify({"error": f"Every part except the last must be at least {MIN_PART_SIZE} bytes"}), 400
+    size = sum(part.size for part in upload.parts)
+    try:
+        # The upload is left to be aborted by the client or the sweep
+        check_quota(current_user.id, size)
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e)}), 403
+
+    try:
+        try:
+            s3_client.complete_multipart_upload(
+                Bucket=upload.s3_bucket,
+                Key=upload.s3_key,
+                UploadId=upload.s3_upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": part.part_number, "ETag": part.etag} for part in upload.parts]}
+            )
+        except s3_client.exceptions.NoSuchUpload:
+            # A previous attempt assembled the object but failed to store the audio file, so this one finishes it
+            if s3_client.head_object(Bucket=upload.s3_bucket, Key=upload.s3_key)["ContentLength"] != size:
+                raise
+        audio_file = AudioFile(
+            id=upload.s3_key,
+            file_name=upload.file_name,
+            s3_bucket=upload.s3_bucket,
+            s3_key=upload.s3_key,
+            user_id=current_user.id,
+            size=size
+        )
+        db.session.add(audio_file)
+        db.session.delete(upload)
+        charge_quota(current_user.id, size)
+        bump_versions(audiofiles_collection(current_user.id))
+        schedule_ingest(audio_file.id)
+        db.session.commit()
+        job_worker.notify()
+
+        return jsonify({"id": audio_file.id, "message": f"Audio file {audio_file.file_name} uploaded successfully!"}), 201
+    except QuotaExceeded as e:
+        # A concurrent upload took the remaining quota after the upload was completed, so the file is deleted
+        db.session.rollback()
+        enqueue_s3_deletions(upload.s3_bucket, [upload.s3_key])
+        db.session.delete(upload)
+        db.session.commit()
+        s3_deletion_worker.notify()
+        return jsonify({"error": str(e)}), 403
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@uploads_routes.route('/audiofiles/uploads/<upload_id>', methods=['DELETE'])
+@token_required
+def abort_upload(current_user, upload_id):
+    """
+    Aborts a chunked upload and discards the parts stored in S3.
+
+    Response:
+        - On success: JSON message confirming the upload was aborted.
+        - On failure:
+            - 404 if the upload is not found or does not belong to the user.
+            - 500 if there was an error aborting the upload.
+    """
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first()
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+
+    try:
+        try:
+            s3_client.abort_multipart_upload(Bucket=upload.s3_bucket, Key=upload.s3_key, UploadId=upload.s3_upload_id)
+        except s3_client.exceptions.NoSuchUpload:
+            # Already assembled by a completion that failed to store the audio file
+            enqueue_s3_deletions(upload.s3_bucket, [upload.s3_key])
+        db.session.delete(upload)
+        db.session.commit()
+        s3_deletion_worker.notify()
+
+        return jsonify({"message": "Upload aborted successfully!"}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+def sweep_expired_uploads():
+    """
+    Aborts every chunked upload that was initiated more than Config.UPLOAD_EXPIRY_SECONDS ago,
+    so abandoned parts do not keep accumulating in S3. The objects of uploads that were assembled
+    but never stored as audio files are queued for deletion.
+
+    Returns:
+        int: The number of uploads that were aborted.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=Config.UPLOAD_EXPIRY_SECONDS)
+    expired_uploads = UploadSession.query.filter(UploadSession.created_at < cutoff).all()
+    aborted = 0
+    for upload in expired_uploads:
+        try:
+            s3_client.abort_multipart_upload(Bucket=upload.s3_bucket, Key=upload.s3_key, UploadId=upload.s3_upload_id)
+        except s3_client.exceptions.NoSuchUpload:
+            # The parts were assembled by a completion that failed to store the audio file, the object is an orphan
+            enqueue_s3_deletions(upload.s3_bucket, [upload.s3_key])
+        except Exception:
+            # Leave the upload to be retried on the next sweep
+            continue
+        db.session.delete(upload)
+        aborted += 1
+    db.session.commit()
+    s3_deletion_worker.notify()
+    return aborted
+
+@uploads_routes.cli.command('sweep')
+def sweep_expired_uploads_command():
+    """Abort chunked uploads that have expired."""
+    aborted = sweep_expired_uploads()
+    click.echo(f"Aborted {aborted} expired uploads")
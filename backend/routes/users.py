@@ -1,11 +1,23 @@
-from flask import Blueprint, request, jsonify
-import bcrypt
-from models import User
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+import json
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.orm import selectinload
+from models import User, AudioFile, UploadSession, S3Deletion
 from db import db
-from routes.utils import token_required
+from routes.utils import token_required, admin_required, invalidate_user, encode_cursor, decode_cursor, parse_limit
+from routes.audiofiles import delete_audiofiles, forget_deleted_audiofiles
+from passwords import hash_password
+from config import Config
+from collection_versions import USERS_COLLECTION, audiofiles_collection, bump_versions, forget_versions
+from response_cache import versioned_collection
+from user_summary import adjust_summary, move_user_summary, user_summary
+from user_import import CSV_MIMETYPES, JSON_LINES_MIMETYPES, read_import_rows, import_users
 
 users_routes = Blueprint('users', __name__)
 
+DEFAULT_USERS_PAGE_SIZE = 50
+MAX_USERS_PAGE_SIZE = 200
+
 @users_routes.route('/users', methods=['POST'])
 @token_required  
 def create_user(current_user):
@@ -35,52 +47,165 @@ def create_user(current_user):
     if existing_user:
         return jsonify({"error": "Username already exists"}), 400
 
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed_password = hash_password(password)
     new_user = User(username=username, role=role, password=hashed_password)
 
     db.session.add(new_user)
+    adjust_summary(role, users=1)
+    bump_versions(USERS_COLLECTION)
     db.session.commit()
 
     return jsonify({"message": f"User {username} created successfully!"}), 201
 
-# Endpoint to retrieve all users
+@users_routes.route('/users/bulk', methods=['POST'])
+@token_required
+@admin_required
+def bulk_create_users(current_user):
+    """
+    Creates many users from a CSV or JSON lines body, read as it arrives and imported in batches, each
+    checked with one query, hashed in parallel and inserted with one statement. Rows whose username is
+    taken or that are invalid are skipped without failing the import.
+
+    Request:
+        - CSV body (Content-Type 'text/csv') with a header naming the 'username', 'password' and 'role'
+          columns, or JSON lines body (Content-Type 'application/x-ndjson') with one object per line.
+          The role is 'member' or 'admin', and defaults to 'member'.
+
+    Response:
+        - On success: a JSON lines stream with the result of each row as its batch is committed, with the row's
+          'line', 'username' and 'status' ('created', 'exists', or 'invalid' with the 'error'), ending with a
+          summary of the number of rows of each status. If the import fails, the last line holds the 'error',
+          and the batches already reported as created stay created.
+        - On failure:
+            - 403 if the user is not an administrator.
+            - 415 if the body is neither CSV nor JSON lines.
+    """
+    if request.mimetype not in CSV_MIMETYPES + JSON_LINES_MIMETYPES:
+        return jsonify({"error": "Body must be CSV (text/csv) or JSON lines (application/x-ndjson)"}), 415
+
+    def generate():
+        summary = {"created": 0, "exists": 0, "invalid": 0}
+        try:
+            for result in import_users(read_import_rows(request.stream, request.mimetype)):
+                summary[result["status"]] += 1
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            db.session.rollback()
+            yield json.dumps({"error": str(e)}) + "\n"
+            return
+        yield json.dumps(summary) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Endpoint to retrieve a page of users
 @users_routes.route('/users', methods=['GET'])
-@token_required  
-def get_users(current_user):  
+@token_required
+@admin_required
+@versioned_collection(lambda user: USERS_COLLECTION, max_age=Config.USERS_LISTING_MAX_AGE_SECONDS)
+def get_users(current_user):
     """
-    Retrieves a list of all users, including their id, username, and role.
+    Retrieves a page of users, ordered by username, with the number and total size of their audio files
+    and how many they liked, along with the totals of all users. Each page costs the same however many
+    users there are: the usage counters are columns of the users and the liked counts come from one
+    grouped query over the page's users.
+
+    Request:
+        - Optional 'limit' query parameter with the page size (default 50, max 200).
+        - Optional 'cursor' query parameter with the 'next_cursor' of the previous page.
+        - Optional 'role' query parameter to only list users with that role ('member' or 'admin').
+        - Optional 'prefix' query parameter to only list users whose username starts with it.
 
     Response:
-        - On success: JSON list of users with 'id', 'username', and 'role'.
+        - On success: JSON with the page of users, each with 'id', 'username', 'role', 'file_count',
+          'storage_bytes' and 'liked_count', the 'next_cursor' to fetch the following page, which is null
+          on the last page, and the 'summary' of all users.
+        - On failure:
+            - 400 if the limit or cursor is invalid.
+            - 403 if the user is not an administrator.
     """
-    users = User.query.filter(User.role != 'master').order_by(User.username, User.id).all()  
+    query = User.query.filter(User.role != 'master')
+    try:
+        limit = parse_limit(request.args.get('limit'), DEFAULT_USERS_PAGE_SIZE, MAX_USERS_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            username, id = decode_cursor(cursor, 2)
+            query = query.filter(tuple_(User.username, User.id) > (username, id))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if request.args.get('role'):
+        query = query.filter(User.role == request.args.get('role'))
+    if request.args.get('prefix'):
+        query = query.filter(User.username.startswith(request.args.get('prefix'), autoescape=True))
+
+    # Fetch one extra row to know whether there is a next page
+    users = query.order_by(User.username, User.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1].username, users[-1].id)
+
+    liked_counts = {}
+    if users:
+        liked_counts = dict(db.session.execute(
+            select(AudioFile.user_id, func.count())
+            .where(AudioFile.user_id.in_([user.id for user in users]), AudioFile.liked.is_(True))
+            .group_by(AudioFile.user_id)
+        ).all())
     users_data = [
-        {"id": user.id, "username": user.username, "role": user.role}
+        {
+            "id": user.id,
+            "username": user.username,
+            "role": user.role,
+            "file_count": user.file_count,
+            "storage_bytes": user.storage_bytes,
+            "liked_count": liked_counts.get(user.id, 0),
+        }
         for user in users
-    ] 
-    return jsonify({"users": users_data}), 200
-    
+    ]
+    return jsonify({"users": users_data, "next_cursor": next_cursor, "summary": user_summary()}), 200
+
 # Endpoint to delete a user    
 @users_routes.route('/users/<id>', methods=['DELETE'])
-def delete_user(id):
+@token_required
+def delete_user(current_user, id):
     """
-    Deletes a user based on the provided user ID.
+    Deletes a user based on the provided user ID, along with their audio files and unfinished uploads.
+    Their objects are deleted from S3 in the background.
 
     Request:
         - DELETE request to '/users/<id>' where <id> is the user's ID.
 
     Response:
         - On success: JSON message confirming the user was deleted.
-        - On failure: JSON error message if the user is not found (404).
+        - On failure:
+            - 404 if the user is not found.
+            - 403 if the user is the master user.
+            - 500 if there was an error during the deletion process.
     """
     user_to_delete = User.query.filter_by(id=id).first()
-    if user_to_delete.role == 'master':
-        jsonify({"error": "cannot delete master"}), 403
     if not user_to_delete:
         return jsonify({"error": "User not found"}), 404
-
-    db.session.delete(user_to_delete)
-    db.session.commit()
+    if user_to_delete.role == 'master':
+        return jsonify({"error": "cannot delete master"}), 403
+
+    try:
+        audio_files = AudioFile.query.options(selectinload(AudioFile.renditions)).filter_by(user_id=id).all()
+        s3_keys = delete_audiofiles(audio_files)
+        for upload in UploadSession.query.filter_by(user_id=id):
+            db.session.add(S3Deletion(s3_bucket=upload.s3_bucket, s3_key=upload.s3_key, s3_upload_id=upload.s3_upload_id))
+            db.session.delete(upload)
+        # Remove the rows referencing the user before the user
+        db.session.flush()
+        db.session.delete(user_to_delete)
+        adjust_summary(user_to_delete.role, users=-1)
+        bump_versions(USERS_COLLECTION)
+        forget_versions(audiofiles_collection(id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+    invalidate_user(id)
+    forget_deleted_audiofiles(audio_files, s3_keys)
 
     return jsonify({"message": "User deleted successfully!"}), 200
 
@@ -119,12 +244,18 @@ def update_user(current_user, id):
     if username:
         user_to_update.username = username
     if role == 'member' or role == 'admin':
+        old_role = user_to_update.role
         user_to_update.role = role
+        db.session.flush()
+        move_user_summary(id, old_role)
     if password:
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(password)
         user_to_update.password = hashed_password
+    if username or role == 'member' or role == 'admin':
+        bump_versions(USERS_COLLECTION)
 
     db.session.commit()
+    invalidate_user(id)
 
     return jsonify({"message": f"User {id} updated successfully!"}), 200
 
@@ -163,8 +294,10 @@ def update_self_username(current_user):
         user_to_update.username = username
     else:
         return  jsonify({"error": f"Please input a new username"}), 500
+    bump_versions(USERS_COLLECTION)
 
     db.session.commit()
+    invalidate_user(current_user.id)
 
     return jsonify({"message": f"Username updated successfully!"}), 200
 
@@ -194,11 +327,12 @@ def update_self_password(current_user):
         return jsonify({"error": "User not found"}), 404
 
     if password:
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hash_password(password)
         user_to_update.password = hashed_password
     else:
         return  jsonify({"error": f"Please input a password"}), 500
 
     db.session.commit()
+    invalidate_user(current_user.id)
 
     return jsonify({"message": f"User {id} updated successfully!"}), 200
\ No newline at end of file
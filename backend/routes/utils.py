@@ -1,68 +1,234 @@
 import os 
-import db
+import click
+from db import db
 from models import User
 from flask import Blueprint, jsonify, request, current_app
+from flask_migrate import upgrade
 from functools import wraps
-import bcrypt  
 import jwt
 import datetime
+import base64
+import json
+import time
+from collections import namedtuple
+from cache import TTLCache
+from config import Config
+from passwords import hash_password, check_password, needs_rehash, PasswordHashPoolFull
+from profiling import phase
+from user_summary import adjust_summary
 
-utils_routes = Blueprint('utils', __name__)
+# Its commands are top level, e.g. `flask bootstrap`
+utils_routes = Blueprint('utils', __name__, cli_group=None)
+
+# The authenticated user passed to route handlers, cached so most requests skip the database lookup
+Principal = namedtuple('Principal', ['id', 'username', 'role'])
+
+# Verified token -> decoded claims, and user id -> Principal
+token_cache = TTLCache(Config.AUTH_CACHE_SIZE, Config.AUTH_CACHE_TTL_SECONDS)
+principal_cache = TTLCache(Config.AUTH_CACHE_SIZE, Config.AUTH_CACHE_TTL_SECONDS)
+
+def invalidate_user(user_id):
+    """
+    Drops the cached principal of a user, must be called whenever a user is updated or deleted.
+    Other worker processes pick up the change once their entry expires after Config.AUTH_CACHE_TTL_SECONDS.
+    """
+    principal_cache.pop(user_id)
+
+def auth_cache_stats():
+    """Returns the size and hit/miss counters of the token and principal caches."""
+    return {"tokens": token_cache.stats(), "principals": principal_cache.stats()}
 
 def create_admin():
     """
-    Checks if an admin user exists. If not, creates a new admin with the username 'audiovault' 
-    and a hashed password. The admin's role is set to 'admin'.
-    This function is intended to be called when initializing the database for the first time.
+    Checks if the master user exists. If not, creates it with the username 'master', the password
+    in MASTER_PASSWORD hashed, and the role 'master'. Run once per deployment by `flask bootstrap`.
+
+    Returns:
+        bool: Whether the master user was created.
+    """
+    # Check if the master already exists
+    if User.query.filter_by(username='master').first():
+        return False
+    # Create a new master if none exists
+    admin = User(
+        username='master',
+        password=hash_password(os.getenv('MASTER_PASSWORD', '')),
+        role='master'
+    )
+    db.session.add(admin)
+    adjust_summary('master', users=1)
+    db.session.commit()
+    return True
+
+@utils_routes.cli.command('bootstrap')
+def bootstrap_command():
+    """Apply the database migrations and create the master user, once per deployment."""
+    upgrade()
+    click.echo("Created the master user" if create_admin() else "The master user already exists")
+
+def encode_cursor(*values):
+    """
+    Encodes the sort key of the last row of a page into an opaque cursor string.
+
+    Args:
+        *values: The values of the columns the listing is ordered by, e.g. (file_name, id).
+
+    Returns:
+        str: A URL-safe cursor that can be passed back to fetch the next page.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor, size):
+    """
+    Decodes a cursor created by encode_cursor back into its sort key values.
+
+    Args:
+        cursor (str): The cursor string received from the client.
+        size (int): The number of values the cursor is expected to contain.
+
+    Returns:
+        list: The decoded sort key values.
+
+    Raises:
+        ValueError: If the cursor is malformed.
     """
     try:
-        # Check if the master already exists
-        admin = User.query.filter_by(username='master').first()
-        master_password = os.getenv('MASTER_PASSWORD', '')
-        if not admin:
-            # Create a new master if none exists
-            hashed_password = bcrypt.hashpw(master_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            admin = User(
-                username='master',
-                password=hashed_password,
-                role='master'
-            )
-            db.session.add(admin)
-            db.session.commit()
-    except:
-        db.session.rollback()
-        
-def token_required(f):
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, str) for v in values):
+        raise ValueError("Invalid cursor")
+    return values
+
+def parse_limit(value, default, maximum):
     """
-    Decorator to ensure a valid JWT token is present in the request header.
+    Parses the 'limit' query parameter of a paginated listing.
 
-    The token is decoded using the app's secret key, and the user is authenticated. If the token is missing, 
-    expired, or invalid, a 401 error is returned. Otherwise, the current user is passed to the route handler.
+    Args:
+        value (str): The raw query parameter, or None if it was not given.
+        default (int): The page size to use when no limit is given.
+        maximum (int): The largest page size a client may request.
+
+    Returns:
+        int: The page size to use.
+
+    Raises:
+        ValueError: If the limit is not an integer between 1 and maximum.
+    """
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("Limit must be an integer")
+    if limit < 1 or limit > maximum:
+        raise ValueError(f"Limit must be between 1 and {maximum}")
+    return limit
+
+def decode_token(token, secret_key):
+    """
+    Verifies and decodes a JWT, reusing the claims of tokens that were verified recently.
 
     Args:
-        f (function): The route handler function to be wrapped.
+        token (str): The encoded token, without the 'Bearer' prefix.
+        secret_key (str): The key the token was signed with.
 
     Returns:
-        function: The decorated route handler with added token validation logic.
+        dict: The token's claims.
+
+    Raises:
+        jwt.PyJWTError: If the token is invalid or expired.
+    """
+    data = token_cache.get(token)
+    if data is None:
+        data = jwt.decode(token, secret_key, algorithms=["HS256"])
+        # Never keep a token cached past its expiry
+        token_cache.set(token, data, min(Config.AUTH_CACHE_TTL_SECONDS, data['exp'] - time.time()))
+    return data
+
+def request_token(allow_query_token=False):
     """
+    Returns the Authorization header of the request, 'Bearer <token>', or None if it has none.
+
+    Args:
+        allow_query_token (bool): Also accept the token in the 'token' query parameter. Only for routes loaded
+            by media elements such as <audio src=...>, which cannot set headers, as URLs end up in logs.
+    """
+    token = request.headers.get('Authorization')
+    if not token and allow_query_token and request.args.get('token'):
+        token = f"Bearer {request.args.get('token')}"
+    return token
+
+def authenticate(f, allow_query_token):
+    """Wraps a route handler with the token validation of token_required, see request_token for allow_query_token."""
     @wraps(f)
     def decorated(*args, **kwargs):
         if request.method == 'OPTIONS':
             return '', 200 
 
-        token = request.headers.get('Authorization')
+        token = request_token(allow_query_token)
         if not token:
             return jsonify({"error": "Token is missing"}), 401
         
         try:
-            token = token.split(" ")[1] 
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.filter_by(id=data['user_id']).first()
+            with phase('auth'):
+                token = token.split(" ")[1] 
+                data = decode_token(token, current_app.config['SECRET_KEY'])
+
+                current_user = principal_cache.get(data['user_id'])
+                if current_user is None:
+                    user = User.query.filter_by(id=data['user_id']).first()
+                    if not user:
+                        raise LookupError("User not found")
+                    current_user = Principal(user.id, user.username, user.role)
+                    principal_cache.set(user.id, current_user)
         except Exception as e:
             return jsonify({"error": "Your login session has expired please log out and log back in"}), 401
         return f(current_user, *args, **kwargs)
     return decorated
 
+def token_required(f):
+    """
+    Decorator to ensure a valid JWT token is present in the request header.
+
+    The token is decoded using the app's secret key, and the user is authenticated. If the token is missing, 
+    expired, or invalid, a 401 error is returned. Otherwise, the current user is passed to the route handler
+    as a Principal. Decoded tokens and principals are cached in-process to avoid a database round trip per request.
+
+    Args:
+        f (function): The route handler function to be wrapped.
+
+    Returns:
+        function: The decorated route handler with added token validation logic.
+    """
+    return authenticate(f, allow_query_token=False)
+
+def media_token_required(f):
+    """
+    Decorator like token_required for the routes media elements load, such as audio streams, which also accepts
+    the token in the 'token' query parameter as media elements cannot set headers.
+    """
+    return authenticate(f, allow_query_token=True)
+
+def admin_required(f):
+    """
+    Decorator for routes reserved to administrators, placed under token_required.
+    Users whose role is not 'admin' or 'master' get a 403.
+    """
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        if current_user.role not in ('admin', 'master'):
+            return jsonify({"error": "Administrator access required"}), 403
+        return f(current_user, *args, **kwargs)
+    return decorated
+
+@utils_routes.app_errorhandler(PasswordHashPoolFull)
+def handle_password_hash_pool_full(e):
+    """
+    Returns a 503 from any route when password hashing is saturated, rather than queueing the request.
+    """
+    return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+
 @utils_routes.route('/login', methods=['POST'])
 def login():
     """
@@ -85,9 +251,14 @@ def login():
     if not user:
         return jsonify({"error": "Invalid username"}), 401
     
-    if not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+    if not check_password(password, user.password):
         return jsonify({"error": "Invalid password"}), 402
 
+    # Upgrade the stored hash if the configured bcrypt cost has changed since it was created
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+
     # Generate JWT tokens
     token = jwt.encode({
         'user_id': user.id,
@@ -1,3 +1,126 @@
-import boto3
+import contextvars
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
 
-s3_client = boto3.client('s3', region_name='ap-southeast-1')
\ No newline at end of file
+class LazyS3Client:
+    """
+    The S3 client shared by every thread of a process, with its connection pool. It is built on first use
+    rather than at import, as loading boto3 and the S3 service model is a large part of startup, and is
+    rebuilt in a forked process, which must not share its parent's connections. Attributes are those of the
+    boto3 client.
+    """
+    def __init__(self):
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._on_create = []
+
+    def on_create(self, callback):
+        """Registers a function called with each client built, e.g. to instrument it, and with the current one if any."""
+        with self._lock:
+            self._on_create.append(callback)
+            if self._client is not None and self._pid == os.getpid():
+                callback(self._client)
+
+    def get(self):
+        """Returns the client of the current process, building it on first use."""
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    import boto3
+                    from botocore.config import Config as BotoConfig
+                    client = boto3.client(
+                        's3',
+                        region_name=Config.S3_REGION,
+                        endpoint_url=Config.S3_ENDPOINT_URL,
+                        config=BotoConfig(max_pool_connections=Config.S3_MAX_POOL_CONNECTIONS, tcp_keepalive=True),
+                    )
+                    for callback in self._on_create:
+                        callback(client)
+                    self._client, self._pid = client, os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+# boto3 clients are thread safe, so a single client per process is shared by every thread
+s3_client = LazyS3Client()
+
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+def get_fetch_executor():
+    """
+    Returns the thread pool used for bulk S3 fetches, creating it on first use.
+    The pool is shared by all requests so the total number of fetch threads stays bounded.
+    """
+    global _fetch_executor
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(max_workers=Config.S3_FETCH_CONCURRENCY, thread_name_prefix='s3-fetch')
+        return _fetch_executor
+
+def fetch_objects(objects, concurrency=None, client=None):
+    """
+    Fetches the content of many S3 objects concurrently and yields them in the order they were requested.
+
+    At most `concurrency` objects are in flight at once, so fetching N objects takes roughly
+    ceil(N / concurrency) round trips instead of N, while only `concurrency` bodies are held in memory.
+
+    Args:
+        objects (iterable): (bucket, key) pairs of the objects to fetch.
+        concurrency (int): Maximum number of objects fetched at once, defaults to Config.S3_FETCH_CONCURRENCY.
+        client: The S3 client to fetch with, defaults to the shared s3_client.
+
+    Yields:
+        bytes: The content of each object, in the same order as `objects`.
+    """
+    concurrency = concurrency or Config.S3_FETCH_CONCURRENCY
+    client = client or s3_client
+    executor = get_fetch_executor()
+
+    def fetch(bucket, key):
+        return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    pending = deque()
+    try:
+        for bucket, key in objects:
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+            # Run in a copy of the caller's context so the fetch counts towards its request's profile
+            pending.append(executor.submit(contextvars.copy_context().run, fetch, bucket, key))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Drop the remaining fetches if the consumer stopped early or a fetch failed
+        for future in pending:
+            future.cancel()
+
+# Maximum number of keys S3 accepts in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+def delete_objects(bucket, keys, client=None):
+    """
+    Deletes many S3 objects with as few DeleteObjects requests as possible, DELETE_BATCH_SIZE keys at a time.
+
+    Args:
+        bucket (str): The bucket the objects are in.
+        keys (iterable): Keys of the objects to delete, duplicates are only deleted once.
+        client: The S3 client to delete with, defaults to the shared s3_client.
+
+    Returns:
+        dict: The error message of each key that could not be deleted, empty if all were deleted.
+    """
+    client = client or s3_client
+    keys = list(dict.fromkeys(keys))
+    errors = {}
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        # Quiet mode only reports the keys that failed
+        response = client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+        for error in response.get("Errors", []):
+            errors[error["Key"]] = error.get("Message") or error.get("Code")
+    return errors
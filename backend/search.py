@@ -0,0 +1,207 @@
+import bisect
+import re
+import threading
+from sqlalchemy import event, func, literal, literal_column, or_, and_, case, cast, Float
+from db import db
+from models import AudioFile
+
+# Text searched for each audio file, written exactly as in the expression indexes so Postgres can use them
+SEARCH_DOCUMENT = literal_column("(audio_file.file_name || ' ' || coalesce(audio_file.tags_text, ''))")
+SEARCH_VECTOR = func.to_tsvector(literal_column("'simple'"), literal_column("audio_file.file_name || ' ' || coalesce(audio_file.tags_text, '')"))
+
+# Minimum trigram similarity for a word to match a misspelt search term
+SIMILARITY_THRESHOLD = 0.3
+
+# Bonus for files whose name starts with the query, so autocomplete suggests them first
+NAME_PREFIX_BONUS = 1.0
+
+def tokenize(text):
+    """Splits text into the lower-cased words it is searched by."""
+    # Underscores separate words as in the Postgres text search parser
+    return re.findall(r'[^\W_]+', (text or '').lower())
+
+def escape_like(text):
+    """Escapes the LIKE wildcards in text, with '\\' as the escape character."""
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+def search_audiofiles(user_id, query, limit, after=None):
+    """
+    Searches a user's audio files by file name and tags, matching every word of the query as a word or
+    word prefix (so partial input autocompletes), the query as a substring, or words close to it to allow
+    for typos. Runs in Postgres on its full text and trigram indexes, or on SearchIndex under SQLite.
+
+    Args:
+        user_id (str): ID of the user whose audio files are searched.
+        query (str): The search text.
+        limit (int): Maximum number of results.
+        after (tuple): (score, id) of the last result of the previous page, if any.
+
+    Returns:
+        list: Up to limit + 1 (AudioFile, score) pairs ordered by descending score then id, the extra
+        result telling the caller there is a next page.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return search_index.search(user_id, query, limit, after)
+
+    words = tokenize(query)
+    ts_query = func.to_tsquery(literal_column("'simple'"), ' & '.join(f"{word}:*" for word in words)) if words else None
+    matches = [
+        SEARCH_DOCUMENT.ilike(f"%{escape_like(query)}%", escape='\\'),
+        literal(query).op('<%')(SEARCH_DOCUMENT),
+    ]
+    rank = func.word_similarity(query, SEARCH_DOCUMENT)
+    if ts_query is not None:
+        matches.append(SEARCH_VECTOR.op('@@')(ts_query))
+        rank = rank + func.ts_rank(SEARCH_VECTOR, ts_query)
+    score = cast(
+        rank + case((AudioFile.file_name.ilike(f"{escape_like(query)}%", escape='\\'), NAME_PREFIX_BONUS), else_=0.0),
+        Float
+    ).label('score')
+
+    # Scored in a subquery so the keyset condition and ordering can refer to the score
+    ranked = db.session.query(AudioFile.id.label('id'), score).filter(
+        AudioFile.user_id == user_id,
+        or_(*matches)
+    ).subquery()
+    page = db.session.query(ranked.c.id, ranked.c.score)
+    if after:
+        after_score, after_id = after
+        page = page.filter(or_(ranked.c.score < after_score, and_(ranked.c.score == after_score, ranked.c.id > after_id)))
+    results = page.order_by(ranked.c.score.desc(), ranked.c.id).limit(limit + 1).all()
+    return load_results(results)
+
+def load_results(results):
+    """Loads the audio files of (id, score) search results in one query, dropping ids that no longer exist."""
+    audio_files = {audio_file.id: audio_file for audio_file in AudioFile.query.filter(AudioFile.id.in_([id for id, _ in results]))} if results else {}
+    return [(audio_files[id], score) for id, score in results if id in audio_files]
+
+def trigrams(word):
+    """Returns the set of trigrams of a word padded like pg_trgm pads it."""
+    padded = f"  {word} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+def similarity(left, right):
+    """Returns the trigram similarity of two words, between 0 and 1."""
+    left, right = trigrams(left), trigrams(right)
+    return len(left & right) / len(left | right) if left and right else 0.0
+
+class UserIndex:
+    """Inverted index of the words in one user's audio files, with the words kept sorted for prefix lookups."""
+    def __init__(self):
+        self.postings = {}
+        self.words = []
+        self.documents = {}
+
+    def add(self, id, file_name, tags_text):
+        self.remove(id)
+        words = set(tokenize(file_name) + tokenize(tags_text))
+        self.documents[id] = (file_name.lower(), f"{file_name} {tags_text or ''}".lower(), words)
+        for word in words:
+            if word not in self.postings:
+                self.postings[word] = set()
+                bisect.insort(self.words, word)
+            self.postings[word].add(id)
+
+    def remove(self, id):
+        document = self.documents.pop(id, None)
+        if document is None:
+            return
+        for word in document[2]:
+            ids = self.postings[word]
+            ids.discard(id)
+            if not ids:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def match(self, term):
+        """Returns {id: score} for the documents containing term as a word (1), a word prefix (0.5) or a close word."""
+        scores = {}
+        start = bisect.bisect_left(self.words, term)
+        for word in self.words[start:]:
+            if not word.startswith(term):
+                break
+            for id in self.postings[word]:
+                scores[id] = max(scores.get(id, 0.0), 1.0 if word == term else 0.5)
+        if not scores:
+            for word in self.words:
+                word_similarity = similarity(term, word)
+                if word_similarity >= SIMILARITY_THRESHOLD:
+                    for id in self.postings[word]:
+                        scores[id] = max(scores.get(id, 0.0), word_similarity * 0.5)
+        return scores
+
+    def search(self, query):
+        """Returns {id: score} for the documents matching every word of the query, or containing it as a substring."""
+        query = query.lower()
+        terms = tokenize(query)
+        scores = None
+        for term in terms:
+            term_scores = self.match(term)
+            scores = term_scores if scores is None else {id: score + term_scores[id] for id, score in scores.items() if id in term_scores}
+        scores = scores or {}
+        for id, (file_name, document, _) in self.documents.items():
+            if query in document and id not in scores:
+                scores[id] = 0.25
+            if id in scores and file_name.startswith(query):
+                scores[id] += NAME_PREFIX_BONUS
+        return scores
+
+class SearchIndex:
+    """
+    In-memory search index used instead of the Postgres indexes when running on SQLite, e.g. in tests and
+    local development. Each user's index is built from the database on their first search and then kept
+    current by the AudioFile mapper events, so it only reflects writes made through this process.
+    """
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _user_index(self, user_id):
+        with self._lock:
+            index = self._users.get(user_id)
+        if index is not None:
+            return index
+        index = UserIndex()
+        rows = db.session.query(AudioFile.id, AudioFile.file_name, AudioFile.tags_text).filter_by(user_id=user_id)
+        for id, file_name, tags_text in rows:
+            index.add(id, file_name, tags_text)
+        with self._lock:
+            return self._users.setdefault(user_id, index)
+
+    def search(self, user_id, query, limit, after=None):
+        """Searches a user's audio files, with the same arguments and results as search_audiofiles."""
+        index = self._user_index(user_id)
+        with self._lock:
+            scores = index.search(query)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        if after:
+            after_key = (-after[0], after[1])
+            ranked = [item for item in ranked if (-item[1], item[0]) > after_key]
+        return load_results(ranked[:limit + 1])
+
+    def indexed(self, audio_file):
+        with self._lock:
+            index = self._users.get(audio_file.user_id)
+            if index is not None:
+                index.add(audio_file.id, audio_file.file_name, audio_file.tags_text)
+
+    def removed(self, audio_file):
+        with self._lock:
+            index = self._users.get(audio_file.user_id)
+            if index is not None:
+                index.remove(audio_file.id)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+search_index = SearchIndex()
+
+@event.listens_for(AudioFile, 'after_insert')
+@event.listens_for(AudioFile, 'after_update')
+def index_audiofile(mapper, connection, audio_file):
+    search_index.indexed(audio_file)
+
+@event.listens_for(AudioFile, 'after_delete')
+def unindex_audiofile(mapper, connection, audio_file):
+    search_index.removed(audio_file)
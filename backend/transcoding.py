@@ -0,0 +1,227 @@
+import subprocess
+import threading
+from flask import current_app
+from sqlalchemy import select
+from db import db
+from models import AudioFile, Blob, Rendition
+from config import Config
+from s3_client import s3_client
+from jobs import job_handler, enqueue_job, job_worker
+
+try:
+    import imageio_ffmpeg
+except ImportError:
+    imageio_ffmpeg = None
+
+# Renditions are AAC in ADTS framing, which ffmpeg can write to a pipe and browsers can play as it streams
+RENDITION_CODEC = 'aac'
+RENDITION_CONTENT_TYPE = 'audio/aac'
+
+# How long ffmpeg may take to read the original through its presigned URL
+SOURCE_URL_EXPIRY_SECONDS = 3600
+
+def get_ffmpeg_binary():
+    """Returns the ffmpeg executable, preferring Config.FFMPEG_BINARY, then the one bundled with imageio-ffmpeg."""
+    if Config.FFMPEG_BINARY:
+        return Config.FFMPEG_BINARY
+    if imageio_ffmpeg is not None:
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    return 'ffmpeg'
+
+def rendition_s3_key(audio_file, bitrate):
+    """Returns the key a rendition of an audio file is stored under, derived from the original's key."""
+    return f"renditions/{audio_file.s3_key}/{bitrate}k.aac"
+
+def lock_renditions(blob_digest):
+    """
+    Locks a blob until the transaction ends, serializing the status changes of the renditions shared by the audio
+    files referencing it. Content that is not stored as a blob is not shared, so nothing is locked for it.
+    """
+    if blob_digest:
+        db.session.execute(select(Blob.digest).where(Blob.digest == blob_digest).with_for_update())
+
+def choose_bitrate(bitrates, args, headers):
+    """
+    Picks which rendition to serve from the client's hints.
+
+    Args:
+        bitrates (list): Bitrates of the ready renditions of the audio file.
+        args: The request's query parameters. 'quality=original' asks for the original, 'bitrate=<kbit/s>'
+            for the highest rendition at or below that bitrate.
+        headers: The request's headers. 'Save-Data: on' asks for the lowest rendition.
+
+    Returns:
+        int: The bitrate of the rendition to serve, or None to serve the original.
+    """
+    if not bitrates or args.get('quality') == 'original':
+        return None
+    bitrates = sorted(bitrates)
+    requested = args.get('bitrate', type=int)
+    if requested is not None:
+        suitable = [bitrate for bitrate in bitrates if bitrate <= requested]
+        return suitable[-1] if suitable else bitrates[0]
+    if args.get('quality') == 'low' or headers.get('Save-Data', '').lower() == 'on':
+        return bitrates[0]
+    if args.get('quality') == 'high':
+        return bitrates[-1]
+    return None
+
+def transcode_job_key(audio_file):
+    """
+    Returns the idempotency key of the transcode job of an audio file's content. Done and dead jobs keep their
+    key for Config.JOB_RETENTION_SECONDS, so besides the content's key it names the blob's creation time, which
+    changes when the content is deleted and uploaded again, and the configured bitrates. Either change then
+    queues a new job.
+    """
+    blob = db.session.get(Blob, audio_file.blob_digest) if audio_file.blob_digest else None
+    generation = blob.created_at.isoformat() if blob else ''
+    bitrates = ','.join(str(bitrate) for bitrate in sorted(Config.RENDITION_BITRATES))
+    return f"transcode:{audio_file.s3_bucket}/{audio_file.s3_key}:{generation}:{bitrates}"
+
+def delete_partial_rendition(s3_bucket, s3_key):
+    """Deletes what a failed transcode uploaded, unless a ready rendition references the key."""
+    if Rendition.query.filter_by(s3_bucket=s3_bucket, s3_key=s3_key, status='ready').first():
+        return
+    s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
+
+def transcode_rendition(source_url, s3_bucket, s3_key, bitrate):
+    """
+    Encodes the original audio file at the given bitrate and uploads the result to S3 as it is produced.
+    ffmpeg reads the original straight from S3 and writes to a pipe, so nothing is spooled to disk. Only
+    called by the transcode job of the content, so no other job writes to the same key.
+
+    Returns:
+        int: The size of the rendition in bytes.
+
+    Raises:
+        RuntimeError: If ffmpeg fails to decode or encode the file.
+        Exception: Whatever the upload raised, once ffmpeg is stopped and any partial rendition deleted.
+    """
+    process = subprocess.Popen(
+        [
+            get_ffmpeg_binary(), '-nostdin', '-v', 'error',
+            '-i', source_url,
+            '-map', '0:a:0', '-vn',
+            '-c:a', RENDITION_CODEC, '-b:a', f'{bitrate}k',
+            '-f', 'adts', 'pipe:1',
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stderr = []
+    # Drain stderr concurrently so a chatty ffmpeg cannot block on a full pipe
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    stderr_reader.start()
+
+    try:
+        s3_client.upload_fileobj(process.stdout, s3_bucket, s3_key, ExtraArgs={"ContentType": RENDITION_CONTENT_TYPE})
+    except Exception:
+        # Stop ffmpeg, which would otherwise block on the pipe forever along with the stderr reader
+        process.kill()
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        try:
+            delete_partial_rendition(s3_bucket, s3_key)
+        except Exception:
+            pass
+        raise
+    process.wait()
+    stderr_reader.join()
+    if process.returncode != 0:
+        delete_partial_rendition(s3_bucket, s3_key)
+        raise RuntimeError(b''.join(stderr).decode('utf-8', 'replace').strip() or f"ffmpeg exited with {process.returncode}")
+    return s3_client.head_object(Bucket=s3_bucket, Key=s3_key)["ContentLength"]
+
+def transcode_audiofile(audio_file_id):
+    """
+    Records every configured rendition of an audio file, reusing those already produced for another audio file
+    with the same content, and queues the transcode of its content if any is still missing. Must be called
+    inside an application context. Commits.
+    """
+    audio_file = db.session.get(AudioFile, audio_file_id)
+    if not audio_file:
+        return
+    # Either the transcode job sees the pending renditions, or they see the ready ones it produced
+    lock_renditions(audio_file.blob_digest)
+    missing = False
+    for bitrate in Config.RENDITION_BITRATES:
+        rendition = Rendition.query.filter_by(audio_file_id=audio_file.id, bitrate=bitrate).first()
+        if rendition and rendition.status == 'ready':
+            continue
+        if not rendition:
+            rendition = Rendition(
+                audio_file_id=audio_file.id,
+                bitrate=bitrate,
+                codec=RENDITION_CODEC,
+                content_type=RENDITION_CONTENT_TYPE,
+                s3_bucket=audio_file.s3_bucket,
+                s3_key=rendition_s3_key(audio_file, bitrate)
+            )
+            db.session.add(rendition)
+        # Audio files sharing a blob share renditions, so another file's ready rendition can be reused as is
+        shared = Rendition.query.filter(
+            Rendition.s3_key == rendition.s3_key,
+            Rendition.status == 'ready',
+            Rendition.audio_file_id != audio_file.id
+        ).first()
+        if shared:
+            rendition.size = shared.size
+            rendition.status = 'ready'
+            continue
+        rendition.status = 'pending'
+        missing = True
+    if missing:
+        # Keyed by the content, so a single job transcodes it however many audio files share it
+        enqueue_job(
+            'transcode',
+            {"s3_bucket": audio_file.s3_bucket, "s3_key": audio_file.s3_key},
+            idempotency_key=transcode_job_key(audio_file)
+        )
+    db.session.commit()
+    if missing:
+        job_worker.notify()
+
+@job_handler('transcode')
+def transcode_content(s3_bucket, s3_key):
+    """
+    Produces the missing renditions of the content stored under a key, for every audio file with that content,
+    and marks them ready. The job is retried if a rendition failed, which only redoes the missing ones.
+    """
+    audio_file = AudioFile.query.filter_by(s3_bucket=s3_bucket, s3_key=s3_key).first()
+    if not audio_file:
+        return
+    blob_digest = audio_file.blob_digest
+    rendition_keys = {bitrate: rendition_s3_key(audio_file, bitrate) for bitrate in Config.RENDITION_BITRATES}
+    source_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={"Bucket": s3_bucket, "Key": s3_key},
+        ExpiresIn=SOURCE_URL_EXPIRY_SECONDS
+    )
+
+    failed = []
+    for bitrate, key in rendition_keys.items():
+        missing = Rendition.query.filter(Rendition.s3_key == key, Rendition.status != 'ready').first()
+        # Ends the read, so no transaction stays open while ffmpeg runs
+        db.session.commit()
+        if not missing:
+            continue
+        try:
+            size = transcode_rendition(source_url, s3_bucket, key, bitrate)
+            status = 'ready'
+        except Exception as e:
+            size, status = None, 'failed'
+            failed.append(bitrate)
+            current_app.logger.warning(f"Transcoding {s3_key} at {bitrate}k failed: {e}")
+
+        lock_renditions(blob_digest)
+        renditions = Rendition.query.filter(Rendition.s3_key == key, Rendition.status != 'ready').all()
+        for rendition in renditions:
+            rendition.size = size
+            rendition.status = status
+        db.session.commit()
+        if status == 'ready' and not renditions:
+            # Every audio file with this content was deleted while it was being transcoded
+            delete_partial_rendition(s3_bucket, key)
+    if failed:
+        raise RuntimeError(f"Transcoding failed at {', '.join(f'{bitrate}k' for bitrate in failed)}")
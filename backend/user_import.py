@@ -0,0 +1,138 @@
+import csv
+import io
+import json
+from collections import Counter
+from itertools import islice
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from db import db
+from models import User
+from config import Config
+from passwords import hash_passwords
+from collection_versions import USERS_COLLECTION, bump_versions
+from user_summary import adjust_summary
+
+# Content types accepted by bulk imports
+CSV_MIMETYPES = ('text/csv',)
+JSON_LINES_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/json-lines')
+
+ROLES = ('member', 'admin')
+MAX_USERNAME_LENGTH = User.username.type.length
+
+def read_import_rows(stream, mimetype):
+    """
+    Reads the users of a bulk import from a request body as it arrives, one row at a time.
+    CSV bodies start with a header naming the 'username', 'password' and 'role' columns,
+    JSON lines bodies hold one object with those keys per line. Blank lines are skipped.
+
+    Args:
+        stream: The binary request stream.
+        mimetype (str): The request's content type, one of CSV_MIMETYPES or JSON_LINES_MIMETYPES.
+
+    Yields:
+        tuple: The line number of the row and its fields as a dict, or None if the line is not valid JSON.
+    """
+    text = io.TextIOWrapper(io.BufferedReader(stream), encoding='utf-8-sig', newline='')
+    if mimetype in CSV_MIMETYPES:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+def validate_import_row(row):
+    """
+    Checks the fields of an imported user.
+
+    Returns:
+        str: Why the row cannot be imported, or None if it is valid.
+    """
+    if row is None:
+        return "Row is not a JSON object"
+    username, password, role = row.get('username'), row.get('password'), row.get('role') or 'member'
+    if not isinstance(username, str) or not username or not isinstance(password, str) or not password:
+        return "Username and password are required"
+    if len(username) > MAX_USERNAME_LENGTH:
+        return f"Username is longer than {MAX_USERNAME_LENGTH} characters"
+    if role not in ROLES:
+        return "Role must be member or admin"
+    return None
+
+def import_batch(rows):
+    """
+    Creates the users of one batch in a single transaction: the usernames are checked with one query,
+    the passwords hashed in parallel and the users inserted with one batched INSERT. If a concurrent
+    request takes one of the usernames in the meantime, the batch is checked and inserted again once.
+
+    Args:
+        rows (list): (line number, fields) of the batch's rows, in order.
+
+    Returns:
+        list: The result of each row, with its 'line', 'username' and 'status', which is 'created',
+        'exists' if the username is taken, or 'invalid' with the 'error'.
+    """
+    results = {}
+    users = {}
+    for line_number, row in rows:
+        error = validate_import_row(row)
+        username = row.get('username') if row else None
+        if error:
+            results[line_number] = {"line": line_number, "username": username, "status": "invalid", "error": error}
+        elif username in users:
+            results[line_number] = {"line": line_number, "username": username, "status": "invalid", "error": "Duplicate username in the import"}
+        else:
+            users[username] = (line_number, row)
+
+    hashed_passwords = {}
+    for attempt in range(2):
+        existing = set(db.session.scalars(select(User.username).where(User.username.in_(list(users)))))
+        for username in existing:
+            line_number, _ = users.pop(username)
+            results[line_number] = {"line": line_number, "username": username, "status": "exists"}
+        # Hashed once, a retry only drops the rows that became duplicates
+        pending = [username for username in users if username not in hashed_passwords]
+        hashed_passwords.update(zip(pending, hash_passwords([users[username][1]['password'] for username in pending])))
+        try:
+            if users:
+                db.session.execute(insert(User), [
+                    {"username": username, "password": hashed_passwords[username], "role": row.get('role') or 'member'}
+                    for username, (_, row) in users.items()
+                ])
+                for role, count in Counter(row.get('role') or 'member' for _, row in users.values()).items():
+                    adjust_summary(role, users=count)
+                bump_versions(USERS_COLLECTION)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                raise
+
+    for username, (line_number, _) in users.items():
+        results[line_number] = {"line": line_number, "username": username, "status": "created"}
+    return [results[line_number] for line_number in sorted(results)]
+
+def import_users(rows):
+    """
+    Imports users in batches of Config.USER_IMPORT_BATCH_SIZE, so memory stays bounded whatever the
+    size of the import. Each batch is committed before the next one is read.
+
+    Args:
+        rows: Iterable of (line number, fields), as yielded by read_import_rows.
+
+    Yields:
+        dict: The result of each row, see import_batch.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, Config.USER_IMPORT_BATCH_SIZE))
+        if not batch:
+            return
+        yield from import_batch(batch)
@@ -0,0 +1,57 @@
+from sqlalchemy import select, update
+from db import db
+from models import User, UserSummary
+
+def user_role(user_id):
+    """Returns the role of a user as a subquery, so a statement can adjust the totals of the user's role without reading it first."""
+    return select(User.role).where(User.id == user_id).scalar_subquery()
+
+def adjust_summary_statement(role, users=0, files=0, storage_bytes=0):
+    """
+    Builds the UPDATE adding to the totals of a role, see adjust_summary.
+
+    Args:
+        role: The role, or an expression returning it such as user_role(user_id).
+        users (int): Number of users to add, negative to remove.
+        files (int): Number of audio files to add, negative to remove.
+        storage_bytes (int): Size of the audio files to add, negative to remove.
+    """
+    return update(UserSummary).where(UserSummary.role == role).values(
+        user_count=UserSummary.user_count + users,
+        file_count=UserSummary.file_count + files,
+        storage_bytes=UserSummary.storage_bytes + storage_bytes
+    ).execution_options(synchronize_session=False)
+
+def adjust_summary(role, users=0, files=0, storage_bytes=0):
+    """
+    Adds to the totals of a role. Must be in the transaction that creates or deletes the users or audio
+    files counted. Does not commit.
+    """
+    db.session.execute(adjust_summary_statement(role, users, files, storage_bytes))
+
+def move_user_summary(user_id, old_role):
+    """
+    Moves a user and their audio files from the totals of their old role to those of their new one.
+    Must be called once the role change is flushed, as the UPDATE of the user locks their counters so
+    the audio files added or removed concurrently are counted in the new role. Does not commit.
+    """
+    counters = db.session.execute(select(User.role, User.file_count, User.storage_bytes).where(User.id == user_id)).one()
+    if counters.role == old_role:
+        return
+    adjust_summary(old_role, -1, -counters.file_count, -counters.storage_bytes)
+    adjust_summary(counters.role, 1, counters.file_count, counters.storage_bytes)
+
+def user_summary():
+    """
+    Returns the totals of the users shown by the admin user listing, that is all but the master user.
+
+    Returns:
+        dict: The number of 'users', their 'file_count' and 'storage_bytes', and the number of users of each role in 'roles'.
+    """
+    rows = UserSummary.query.filter(UserSummary.role != 'master').order_by(UserSummary.role).all()
+    return {
+        "users": sum(row.user_count for row in rows),
+        "file_count": sum(row.file_count for row in rows),
+        "storage_bytes": sum(row.storage_bytes for row in rows),
+        "roles": {row.role: row.user_count for row in rows},
+    }
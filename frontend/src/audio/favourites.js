@@ -20,32 +20,39 @@ function FavouriteAudioFiles({ selectedTab }) {
     }
 
     try {
-      const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/audiofiles/favourites`, {
-        method: 'GET',
-        headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`,
-        },
-      });
+      // The listing is paginated, keep following next_cursor and show each page as it arrives
+      let allAudioFiles = [];
+      let cursor = null;
+      do {
+        const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/audiofiles/favourites${query}`, {
+          method: 'GET',
+          headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${token}`,
+          },
+        });
 
-      const data = await response.json();
+        const data = await response.json();
 
-      if (response.ok) {
+        if (!response.ok) {
+          console.error('Failed to fetch audio files:', data.error);
+          return;
+        }
         console.log('Raw Response Data:', data);
-        // Map the response to include audio file details and decoded content (Base64 to data URL)
+        // Map the response to include audio file details and the URL the player streams the content from
         const formattedAudioFiles = (data.audiofiles || []).map((file) => ({
           ...file,
           liked: file.liked || false, // Add liked property if it doesn't exist
-          audioDataUrl: file.file_content
-            ? `data:audio/mpeg;base64,${file.file_content}`  // Assuming it's an MP3 file
-            : file.file_url, // Fallback to the external URL if no Base64 content
+          audioDataUrl: file.file_url
+            || `${process.env.REACT_APP_BACKEND_URL}/audiofiles/${file.id}/stream?token=${encodeURIComponent(token)}`,
         }));
 
-        setAudioFiles(formattedAudioFiles);
-        setFilteredAudioFiles(formattedAudioFiles); // Set filtered files initially
-      } else {
-        console.error('Failed to fetch audio files:', data.error);
-      }
+        allAudioFiles = allAudioFiles.concat(formattedAudioFiles);
+        setAudioFiles(allAudioFiles);
+        setFilteredAudioFiles(allAudioFiles); // Set filtered files initially
+        cursor = data.next_cursor;
+      } while (cursor);
     } catch (error) {
       console.error('Error fetching audio files:', error);
     }
@@ -146,7 +153,7 @@ function FavouriteAudioFiles({ selectedTab }) {
         <tr key={file.id}>
           <td style={{ width: '30%' }}>{file.file_name}</td> 
           <td style={{ width: '59%' }}>
-          <audio controls className="audio-player">
+          <audio controls preload="metadata" className="audio-player">
             <source src={file.audioDataUrl} type="audio/mpeg" />
             Your browser does not support the audio element.
           </audio>
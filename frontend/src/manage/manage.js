@@ -63,20 +63,28 @@ function Manage({selectedTab}) {
     }
 
     try {
-      const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/users`, {
-        method: 'GET',
-        headers: {
-          'Content-Type': 'application/json',
-          'Authorization': `Bearer ${token}`,
-        },
-      });
+      // The listing is paginated, keep following next_cursor and show each page as it arrives
+      let allUsers = [];
+      let cursor = null;
+      do {
+        const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`${process.env.REACT_APP_BACKEND_URL}/users${query}`, {
+          method: 'GET',
+          headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${token}`,
+          },
+        });
 
-      const data = await response.json();
-      if (response.ok) {
-        setUsers(data.users);
-      } else {
-        console.error('Failed to fetch users:', data.error);
-      }
+        const data = await response.json();
+        if (!response.ok) {
+          console.error('Failed to fetch users:', data.error);
+          return;
+        }
+        allUsers = allUsers.concat(data.users);
+        setUsers(allUsers);
+        cursor = data.next_cursor;
+      } while (cursor);
     } catch (error) {
       console.error('Error fetching users:', error);
     }